@@ -25,6 +25,7 @@ use clap::Parser;
 use clap::ValueEnum;
 use json_arg::JsonFile;
 use tracing::debug;
+use tracing::info;
 use tracing::trace;
 use tracing::warn;
 
@@ -219,14 +220,25 @@ impl Compile {
                 let _ = std::fs::remove_file(&self.output);
                 std::os::unix::fs::symlink(subvol.path(), &self.output)
                     .context("while making symlink")?;
+                if let Err(e) = working_volume
+                    .as_ref()
+                    .expect("WorkingVolume always exists for btrfs")
+                    .record_reference(subvol.path(), &self.output)
+                {
+                    warn!("failed to record reference to subvol: {e:#?}");
+                }
 
                 let root_guard = rootless.map(|r| r.escalate()).transpose()?;
-                if let Err(e) = working_volume
+                match working_volume
                     .as_ref()
                     .expect("WorkingVolume always exists for btrfs")
                     .garbage_collect_old_subvols()
                 {
-                    warn!("failed to gc old subvols: {e:#?}")
+                    Ok(report) => info!(
+                        "gc deleted {} subvols in {:?}, {} remain",
+                        report.deleted, report.elapsed, report.remaining,
+                    ),
+                    Err(e) => warn!("failed to gc old subvols: {e:#?}"),
                 }
                 drop(root_guard);
             }
@@ -262,6 +274,12 @@ impl Compile {
                     Some(parent) => {
                         trace!("snapshotting parent {parent:?}");
                         let parent = Subvolume::open(parent)?;
+                        if let Err(e) = working_volume
+                            .expect("checked above")
+                            .mark_used(parent.path())
+                        {
+                            warn!("failed to mark parent as used: {e:#?}");
+                        }
                         parent.snapshot(&dst, Default::default())?
                     }
                     None => Subvolume::create(&dst)?,
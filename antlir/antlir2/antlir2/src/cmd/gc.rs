@@ -0,0 +1,54 @@
+/*
+ * Copyright (c) Meta Platforms, Inc. and affiliates.
+ *
+ * This source code is licensed under the MIT license found in the
+ * LICENSE file in the root directory of this source tree.
+ */
+
+use std::time::Duration;
+
+use antlir2_working_volume::GcPolicy;
+use antlir2_working_volume::WorkingVolume;
+use clap::Parser;
+
+use crate::Result;
+
+#[derive(Parser, Debug)]
+/// Garbage collect subvolumes in the working volume
+pub(crate) struct Gc {
+    #[clap(long)]
+    /// Delete the least recently used subvolumes that no build output points
+    /// to anymore until the rest fit in this many bytes
+    max_bytes: Option<u64>,
+    #[clap(long)]
+    /// Delete subvolumes that have not been used in this many days
+    max_age_days: Option<u64>,
+}
+
+impl Gc {
+    #[tracing::instrument(name = "gc", skip(self))]
+    pub(crate) fn run(self) -> Result<()> {
+        let default = GcPolicy::default();
+        let policy = GcPolicy {
+            max_bytes: self.max_bytes,
+            max_age: self
+                .max_age_days
+                .map(|days| Duration::from_secs(days * 24 * 60 * 60))
+                .unwrap_or(default.max_age),
+            ..default
+        };
+        let report = WorkingVolume::ensure()?.garbage_collect(&policy)?;
+        println!(
+            "deleted {} subvols in {:?}, {} remain",
+            report.deleted, report.elapsed, report.remaining,
+        );
+        // sizes are only measured when there is a byte budget to enforce
+        if policy.max_bytes.is_some() {
+            println!(
+                "reclaimed up to {} bytes, {} bytes remain",
+                report.reclaimed_bytes, report.remaining_bytes,
+            );
+        }
+        Ok(())
+    }
+}
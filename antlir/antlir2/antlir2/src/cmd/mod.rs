@@ -7,5 +7,7 @@
 
 mod compile;
 mod depgraph;
+mod gc;
 pub(crate) use compile::Compile;
 pub(crate) use depgraph::Depgraph;
+pub(crate) use gc::Gc;
@@ -93,6 +93,7 @@ impl LogArgs {
 enum Subcommand {
     Compile(cmd::Compile),
     Depgraph(cmd::Depgraph),
+    Gc(cmd::Gc),
 }
 
 impl Error {
@@ -127,6 +128,7 @@ fn main() -> Result<()> {
     let result = match args.subcommand {
         Subcommand::Compile(x) => x.run(rootless),
         Subcommand::Depgraph(x) => x.run(),
+        Subcommand::Gc(x) => x.run(),
     };
     if let Err(e) = result {
         error!("{e:#?}");
@@ -6,6 +6,7 @@
  */
 
 use std::path::PathBuf;
+use std::sync::mpsc::Receiver;
 
 use cap_std::fs::Dir;
 use cap_std::fs::File;
@@ -17,6 +18,7 @@ use crate::Contents;
 use crate::Operation;
 use crate::Result;
 
+mod extents;
 mod file;
 mod tree;
 mod xattrs;
@@ -76,6 +78,31 @@ fn sanitize_mode(mode: u32) -> u32 {
     mode & !0o0170000
 }
 
+/// Expand a single instruction into the instructions that replace it on the
+/// stack (already in stack order, so the last element is the next one to be
+/// processed).
+fn expand<C>(instr: Instruction<C>) -> Result<Vec<Instruction<C>>>
+where
+    C: Contents,
+{
+    match instr {
+        Instruction::Change(c) => Ok(vec![Instruction::Change(c)]),
+        Instruction::CompareTree { prefix, old, new } => tree::compare(&prefix, old, new),
+        Instruction::RemoveTree { prefix, dir } => tree::remove(&prefix, dir),
+        Instruction::AddTree { prefix, dir } => tree::add(&prefix, dir),
+        Instruction::CompareFile { path, old, new } => Ok(file::compare(old, new)?
+            .into_iter()
+            .rev()
+            .map(|op| Instruction::Change(Change::new(path.clone(), op)))
+            .collect()),
+        Instruction::NewFile { path, file } => Ok(file::add(file)?
+            .into_iter()
+            .rev()
+            .map(|op| Instruction::Change(Change::new(path.clone(), op)))
+            .collect()),
+    }
+}
+
 /// Run the stack machine to completion using this starting set of instructions,
 /// yielding each change as it is produced by the stack machine.
 pub(crate) fn run_to_completion<C, F>(mut stack: Vec<Instruction<C>>, mut yield_fn: F) -> Result<()>
@@ -86,32 +113,88 @@ where
     while let Some(instr) = stack.pop() {
         match instr {
             Instruction::Change(c) => yield_fn(c),
-            Instruction::CompareTree { prefix, old, new } => {
-                stack.extend(tree::compare(&prefix, old, new)?);
-            }
-            Instruction::RemoveTree { prefix, dir } => {
-                stack.extend(tree::remove(&prefix, dir)?);
-            }
-            Instruction::AddTree { prefix, dir } => {
-                stack.extend(tree::add(&prefix, dir)?);
-            }
-            Instruction::CompareFile { path, old, new } => {
-                let ops = file::compare(old, new)?;
-                stack.extend(
-                    ops.into_iter()
-                        .rev()
-                        .map(|op| Instruction::Change(Change::new(path.clone(), op))),
-                );
+            instr => stack.extend(expand(instr)?),
+        }
+    }
+    Ok(())
+}
+
+/// Entry on the stack of [run_to_completion_parallel]
+enum Slot<C> {
+    /// Instruction that has not been started yet
+    Ready(Instruction<C>),
+    /// Instruction that was handed off to the worker pool, its expansion will
+    /// be sent on this channel
+    InFlight(Receiver<Result<Vec<Instruction<C>>>>),
+}
+
+/// Same as [run_to_completion], but the expensive parts of the stack machine
+/// (reading directories and comparing file contents) are done on a worker pool.
+///
+/// The stack itself is still only ever manipulated by this thread, and an
+/// instruction that is handed off to the pool is replaced in-place by a
+/// placeholder for its result, so the order of the yielded changes is exactly
+/// the same as that of [run_to_completion]. Workers look ahead at (at most
+/// `max_in_flight`) instructions near the top of the stack, which are the
+/// next ones that will be needed.
+pub(crate) fn run_to_completion_parallel<C, F>(
+    stack: Vec<Instruction<C>>,
+    pool: &rayon::ThreadPool,
+    max_in_flight: usize,
+    mut yield_fn: F,
+) -> Result<()>
+where
+    C: Contents + 'static,
+    F: FnMut(Change<C>),
+{
+    let mut stack: Vec<Slot<C>> = stack.into_iter().map(Slot::Ready).collect();
+    let mut in_flight = 0;
+    submit(&mut stack, pool, &mut in_flight, max_in_flight);
+    while let Some(slot) = stack.pop() {
+        let expanded = match slot {
+            Slot::Ready(Instruction::Change(c)) => {
+                yield_fn(c);
+                continue;
             }
-            Instruction::NewFile { path, file } => {
-                let ops = file::add(file)?;
-                stack.extend(
-                    ops.into_iter()
-                        .rev()
-                        .map(|op| Instruction::Change(Change::new(path.clone(), op))),
-                );
+            Slot::Ready(instr) => expand(instr)?,
+            Slot::InFlight(rx) => {
+                in_flight -= 1;
+                rx.recv().expect("worker exited without sending a result")?
             }
-        }
+        };
+        stack.extend(expanded.into_iter().map(Slot::Ready));
+        submit(&mut stack, pool, &mut in_flight, max_in_flight);
     }
     Ok(())
 }
+
+/// Hand off instructions from the top of the stack to the worker pool until
+/// there are `max_in_flight` outstanding. Only the top `max_in_flight * 2`
+/// slots are considered, so that this stays cheap when the top of the stack
+/// is mostly made up of changes that are ready to be yielded.
+fn submit<C>(
+    stack: &mut [Slot<C>],
+    pool: &rayon::ThreadPool,
+    in_flight: &mut usize,
+    max_in_flight: usize,
+) where
+    C: Contents + 'static,
+{
+    for slot in stack.iter_mut().rev().take(max_in_flight * 2) {
+        if *in_flight >= max_in_flight {
+            break;
+        }
+        if !matches!(slot, Slot::Ready(instr) if !matches!(instr, Instruction::Change(_))) {
+            continue;
+        }
+        let (tx, rx) = std::sync::mpsc::sync_channel(1);
+        let Slot::Ready(instr) = std::mem::replace(slot, Slot::InFlight(rx)) else {
+            unreachable!("checked above");
+        };
+        *in_flight += 1;
+        pool.spawn(move || {
+            // the receiver is only gone if the stack machine already failed
+            let _ = tx.send(expand(instr));
+        });
+    }
+}
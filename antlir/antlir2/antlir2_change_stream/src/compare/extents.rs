@@ -0,0 +1,309 @@
+/*
+ * Copyright (c) Meta Platforms, Inc. and affiliates.
+ *
+ * This source code is licensed under the MIT license found in the
+ * LICENSE file in the root directory of this source tree.
+ */
+
+//! Cheap content comparison for files that share physical extents.
+//!
+//! Layers are (usually) btrfs snapshots of their parent, so a file that was
+//! not touched still points at the exact same extents on disk as the parent
+//! copy. Comparing the extent maps (from FIEMAP) lets us prove that two files
+//! are identical without reading any of their data, and for files that were
+//! only partially rewritten, only the ranges that are not shared have to be
+//! read.
+
+use std::fs::File;
+use std::ops::Range;
+use std::os::fd::AsRawFd;
+use std::os::unix::fs::FileExt;
+use std::os::unix::fs::MetadataExt;
+
+use nix::ioctl_readwrite;
+
+const EXTENTS_PER_CALL: usize = 256;
+
+const FIEMAP_FLAG_SYNC: u32 = 0x1;
+const FIEMAP_EXTENT_LAST: u32 = 0x1;
+/// Extent flags that mean that the physical address cannot be used to
+/// determine if two extents contain the same data:
+///  - UNKNOWN, DELALLOC: data location is not known (yet)
+///  - ENCODED: compressed extents may be referenced at different offsets with
+///    the same reported physical address
+///  - NOT_ALIGNED, DATA_INLINE, DATA_TAIL: data is packed with other metadata
+const FIEMAP_EXTENT_UNRELIABLE: u32 = 0x2 | 0x4 | 0x8 | 0x100 | 0x200 | 0x400;
+
+const COMPARE_CHUNK_SIZE: usize = 1 << 20;
+
+#[allow(non_camel_case_types)]
+#[derive(Copy, Clone, Default)]
+#[repr(C)]
+pub(crate) struct fiemap {
+    pub fm_start: u64,
+    pub fm_length: u64,
+    pub fm_flags: u32,
+    pub fm_mapped_extents: u32,
+    pub fm_extent_count: u32,
+    pub fm_reserved: u32,
+}
+
+#[allow(non_camel_case_types)]
+#[derive(Copy, Clone, Default)]
+#[repr(C)]
+pub(crate) struct fiemap_extent {
+    pub fe_logical: u64,
+    pub fe_physical: u64,
+    pub fe_length: u64,
+    pub fe_reserved64: [u64; 2],
+    pub fe_flags: u32,
+    pub fe_reserved: [u32; 3],
+}
+
+ioctl_readwrite!(fs_ioc_fiemap, b'f', 11, fiemap);
+
+/// struct fiemap with its trailing flexible array of extents
+#[repr(C)]
+struct FiemapRequest {
+    header: fiemap,
+    extents: [fiemap_extent; EXTENTS_PER_CALL],
+}
+
+#[derive(Debug, Copy, Clone, PartialEq, Eq)]
+struct Extent {
+    logical: u64,
+    len: u64,
+    /// Physical address of the first byte of this extent, or None if it
+    /// cannot be trusted to identify the data.
+    physical: Option<u64>,
+}
+
+impl Extent {
+    fn end(&self) -> u64 {
+        self.logical + self.len
+    }
+}
+
+fn extents(file: &File, size: u64) -> std::io::Result<Vec<Extent>> {
+    let mut req = Box::new(FiemapRequest {
+        header: fiemap::default(),
+        extents: [fiemap_extent::default(); EXTENTS_PER_CALL],
+    });
+    let mut extents = Vec::new();
+    let mut start = 0;
+    while start < size {
+        req.header = fiemap {
+            fm_start: start,
+            fm_length: size - start,
+            fm_flags: FIEMAP_FLAG_SYNC,
+            fm_extent_count: EXTENTS_PER_CALL as u32,
+            ..Default::default()
+        };
+        // SAFETY: the request has room for fm_extent_count extents following
+        // the header
+        unsafe { fs_ioc_fiemap(file.as_raw_fd(), &mut req.header as *mut fiemap) }?;
+        let mapped = &req.extents[..req.header.fm_mapped_extents as usize];
+        for fe in mapped {
+            extents.push(Extent {
+                logical: fe.fe_logical,
+                len: fe.fe_length,
+                physical: if fe.fe_flags & FIEMAP_EXTENT_UNRELIABLE == 0 {
+                    Some(fe.fe_physical)
+                } else {
+                    None
+                },
+            });
+        }
+        match mapped.last() {
+            Some(last) if last.fe_flags & FIEMAP_EXTENT_LAST == 0 => {
+                start = last.fe_logical + last.fe_length;
+            }
+            _ => break,
+        }
+    }
+    Ok(extents)
+}
+
+/// Mount id of the file, if the kernel is new enough to report it.
+fn mnt_id(file: &File) -> Option<u64> {
+    let mut stx = std::mem::MaybeUninit::<libc::statx>::uninit();
+    // SAFETY: statx fills in the buffer when it returns successfully
+    let ret = unsafe {
+        libc::statx(
+            file.as_raw_fd(),
+            c"".as_ptr(),
+            libc::AT_EMPTY_PATH,
+            libc::STATX_MNT_ID,
+            stx.as_mut_ptr(),
+        )
+    };
+    if ret != 0 {
+        return None;
+    }
+    // SAFETY: statx succeeded
+    let stx = unsafe { stx.assume_init() };
+    if stx.stx_mask & libc::STATX_MNT_ID != 0 {
+        Some(stx.stx_mnt_id)
+    } else {
+        None
+    }
+}
+
+/// Physical addresses are only comparable within the same filesystem. Every
+/// btrfs subvolume has its own st_dev, so snapshots are recognized by being on
+/// the same mount instead.
+fn same_filesystem(old: &File, new: &File) -> std::io::Result<bool> {
+    if old.metadata()?.dev() == new.metadata()?.dev() {
+        return Ok(true);
+    }
+    Ok(matches!((mnt_id(old), mnt_id(new)), (Some(o), Some(n)) if o == n))
+}
+
+/// Split `0..size` into ranges that are known to be equal in both files, and
+/// ranges that must be read to find out. Returns the latter, along with
+/// whether any range was proven equal by sharing a physical extent.
+fn unshared_ranges(old: &[Extent], new: &[Extent], size: u64) -> (Vec<Range<u64>>, bool) {
+    let mut boundaries: Vec<u64> = old
+        .iter()
+        .chain(new)
+        .flat_map(|e| [e.logical, e.end()])
+        .filter(|b| *b < size)
+        .chain([0, size])
+        .collect();
+    boundaries.sort_unstable();
+    boundaries.dedup();
+
+    let mut unshared: Vec<Range<u64>> = Vec::new();
+    let mut any_shared = false;
+    let (mut old_idx, mut new_idx) = (0, 0);
+    for segment in boundaries.windows(2) {
+        let (start, end) = (segment[0], segment[1]);
+        while old_idx < old.len() && old[old_idx].end() <= start {
+            old_idx += 1;
+        }
+        while new_idx < new.len() && new[new_idx].end() <= start {
+            new_idx += 1;
+        }
+        // since every extent start and end is a boundary, a segment is either
+        // entirely inside of an extent or entirely in a hole
+        let old_ext = old.get(old_idx).filter(|e| e.logical <= start);
+        let new_ext = new.get(new_idx).filter(|e| e.logical <= start);
+        let equal = match (old_ext, new_ext) {
+            // holes always read as zeroes
+            (None, None) => true,
+            (Some(o), Some(n)) => match (o.physical, n.physical) {
+                (Some(op), Some(np)) if op + (start - o.logical) == np + (start - n.logical) => {
+                    any_shared = true;
+                    true
+                }
+                _ => false,
+            },
+            _ => false,
+        };
+        if !equal {
+            match unshared.last_mut() {
+                Some(prev) if prev.end == start => prev.end = end,
+                _ => unshared.push(start..end),
+            }
+        }
+    }
+    (unshared, any_shared)
+}
+
+fn ranges_equal(old: &File, new: &File, ranges: &[Range<u64>]) -> std::io::Result<bool> {
+    let mut old_buf = vec![0; COMPARE_CHUNK_SIZE];
+    let mut new_buf = vec![0; COMPARE_CHUNK_SIZE];
+    for range in ranges {
+        let mut pos = range.start;
+        while pos < range.end {
+            let len = std::cmp::min(COMPARE_CHUNK_SIZE as u64, range.end - pos) as usize;
+            old.read_exact_at(&mut old_buf[..len], pos)?;
+            new.read_exact_at(&mut new_buf[..len], pos)?;
+            if old_buf[..len] != new_buf[..len] {
+                return Ok(false);
+            }
+            pos += len as u64;
+        }
+    }
+    Ok(true)
+}
+
+fn try_identical(old: &File, new: &File) -> std::io::Result<bool> {
+    let size = old.metadata()?.len();
+    if size != new.metadata()?.len() || !same_filesystem(old, new)? {
+        return Ok(false);
+    }
+    let (unshared, any_shared) = unshared_ranges(&extents(old, size)?, &extents(new, size)?, size);
+    if unshared.is_empty() {
+        return Ok(true);
+    }
+    // If nothing at all is shared, this is no cheaper than a regular
+    // comparison, so leave it to [crate::Contents::differs] instead of
+    // potentially reading everything twice.
+    if !any_shared {
+        return Ok(false);
+    }
+    ranges_equal(old, new, &unshared)
+}
+
+/// Returns true only if `old` and `new` are proven to have identical contents
+/// by (mostly) sharing the same extents on disk. A false return does not mean
+/// that the files differ, just that they need to be fully compared.
+pub(super) fn identical(old: &File, new: &File) -> bool {
+    // any failure (for example, a filesystem that does not support FIEMAP) just
+    // means that the fast path is not available
+    try_identical(old, new).unwrap_or(false)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn ext(logical: u64, len: u64, physical: Option<u64>) -> Extent {
+        Extent {
+            logical,
+            len,
+            physical,
+        }
+    }
+
+    #[test]
+    fn fully_shared() {
+        let e = [ext(0, 4096, Some(1 << 20)), ext(4096, 8192, Some(1 << 30))];
+        assert_eq!(unshared_ranges(&e, &e, 12288), (vec![], true));
+    }
+
+    #[test]
+    fn partially_rewritten() {
+        let old = [ext(0, 12288, Some(1 << 20))];
+        // the middle block was rewritten, the rest still references the same
+        // (now split) extent
+        let new = [
+            ext(0, 4096, Some(1 << 20)),
+            ext(4096, 4096, Some(1 << 30)),
+            ext(8192, 4096, Some((1 << 20) + 8192)),
+        ];
+        assert_eq!(unshared_ranges(&old, &new, 12288), (vec![4096..8192], true));
+    }
+
+    #[test]
+    fn unreliable_and_holes() {
+        let old = [ext(0, 4096, None), ext(8192, 4096, Some(1 << 20))];
+        let new = [ext(0, 4096, None), ext(12288, 4096, Some(1 << 20))];
+        // 0..4096 is not trustworthy, 4096..8192 is a hole in both, and the
+        // rest has no matching extents
+        assert_eq!(
+            unshared_ranges(&old, &new, 16384),
+            (vec![0..4096, 8192..16384], false)
+        );
+    }
+
+    #[test]
+    fn no_extents() {
+        assert_eq!(unshared_ranges(&[], &[], 100), (vec![], false));
+        assert_eq!(
+            unshared_ranges(&[ext(0, 4096, Some(0))], &[], 100),
+            (vec![0..100], false)
+        );
+    }
+}
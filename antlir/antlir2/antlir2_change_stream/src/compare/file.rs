@@ -10,6 +10,7 @@ use std::os::fd::AsRawFd as _;
 use cap_std::fs::File;
 use cap_std::fs::MetadataExt;
 
+use super::extents;
 use super::maybe_chmod;
 use super::maybe_chown;
 use super::maybe_set_times;
@@ -30,12 +31,16 @@ pub(super) fn compare<C: Contents>(old: File, new: File) -> Result<Vec<Operation
         // re-open them for reading (the given fds are just O_PATH)
         let new_fd = std::fs::File::open(format!("/proc/self/fd/{}", new.as_raw_fd()))?;
         let old_fd = std::fs::File::open(format!("/proc/self/fd/{}", old.as_raw_fd()))?;
-        let mut new_contents = C::from_file(new_fd)?;
-        let mut old_contents = C::from_file(old_fd)?;
-        if new_contents.differs(&mut old_contents)? {
-            ops.push(Operation::Contents {
-                contents: new_contents,
-            });
+        // Unchanged files in a snapshot still share all their extents with the
+        // parent, so this avoids reading the data of the vast majority of files
+        if !extents::identical(&old_fd, &new_fd) {
+            let mut new_contents = C::from_file(new_fd)?;
+            let mut old_contents = C::from_file(old_fd)?;
+            if new_contents.differs(&mut old_contents)? {
+                ops.push(Operation::Contents {
+                    contents: new_contents,
+                });
+            }
         }
     }
 
@@ -5,6 +5,7 @@
  * LICENSE file in the root directory of this source tree.
  */
 
+use std::num::NonZeroUsize;
 use std::path::Path;
 
 use cap_std::fs::Dir;
@@ -18,37 +19,93 @@ pub struct Iter<C> {
     rx: std::sync::mpsc::IntoIter<Result<Change<C>>>,
 }
 
+/// Number of threads used by [Iter::diff] and [Iter::from_empty]
+fn default_threads() -> usize {
+    std::thread::available_parallelism()
+        .map(NonZeroUsize::get)
+        .unwrap_or(1)
+}
+
 impl<C: Contents + 'static> Iter<C> {
     /// Diff two filesystem trees and produce a change stream that can be used
     /// to convert `old` to `new`.
     pub fn diff(old: impl AsRef<Path>, new: impl AsRef<Path>) -> Result<Self> {
+        Self::diff_with_threads(old, new, default_threads())
+    }
+
+    /// Same as [Iter::diff], but walk the trees and compare file contents on
+    /// `threads` worker threads. The order of the change stream does not
+    /// depend on the number of threads.
+    pub fn diff_with_threads(
+        old: impl AsRef<Path>,
+        new: impl AsRef<Path>,
+        threads: usize,
+    ) -> Result<Self> {
         let old = Dir::open_ambient_dir(old.as_ref(), cap_std::ambient_authority())?;
         let new = Dir::open_ambient_dir(new.as_ref(), cap_std::ambient_authority())?;
-        Self::with_initial_instruction(compare::Instruction::CompareTree {
-            prefix: "".into(),
-            old,
-            new,
-        })
+        Self::with_initial_instruction(
+            compare::Instruction::CompareTree {
+                prefix: "".into(),
+                old,
+                new,
+            },
+            threads,
+        )
     }
 
     /// Generate a change stream for a completely new directory.
     pub fn from_empty(new: impl AsRef<Path>) -> Result<Self> {
+        Self::from_empty_with_threads(new, default_threads())
+    }
+
+    /// Same as [Iter::from_empty], but read the tree on `threads` worker
+    /// threads.
+    pub fn from_empty_with_threads(new: impl AsRef<Path>, threads: usize) -> Result<Self> {
         let new = Dir::open_ambient_dir(new.as_ref(), cap_std::ambient_authority())?;
-        Self::with_initial_instruction(compare::Instruction::AddTree {
-            prefix: "".into(),
-            dir: new,
-        })
+        Self::with_initial_instruction(
+            compare::Instruction::AddTree {
+                prefix: "".into(),
+                dir: new,
+            },
+            threads,
+        )
     }
 
-    fn with_initial_instruction(instruction: compare::Instruction<C>) -> Result<Self> {
+    fn with_initial_instruction(
+        instruction: compare::Instruction<C>,
+        threads: usize,
+    ) -> Result<Self> {
+        let pool = if threads > 1 {
+            Some(
+                rayon::ThreadPoolBuilder::new()
+                    .num_threads(threads)
+                    .thread_name(|i| format!("compare-{i}"))
+                    .build()
+                    .map_err(std::io::Error::other)?,
+            )
+        } else {
+            None
+        };
         let (tx, rx) = std::sync::mpsc::channel();
         std::thread::Builder::new()
             .name("compare".to_owned())
             .spawn(move || {
-                if let Err(e) = compare::run_to_completion::<C, _>(vec![instruction], |change| {
+                let yield_fn = |change| {
                     tx.send(Ok(change))
                         .expect("failed to send change on channel");
-                }) {
+                };
+                let res = match &pool {
+                    Some(pool) => compare::run_to_completion_parallel::<C, _>(
+                        vec![instruction],
+                        pool,
+                        // enough lookahead to keep every worker busy while
+                        // this thread is blocked on the oldest result
+                        threads * 4,
+                        yield_fn,
+                    ),
+                    None => compare::run_to_completion::<C, _>(vec![instruction], yield_fn),
+                };
+                if let Err(e) = res {
                     tx.send(Err(e)).expect("failed to send");
                 }
             })?;
@@ -9,6 +9,7 @@ use std::io::BufReader;
 use std::io::Read;
 use std::path::Path;
 use std::path::PathBuf;
+use std::time::Instant;
 use std::time::UNIX_EPOCH;
 
 use antlir2_change_stream::Change;
@@ -386,3 +387,79 @@ fn dir_to_file() {
         changes_between::<LossyString>("/some-mutation-base", "/dir-to-file", TimestampMode::Omit)
     );
 }
+
+fn collect_with_threads(old: Option<&str>, new: &str, threads: usize) -> Vec<Change<Vec<u8>>> {
+    match old {
+        Some(old) => Iter::diff_with_threads(old, new, threads),
+        None => Iter::from_empty_with_threads(new, threads),
+    }
+    .expect("failed to create stream")
+    .map(|r| r.expect("failed to get change"))
+    .collect()
+}
+
+#[test]
+fn thread_count_does_not_change_stream() {
+    for (old, new) in [
+        (None, "/some"),
+        (Some("/empty"), "/some"),
+        (Some("/some"), "/empty"),
+        (Some("/some-mutation-base"), "/file-to-dir"),
+        (Some("/some-mutation-base"), "/dir-to-file"),
+    ] {
+        let expected = collect_with_threads(old, new, 1);
+        for threads in [2, 8] {
+            assert!(
+                expected == collect_with_threads(old, new, threads),
+                "{old:?} -> {new}: change stream with {threads} threads differs"
+            );
+        }
+    }
+}
+
+/// Diff a reasonably large tree (/usr has all of coreutils and its
+/// dependencies installed) with an increasing number of threads, checking that
+/// the change stream is identical regardless of the thread count and
+/// reporting how long each run took. These are benchmarks that depend on the
+/// host and take a while, so they only run when asked to with --ignored.
+fn check_scaling(old: Option<&str>, new: &str) {
+    let start = Instant::now();
+    let expected = collect_with_threads(old, new, 1);
+    eprintln!(
+        "{old:?} -> {new}: 1 thread: {} changes in {:?}",
+        expected.len(),
+        start.elapsed()
+    );
+    for threads in [2, 4, 8, 16] {
+        let start = Instant::now();
+        let changes = collect_with_threads(old, new, threads);
+        eprintln!(
+            "{old:?} -> {new}: {threads} threads: {} changes in {:?}",
+            changes.len(),
+            start.elapsed()
+        );
+        assert!(
+            expected == changes,
+            "change stream with {threads} threads differs from single-threaded stream"
+        );
+    }
+}
+
+#[test]
+#[ignore]
+fn parallel_scaling_from_empty() {
+    check_scaling(None, "/usr");
+}
+
+#[test]
+#[ignore]
+fn parallel_scaling_identical_trees() {
+    // every file has to have its contents compared, but there are no changes
+    check_scaling(Some("/usr"), "/usr");
+}
+
+#[test]
+#[ignore]
+fn parallel_scaling_empty_to_usr() {
+    check_scaling(Some("/empty"), "/usr");
+}
@@ -8,10 +8,13 @@
 use std::collections::HashMap;
 use std::fs::File;
 use std::fs::FileTimes;
+use std::os::fd::AsRawFd;
 use std::os::unix::fs::MetadataExt;
 use std::os::unix::fs::fchown;
 use std::path::Path;
+use std::path::PathBuf;
 
+use rayon::prelude::*;
 use tracing::trace;
 use tracing::warn;
 use xattr::FileExt;
@@ -37,7 +40,7 @@ pub fn copy_with_metadata(
         return Ok(());
     } else if metadata.is_file() {
         trace!("copying simple file");
-        std::fs::copy(src, dst)?;
+        copy_contents(&File::open(src)?, &File::create(dst)?)?;
     } else if metadata.is_dir() {
         trace!("creating new directory");
         std::fs::create_dir(dst)?;
@@ -69,6 +72,71 @@ pub fn copy_with_metadata(
     Ok(())
 }
 
+/// Copy the contents of `src` into the empty file `dst`.
+///
+/// When both files are on the same filesystem (which is the common case of
+/// cloning between layers on the working volume), try to share the extents
+/// with a reflink so that no data is actually copied. Otherwise fall back to
+/// [std::io::copy], which uses copy_file_range(2) to at least keep the data in
+/// the kernel.
+fn copy_contents(src: &File, dst: &File) -> std::io::Result<()> {
+    // SAFETY: both fds are valid for the duration of this call
+    let ret = unsafe { nix::libc::ioctl(dst.as_raw_fd(), nix::libc::FICLONE, src.as_raw_fd()) };
+    if ret == 0 {
+        trace!("reflinked file contents");
+        return Ok(());
+    }
+    trace!(
+        "reflink failed, copying contents: {}",
+        std::io::Error::last_os_error()
+    );
+    std::io::copy(&mut &*src, &mut &*dst)?;
+    Ok(())
+}
+
+/// One entry to be copied by [copy_tree].
+#[derive(Debug, Clone)]
+pub struct CopyEntry {
+    pub src: PathBuf,
+    pub dst: PathBuf,
+    pub is_dir: bool,
+    pub uid: Option<u32>,
+    pub gid: Option<u32>,
+}
+
+/// [copy_with_metadata] every entry in a (potentially large) tree.
+///
+/// `entries` must list every directory before its contents (as a [WalkDir]
+/// would). Directories are created serially in that order, then everything
+/// else is copied on a pool of worker threads. Adding the contents of a
+/// directory changes its times, so those are set again at the end, in reverse
+/// order so that each directory comes after all of its contents. The
+/// metadata of each entry only depends on that entry, so the resulting tree
+/// (including directory times, which are those of the source) does not depend
+/// on the order that the workers copied things in.
+///
+/// [WalkDir]: https://docs.rs/walkdir
+#[tracing::instrument(skip_all, fields(entries = entries.len()), err)]
+pub fn copy_tree(entries: &[CopyEntry]) -> Result<()> {
+    let (dirs, others): (Vec<_>, Vec<_>) = entries.iter().partition(|e| e.is_dir);
+    for dir in &dirs {
+        copy_with_metadata(&dir.src, &dir.dst, dir.uid, dir.gid)?;
+    }
+    others
+        .par_iter()
+        .try_for_each(|e| copy_with_metadata(&e.src, &e.dst, e.uid, e.gid))?;
+    for dir in dirs.iter().rev() {
+        let metadata = std::fs::symlink_metadata(&dir.src)?;
+        let times = FileTimes::new()
+            .set_accessed(metadata.accessed()?)
+            .set_modified(metadata.modified()?);
+        if let Err(e) = File::open(&dir.dst)?.set_times(times) {
+            warn!("failed to set directory times: {e:?}")
+        }
+    }
+    Ok(())
+}
+
 #[tracing::instrument(skip_all, ret, err)]
 pub(crate) fn copy_xattrs(src: &Path, dst: &File) -> Result<()> {
     match xattr::list(src) {
@@ -91,3 +159,118 @@ pub(crate) fn copy_xattrs(src: &Path, dst: &File) -> Result<()> {
         }
     }
 }
+
+#[cfg(test)]
+mod tests {
+    use std::os::unix::fs::PermissionsExt;
+
+    use super::*;
+
+    /// List everything under `root` with every directory before its contents,
+    /// like a WalkDir would.
+    fn walk(root: &Path, relpath: &Path, out: &mut Vec<(PathBuf, bool)>) {
+        let path = root.join(relpath);
+        let is_dir = std::fs::symlink_metadata(&path)
+            .expect("failed to stat")
+            .is_dir();
+        out.push((relpath.to_owned(), is_dir));
+        if is_dir {
+            let mut children: Vec<_> = std::fs::read_dir(&path)
+                .expect("failed to read dir")
+                .map(|e| e.expect("bad dir entry").file_name())
+                .collect();
+            children.sort();
+            for child in children {
+                walk(root, &relpath.join(child), out);
+            }
+        }
+    }
+
+    #[test]
+    fn copy_contents_copies_everything() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        // bigger than any single read/write buffer
+        let contents: Vec<u8> = (0..(1 << 20) + 17).map(|i| (i % 251) as u8).collect();
+        std::fs::write(tmp.path().join("src"), &contents).expect("failed to write src");
+        copy_contents(
+            &File::open(tmp.path().join("src")).expect("failed to open src"),
+            &File::create(tmp.path().join("dst")).expect("failed to create dst"),
+        )
+        .expect("failed to copy");
+        assert_eq!(
+            std::fs::read(tmp.path().join("dst")).expect("failed to read dst"),
+            contents
+        );
+    }
+
+    #[test]
+    fn copy_tree_matches_source() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let src = tmp.path().join("src");
+        std::fs::create_dir_all(src.join("a/b/c")).expect("failed to create dirs");
+        for i in 0..50 {
+            std::fs::write(src.join(format!("a/b/c/f{i}")), format!("file {i}"))
+                .expect("failed to write file");
+        }
+        std::fs::write(src.join("a/exec"), "#!/bin/sh").expect("failed to write file");
+        std::fs::set_permissions(src.join("a/exec"), std::fs::Permissions::from_mode(0o755))
+            .expect("failed to chmod");
+        std::fs::set_permissions(src.join("a/b"), std::fs::Permissions::from_mode(0o700))
+            .expect("failed to chmod");
+        std::os::unix::fs::symlink("b/c/f0", src.join("a/link")).expect("failed to symlink");
+        // distinct times that copying the contents would change
+        for (i, dir) in ["", "a", "a/b", "a/b/c"].iter().enumerate() {
+            File::open(src.join(dir))
+                .expect("failed to open dir")
+                .set_times(FileTimes::new().set_modified(
+                    std::time::UNIX_EPOCH
+                        + std::time::Duration::from_secs(1_000_000 * (i as u64 + 1)),
+                ))
+                .expect("failed to set times");
+        }
+
+        let mut listing = Vec::new();
+        walk(&src, Path::new(""), &mut listing);
+        let dst = tmp.path().join("dst");
+        let entries: Vec<_> = listing
+            .iter()
+            .map(|(relpath, is_dir)| CopyEntry {
+                src: src.join(relpath),
+                dst: dst.join(relpath),
+                is_dir: *is_dir,
+                uid: None,
+                gid: None,
+            })
+            .collect();
+        copy_tree(&entries).expect("failed to copy tree");
+
+        let mut copied = Vec::new();
+        walk(&dst, Path::new(""), &mut copied);
+        assert_eq!(copied, listing);
+        for (relpath, _) in &listing {
+            let src_meta = std::fs::symlink_metadata(src.join(relpath)).expect("failed to stat");
+            let dst_meta = std::fs::symlink_metadata(dst.join(relpath)).expect("failed to stat");
+            assert_eq!(src_meta.mode(), dst_meta.mode(), "{}", relpath.display());
+            // symlink times are not copied
+            if !src_meta.is_symlink() {
+                assert_eq!(
+                    src_meta.modified().expect("no mtime"),
+                    dst_meta.modified().expect("no mtime"),
+                    "{}",
+                    relpath.display()
+                );
+            }
+            if src_meta.is_file() {
+                assert_eq!(
+                    std::fs::read(src.join(relpath)).expect("failed to read"),
+                    std::fs::read(dst.join(relpath)).expect("failed to read"),
+                );
+            } else if src_meta.is_symlink() {
+                assert_eq!(
+                    std::fs::read_link(src.join(relpath)).expect("failed to readlink"),
+                    std::fs::read_link(dst.join(relpath)).expect("failed to readlink"),
+                );
+            }
+        }
+    }
+}
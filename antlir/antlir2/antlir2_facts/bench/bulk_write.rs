@@ -0,0 +1,154 @@
+/*
+ * Copyright (c) Meta Platforms, Inc. and affiliates.
+ *
+ * This source code is licensed under the MIT license found in the
+ * LICENSE file in the root directory of this source tree.
+ */
+
+//! Benchmark fact db updates over a synthetic directory tree, comparing the
+//! one-statement-per-fact [Transaction] API against [Bulk] writes.
+//!
+//! Each iteration simulates a child layer: the db starts out as a copy of the
+//! "parent" tree, then a fraction of the entries is replaced, added and
+//! removed.
+
+use std::path::Path;
+use std::path::PathBuf;
+use std::time::Duration;
+use std::time::Instant;
+
+use antlir2_facts::Fact;
+use antlir2_facts::RwDatabase;
+use antlir2_facts::fact::dir_entry::DirEntry;
+use antlir2_facts::fact::dir_entry::FileCommon;
+use anyhow::Context;
+use anyhow::Result;
+use clap::Parser;
+use clap::ValueEnum;
+use fxhash::FxHashSet;
+
+#[derive(Debug, Parser)]
+struct Args {
+    /// Number of DirEntry facts in the synthetic tree
+    #[clap(long, default_value_t = 1_000_000)]
+    entries: usize,
+    /// Number of files per directory in the synthetic tree
+    #[clap(long, default_value_t = 64)]
+    fanout: usize,
+    /// Percentage of the tree that is changed in the "child layer"
+    #[clap(long, default_value_t = 10)]
+    churn_percent: usize,
+    #[clap(long, value_enum)]
+    mode: Vec<Mode>,
+}
+
+#[derive(Debug, Clone, Copy, ValueEnum)]
+enum Mode {
+    /// Transaction::insert + all_keys/delete, one statement per fact
+    PerFact,
+    /// Transaction::bulk
+    Bulk,
+}
+
+/// Deterministic synthetic tree that looks vaguely like /usr
+fn synthetic_tree(entries: usize, fanout: usize, generation: usize) -> Vec<DirEntry> {
+    let mut tree = Vec::with_capacity(entries);
+    let mut dir = 0;
+    while tree.len() < entries {
+        let dir_path = PathBuf::from(format!("/usr/lib{generation}/d{}/d{dir}", dir % 97));
+        tree.push(DirEntry::Directory(
+            FileCommon::new(dir_path.clone(), 0, 0, 0o40755).into(),
+        ));
+        for file in 0..fanout.min(entries - tree.len()) {
+            tree.push(DirEntry::RegularFile(
+                FileCommon::new(
+                    dir_path.join(format!("f{file}-g{generation}")),
+                    0,
+                    0,
+                    0o100644,
+                )
+                .into(),
+            ));
+        }
+        dir += 1;
+    }
+    tree
+}
+
+fn seed_db(path: &Path, parent: &[DirEntry]) -> Result<RwDatabase> {
+    let mut db = RwDatabase::create(path).context("while creating db")?;
+    let mut tx = db.transaction()?;
+    let mut bulk = tx.bulk()?;
+    for ent in parent {
+        bulk.insert(ent)?;
+    }
+    bulk.finish()?;
+    tx.commit()?;
+    Ok(db)
+}
+
+fn run_per_fact(db: &mut RwDatabase, child: &[DirEntry]) -> Result<()> {
+    let mut tx = db.transaction()?;
+    let mut remove: FxHashSet<_> = tx.all_keys::<DirEntry>()?.collect();
+    for ent in child {
+        remove.remove(&ent.key());
+        tx.insert(ent)?;
+    }
+    for key in &remove {
+        tx.delete::<DirEntry>(key)?;
+    }
+    tx.commit()?;
+    Ok(())
+}
+
+fn run_bulk(db: &mut RwDatabase, child: &[DirEntry]) -> Result<()> {
+    let mut tx = db.transaction()?;
+    let mut bulk = tx.bulk()?;
+    for ent in child {
+        bulk.insert(ent)?;
+    }
+    bulk.delete_unseen::<DirEntry>()?;
+    bulk.finish()?;
+    tx.commit()?;
+    Ok(())
+}
+
+fn main() -> Result<()> {
+    let args = Args::parse();
+    let modes = if args.mode.is_empty() {
+        vec![Mode::PerFact, Mode::Bulk]
+    } else {
+        args.mode
+    };
+
+    let parent = synthetic_tree(args.entries, args.fanout, 0);
+    // the child layer keeps most of the parent, but a slice of files has been
+    // replaced by new ones (which looks like both deletes and inserts)
+    let churned = args.entries * args.churn_percent / 100;
+    let mut child = parent[..args.entries - churned].to_vec();
+    child.extend(synthetic_tree(churned, args.fanout, 1));
+
+    let tmp = tempfile::tempdir().context("while creating tempdir")?;
+    for mode in modes {
+        let db_path = tmp.path().join(format!("{mode:?}.db"));
+        let mut db = seed_db(&db_path, &parent)?;
+        let start = Instant::now();
+        match mode {
+            Mode::PerFact => run_per_fact(&mut db, &child)?,
+            Mode::Bulk => run_bulk(&mut db, &child)?,
+        }
+        let elapsed = start.elapsed();
+        let count = db.iter::<DirEntry>()?.count();
+        anyhow::ensure!(
+            count == child.len(),
+            "{mode:?} left {count} facts, expected {}",
+            child.len()
+        );
+        println!(
+            "{mode:?}: {} entries in {elapsed:?} ({:.0} entries/s)",
+            child.len(),
+            child.len() as f64 / elapsed.max(Duration::from_nanos(1)).as_secs_f64(),
+        );
+    }
+    Ok(())
+}
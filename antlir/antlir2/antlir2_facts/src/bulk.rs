@@ -0,0 +1,282 @@
+/*
+ * Copyright (c) Meta Platforms, Inc. and affiliates.
+ *
+ * This source code is licensed under the MIT license found in the
+ * LICENSE file in the root directory of this source tree.
+ */
+
+use fxhash::FxHashMap;
+use once_cell::sync::Lazy;
+use rusqlite::ToSql;
+
+use crate::Fact;
+use crate::Key;
+use crate::Result;
+use crate::Transaction;
+use crate::fact::FactKind;
+
+/// Number of rows written by a single multi-row statement. Each row binds 3
+/// parameters, so this stays well under SQLITE_MAX_VARIABLE_NUMBER even on
+/// older sqlite builds (999).
+const BATCH_ROWS: usize = 256;
+
+static INSERT_FACTS_BATCH: Lazy<String> = Lazy::new(|| insert_facts_sql(BATCH_ROWS));
+static INSERT_SEEN_BATCH: Lazy<String> = Lazy::new(|| insert_seen_sql(BATCH_ROWS));
+static INSERT_DIR_ENTRY_STATS_BATCH: Lazy<String> =
+    Lazy::new(|| insert_dir_entry_stats_sql(BATCH_ROWS));
+
+fn insert_facts_sql(rows: usize) -> String {
+    format!(
+        "INSERT OR REPLACE INTO facts (kind, key, value) VALUES {}",
+        vec!["(?, ?, ?)"; rows].join(", ")
+    )
+}
+
+fn insert_seen_sql(rows: usize) -> String {
+    format!(
+        "INSERT OR IGNORE INTO temp.bulk_seen (kind, key) VALUES {}",
+        vec!["(?, ?)"; rows].join(", ")
+    )
+}
+
+fn insert_dir_entry_stats_sql(rows: usize) -> String {
+    format!(
+        "INSERT OR REPLACE INTO dir_entry_stats (key, ino, ctime) VALUES {}",
+        vec!["(?, ?, ?)"; rows].join(", ")
+    )
+}
+
+/// Bulk writer for replacing large sets of facts in a single [Transaction].
+///
+/// Facts are buffered and written with batched multi-row upserts through
+/// cached prepared statements. Every key that is inserted (or explicitly
+/// [Bulk::keep]-ed) is recorded in a temporary table, so that after the new
+/// set of facts has been written, all the stale facts of a given kind can be
+/// removed with a single set-based delete ([Bulk::delete_unseen]) instead of
+/// collecting all the existing keys up-front and deleting them one by one.
+pub struct Bulk<'a, 'db> {
+    tx: &'a mut Transaction<'db>,
+    facts: Vec<(&'static str, Key, String)>,
+    seen: Vec<(&'static str, Key)>,
+    dir_entry_stats: Vec<(Key, i64, i64)>,
+}
+
+impl<'a, 'db> Bulk<'a, 'db> {
+    pub(crate) fn new(tx: &'a mut Transaction<'db>) -> Result<Self> {
+        tx.tx.execute_batch(
+            "CREATE TEMP TABLE IF NOT EXISTS bulk_seen (kind TEXT, key BLOB, PRIMARY KEY (kind, key)) WITHOUT ROWID;
+            DELETE FROM temp.bulk_seen;",
+        )?;
+        Ok(Self {
+            tx,
+            facts: Vec::with_capacity(BATCH_ROWS),
+            seen: Vec::with_capacity(BATCH_ROWS),
+            dir_entry_stats: Vec::new(),
+        })
+    }
+
+    /// Insert (or replace) a fact.
+    pub fn insert<F>(&mut self, fact: &F) -> Result<()>
+    where
+        F: Fact + FactKind,
+    {
+        let val = serde_json::to_string(fact as &dyn Fact)?;
+        let key = fact.key();
+        self.seen.push((F::KIND, key.clone()));
+        self.facts.push((F::KIND, key, val));
+        if self.facts.len() >= BATCH_ROWS {
+            self.flush_facts()?;
+        }
+        if self.seen.len() >= BATCH_ROWS {
+            self.flush_seen()?;
+        }
+        Ok(())
+    }
+
+    /// Mark an existing fact as still present without rewriting it, so that it
+    /// will not be removed by [Bulk::delete_unseen].
+    pub fn keep<F>(&mut self, key: Key) -> Result<()>
+    where
+        F: Fact + FactKind,
+    {
+        self.seen.push((F::KIND, key));
+        if self.seen.len() >= BATCH_ROWS {
+            self.flush_seen()?;
+        }
+        Ok(())
+    }
+
+    /// Delete every fact of type `F` that was not inserted or kept during this
+    /// bulk write. Returns the number of facts that were deleted.
+    pub fn delete_unseen<F>(&mut self) -> Result<usize>
+    where
+        F: Fact + FactKind,
+    {
+        self.delete_unseen_rows("facts", F::KIND)
+    }
+
+    /// Delete every row of a (kind, key)-indexed side table that corresponds
+    /// to a fact that was not inserted or kept during this bulk write.
+    pub(crate) fn delete_unseen_rows(&mut self, table: &str, kind: &str) -> Result<usize> {
+        self.flush()?;
+        let num_rows = self
+            .tx
+            .tx
+            .prepare_cached(&format!(
+                "DELETE FROM {table} WHERE {kind_filter} NOT EXISTS (
+                    SELECT 1 FROM temp.bulk_seen s WHERE s.kind=?1 AND s.key={table}.key
+                )",
+                kind_filter = if table == "facts" { "kind=?1 AND" } else { "" },
+            ))?
+            .execute((kind,))?;
+        Ok(num_rows)
+    }
+
+    /// The inode number and ctime that each [crate::fact::dir_entry::DirEntry]
+    /// fact was last generated from, as recorded by
+    /// [Bulk::record_dir_entry_stat].
+    pub(crate) fn dir_entry_stats(&self) -> Result<FxHashMap<Key, (i64, i64)>> {
+        let mut stmt = self
+            .tx
+            .tx
+            .prepare_cached("SELECT key, ino, ctime FROM dir_entry_stats")?;
+        let rows = stmt.query_map((), |row| Ok((Key(row.get(0)?), (row.get(1)?, row.get(2)?))))?;
+        Ok(rows.collect::<rusqlite::Result<_>>()?)
+    }
+
+    /// Record (or replace) the inode number and ctime that a
+    /// [crate::fact::dir_entry::DirEntry] fact was generated from.
+    pub(crate) fn record_dir_entry_stat(&mut self, key: Key, ino: i64, ctime: i64) -> Result<()> {
+        self.dir_entry_stats.push((key, ino, ctime));
+        if self.dir_entry_stats.len() >= BATCH_ROWS {
+            self.flush_dir_entry_stats()?;
+        }
+        Ok(())
+    }
+
+    /// Write out any buffered facts. Facts that are still buffered when a
+    /// [Bulk] is dropped without calling this are lost.
+    pub fn finish(mut self) -> Result<()> {
+        self.flush()?;
+        self.tx.tx.execute("DELETE FROM temp.bulk_seen", ())?;
+        Ok(())
+    }
+
+    fn flush(&mut self) -> Result<()> {
+        self.flush_facts()?;
+        self.flush_seen()?;
+        self.flush_dir_entry_stats()
+    }
+
+    fn flush_facts(&mut self) -> Result<()> {
+        for chunk in self.facts.chunks(BATCH_ROWS) {
+            let mut stmt = if chunk.len() == BATCH_ROWS {
+                self.tx.tx.prepare_cached(&INSERT_FACTS_BATCH)?
+            } else {
+                self.tx.tx.prepare_cached(&insert_facts_sql(chunk.len()))?
+            };
+            let params: Vec<&dyn ToSql> = chunk
+                .iter()
+                .flat_map(|(kind, key, val)| [kind as &dyn ToSql, &key.0, val])
+                .collect();
+            stmt.execute(params.as_slice())?;
+        }
+        self.facts.clear();
+        Ok(())
+    }
+
+    fn flush_seen(&mut self) -> Result<()> {
+        for chunk in self.seen.chunks(BATCH_ROWS) {
+            let mut stmt = if chunk.len() == BATCH_ROWS {
+                self.tx.tx.prepare_cached(&INSERT_SEEN_BATCH)?
+            } else {
+                self.tx.tx.prepare_cached(&insert_seen_sql(chunk.len()))?
+            };
+            let params: Vec<&dyn ToSql> = chunk
+                .iter()
+                .flat_map(|(kind, key)| [kind as &dyn ToSql, &key.0])
+                .collect();
+            stmt.execute(params.as_slice())?;
+        }
+        self.seen.clear();
+        Ok(())
+    }
+
+    fn flush_dir_entry_stats(&mut self) -> Result<()> {
+        for chunk in self.dir_entry_stats.chunks(BATCH_ROWS) {
+            let mut stmt = if chunk.len() == BATCH_ROWS {
+                self.tx.tx.prepare_cached(&INSERT_DIR_ENTRY_STATS_BATCH)?
+            } else {
+                self.tx
+                    .tx
+                    .prepare_cached(&insert_dir_entry_stats_sql(chunk.len()))?
+            };
+            let params: Vec<&dyn ToSql> = chunk
+                .iter()
+                .flat_map(|(key, ino, ctime)| [&key.0 as &dyn ToSql, ino, ctime])
+                .collect();
+            stmt.execute(params.as_slice())?;
+        }
+        self.dir_entry_stats.clear();
+        Ok(())
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use std::path::Path;
+
+    use super::*;
+    use crate::RwDatabase;
+    use crate::fact::dir_entry::DirEntry;
+    use crate::fact::dir_entry::FileCommon;
+    use crate::fact::user::User;
+
+    fn file(path: &str) -> DirEntry {
+        DirEntry::RegularFile(FileCommon::new(path.into(), 0, 0, 0o444).into())
+    }
+
+    #[test]
+    fn bulk_replace() {
+        let mut db = RwDatabase::new_test_db();
+        let mut tx = db.transaction().expect("failed to start tx");
+        tx.insert(&file("/stale")).expect("failed to insert /stale");
+        tx.insert(&file("/kept")).expect("failed to insert /kept");
+        tx.insert(&User::new("alice", 1))
+            .expect("failed to insert alice");
+
+        let mut bulk = tx.bulk().expect("failed to start bulk write");
+        // enough to exercise both full and partial batches
+        for i in 0..(BATCH_ROWS * 2 + 7) {
+            bulk.insert(&file(&format!("/file{i}")))
+                .expect("failed to insert");
+        }
+        bulk.keep::<DirEntry>(DirEntry::key(Path::new("/kept")))
+            .expect("failed to keep /kept");
+        assert_eq!(
+            bulk.delete_unseen::<DirEntry>()
+                .expect("failed to delete unseen"),
+            1
+        );
+        bulk.finish().expect("failed to finish bulk write");
+        tx.commit().expect("failed to commit");
+
+        assert_eq!(
+            db.iter::<DirEntry>()
+                .expect("failed to prepare iterator")
+                .count(),
+            BATCH_ROWS * 2 + 7 + 1
+        );
+        assert!(
+            db.get::<DirEntry>(DirEntry::key(Path::new("/stale")))
+                .expect("failed to get /stale")
+                .is_none()
+        );
+        assert!(
+            db.get::<User>(User::key("alice"))
+                .expect("failed to get alice")
+                .is_some(),
+            "facts of other kinds must not be touched"
+        );
+    }
+}
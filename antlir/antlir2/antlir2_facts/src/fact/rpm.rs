@@ -10,11 +10,16 @@ use std::collections::BTreeSet;
 use bon::Builder;
 use once_cell::sync::Lazy;
 use regex::Regex;
+use rusqlite::OptionalExtension;
 use serde::Deserialize;
 use serde::Serialize;
 
 use super::Fact;
+use super::FactKind;
 use super::Key;
+use crate::Database;
+use crate::Result;
+use crate::Transaction;
 use crate::fact_impl;
 
 #[derive(Debug, Clone, PartialEq, Eq, Deserialize, Serialize, Builder)]
@@ -27,13 +32,25 @@ pub struct Rpm {
     version: String,
     release: String,
     arch: String,
+    /// Changelogs are by far the largest part of an rpm's metadata and are
+    /// identical for every subpackage of a source rpm, so they are stored
+    /// out-of-line in the facts db, keyed by this content hash.
     #[serde(default, skip_serializing_if = "Option::is_none")]
+    changelog_hash: Option<String>,
+    /// Never stored inline in the facts db. Readers that care about the
+    /// changelog must explicitly load it with
+    /// [Database::load_rpm_changelog](crate::Database::load_rpm_changelog).
+    #[serde(default, skip_serializing)]
     changelog: Option<String>,
     #[serde(default, skip_serializing_if = "Option::is_none")]
     os: Option<String>,
     #[serde(default)]
     size: Option<u64>,
     source_rpm: Option<String>,
+    /// SHA1 digest of the rpmdb header, used to cheaply detect that an
+    /// installed package is unchanged from the parent layer.
+    #[serde(default, skip_serializing_if = "Option::is_none")]
+    sha1header: Option<String>,
 }
 
 fn skip_epoch(epoch: &u64) -> bool {
@@ -78,6 +95,14 @@ impl Rpm {
         self.to_string()
     }
 
+    pub fn changelog_hash(&self) -> Option<&str> {
+        self.changelog_hash.as_deref()
+    }
+
+    /// The changelog text, if it has been loaded. Facts read back from the db
+    /// will always return `None` here until
+    /// [Database::load_rpm_changelog](crate::Database::load_rpm_changelog) is
+    /// called.
     pub fn changelog(&self) -> Option<&str> {
         self.changelog.as_deref()
     }
@@ -103,6 +128,10 @@ impl Rpm {
         self.source_rpm.as_deref()
     }
 
+    pub fn sha1header(&self) -> Option<&str> {
+        self.sha1header.as_deref()
+    }
+
     pub fn evra(&self) -> String {
         match self.epoch {
             0 => format!("{}-{}.{}", self.version, self.release, self.arch),
@@ -128,6 +157,44 @@ impl std::fmt::Display for Rpm {
     }
 }
 
+impl<const RW: bool> Database<{ RW }> {
+    /// Load the out-of-line changelog for this rpm from the db (if it has
+    /// one).
+    pub fn load_rpm_changelog(&self, rpm: &mut Rpm) -> Result<()> {
+        if let Some(hash) = &rpm.changelog_hash {
+            let mut stmt = self
+                .db
+                .prepare_cached("SELECT changelog FROM rpm_changelogs WHERE hash=?")?;
+            rpm.changelog = stmt.query_row((hash,), |row| row.get(0)).optional()?;
+        }
+        Ok(())
+    }
+}
+
+impl Transaction<'_> {
+    /// Record a changelog that is referenced by [Rpm::changelog_hash]. This is
+    /// a no-op if the same content was already stored.
+    pub fn insert_rpm_changelog(&mut self, hash: &str, changelog: &str) -> Result<()> {
+        self.tx.execute(
+            "INSERT OR IGNORE INTO rpm_changelogs (hash, changelog) VALUES (?1, ?2)",
+            (hash, changelog),
+        )?;
+        Ok(())
+    }
+
+    /// Remove any changelogs that are no longer referenced by an [Rpm] fact.
+    pub fn delete_unreferenced_rpm_changelogs(&mut self) -> Result<usize> {
+        let num_rows = self.tx.execute(
+            "DELETE FROM rpm_changelogs WHERE hash NOT IN (
+                SELECT json_extract(value, '$.value.changelog_hash') FROM facts
+                WHERE kind=?1 AND json_extract(value, '$.value.changelog_hash') IS NOT NULL
+            )",
+            (Rpm::KIND,),
+        )?;
+        Ok(num_rows)
+    }
+}
+
 #[cfg(test)]
 mod tests {
     use super::*;
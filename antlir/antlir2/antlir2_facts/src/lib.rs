@@ -22,8 +22,10 @@ use rusqlite::Row;
 use rusqlite::Rows;
 use serde::de::DeserializeOwned;
 
+mod bulk;
 pub mod fact;
 pub use antlir2_facts_macro::fact_impl;
+pub use bulk::Bulk;
 pub use fact::Fact;
 pub mod update_db;
 
@@ -85,8 +87,24 @@ impl RwDatabase {
     }
 
     fn setup_new_db(db: &Connection) -> Result<()> {
+        // WITHOUT ROWID makes the (kind, key) primary key the clustered index
+        // of the table itself, so lookups by kind and key prefix (which is
+        // what [Database::iter_prefix] does) are a single range scan instead
+        // of an index scan followed by a rowid lookup for every result.
         db.execute(
-            "CREATE TABLE IF NOT EXISTS facts (kind TEXT, key BLOB, value TEXT, PRIMARY KEY (kind, key))",
+            "CREATE TABLE IF NOT EXISTS facts (kind TEXT, key BLOB, value TEXT, PRIMARY KEY (kind, key)) WITHOUT ROWID",
+            (),
+        )?;
+        // Inode number and ctime that each DirEntry fact was generated from,
+        // used to skip unchanged entries when updating a child layer's db
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS dir_entry_stats (key BLOB PRIMARY KEY, ino INTEGER, ctime INTEGER) WITHOUT ROWID",
+            (),
+        )?;
+        // Content-addressed storage for rpm changelogs, see
+        // [fact::rpm::Rpm::changelog_hash]
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS rpm_changelogs (hash TEXT PRIMARY KEY, changelog TEXT)",
             (),
         )?;
         Ok(())
@@ -164,7 +182,7 @@ impl<const RW: bool> Database<{ RW }> {
         let key: Key = key.into();
         let mut stmt = self
             .db
-            .prepare("SELECT value FROM facts WHERE kind=? AND key=?")?;
+            .prepare_cached("SELECT value FROM facts WHERE kind=? AND key=?")?;
         stmt.query_row((F::KIND, key.as_ref()), row_to_fact)
             .optional()
             .map_err(Error::from)
@@ -181,7 +199,7 @@ impl<const RW: bool> Database<{ RW }> {
         // ability to collect a narrower set of Facts.
         let mut stmt = self
             .db
-            .prepare("SELECT value FROM facts WHERE kind=? ORDER BY key ASC")?;
+            .prepare_cached("SELECT value FROM facts WHERE kind=? ORDER BY key ASC")?;
         let rows = stmt.query((F::KIND,))?;
         let facts = rows_to_facts::<F>(rows)?;
         Ok(FactIter {
@@ -205,7 +223,7 @@ impl<const RW: bool> Database<{ RW }> {
         let mut end = key.as_ref().to_vec();
         end.push(0xff);
 
-        let mut stmt = self.db.prepare(
+        let mut stmt = self.db.prepare_cached(
             "SELECT value FROM facts WHERE kind=? AND key>=? AND key<? ORDER BY key ASC",
         )?;
         let rows = stmt.query((F::KIND, key.as_ref(), end.as_slice()))?;
@@ -221,7 +239,9 @@ impl<const RW: bool> Database<{ RW }> {
     {
         // The lifetimes of querying are nasty, so just eagerly load all the
         // keys.
-        let mut stmt = self.db.prepare("SELECT key FROM facts WHERE kind=?")?;
+        let mut stmt = self
+            .db
+            .prepare_cached("SELECT key FROM facts WHERE kind=?")?;
         let keys: Vec<Key> = stmt
             .query_map((F::KIND,), |row| row.get(0).map(Key))?
             .map(|res| res.map_err(Error::from))
@@ -255,19 +275,19 @@ impl<'db> Transaction<'db> {
         F: Fact,
     {
         let val = serde_json::to_string(fact as &dyn Fact)?;
-        self.tx.execute(
-            "INSERT OR REPLACE INTO facts (kind, key, value) VALUES (json_extract(?2, '$.type'), ?1, ?2)",
-            (fact.key().as_ref(), val),
-        )?;
+        self.tx
+            .prepare_cached(
+                "INSERT OR REPLACE INTO facts (kind, key, value) VALUES (json_extract(?2, '$.type'), ?1, ?2)",
+            )?
+            .execute((fact.key().as_ref(), val))?;
         Ok(())
     }
 
     pub fn insert_generic<'f>(&mut self, fact: &'f Generic) -> Result<()> {
         let val = serde_json::to_string(fact)?;
-        self.tx.execute(
-            "INSERT OR REPLACE INTO facts (kind, key, value) VALUES (?1, ?2, ?3)",
-            (fact.ty(), fact.key().as_ref(), val),
-        )?;
+        self.tx
+            .prepare_cached("INSERT OR REPLACE INTO facts (kind, key, value) VALUES (?1, ?2, ?3)")?
+            .execute((fact.ty(), fact.key().as_ref(), val))?;
         Ok(())
     }
 
@@ -275,20 +295,45 @@ impl<'db> Transaction<'db> {
     where
         F: Fact + FactKind,
     {
-        let num_rows = self.tx.execute(
-            "DELETE FROM facts WHERE kind=? AND key=?",
-            (F::KIND, key.as_ref()),
-        )?;
+        let num_rows = self
+            .tx
+            .prepare_cached("DELETE FROM facts WHERE kind=? AND key=?")?
+            .execute((F::KIND, key.as_ref()))?;
         Ok(num_rows > 0)
     }
 
+    /// Start a [Bulk] write, which is much more efficient than
+    /// [Transaction::insert] and [Transaction::delete] when (re)writing a large
+    /// number of facts at once.
+    pub fn bulk(&mut self) -> Result<Bulk<'_, 'db>> {
+        Bulk::new(self)
+    }
+
+    /// Iterate over all facts of a given type, including any that were
+    /// written earlier in this transaction.
+    pub fn iter<F>(&self) -> Result<FactIter<F>>
+    where
+        F: Fact + FactKind + DeserializeOwned,
+    {
+        let mut stmt = self
+            .tx
+            .prepare_cached("SELECT value FROM facts WHERE kind=? ORDER BY key ASC")?;
+        let rows = stmt.query((F::KIND,))?;
+        let facts = rows_to_facts::<F>(rows)?;
+        Ok(FactIter {
+            iter: facts.into_iter(),
+        })
+    }
+
     pub fn all_keys<F>(&self) -> Result<KeyIter>
     where
         F: Fact + FactKind,
     {
         // The lifetimes of querying are nasty, so just eagerly load all the
         // keys.
-        let mut stmt = self.tx.prepare("SELECT key FROM facts WHERE kind=?")?;
+        let mut stmt = self
+            .tx
+            .prepare_cached("SELECT key FROM facts WHERE kind=?")?;
         let keys: Vec<Key> = stmt
             .query_map((F::KIND,), |row| row.get(0).map(Key))?
             .map(|res| res.map_err(Error::from))
@@ -421,10 +466,11 @@ mod tests {
     use super::*;
     use crate::fact::dir_entry::DirEntry;
     use crate::fact::dir_entry::FileCommon;
+    use crate::fact::rpm::Rpm;
     use crate::fact::user::User;
 
     impl RwDatabase {
-        fn new_test_db() -> Self {
+        pub(crate) fn new_test_db() -> Self {
             let db = Connection::open_in_memory().expect("failed to create in-mem db");
             Self::setup_new_db(&db).expect("failed to setup db");
             Self { db }
@@ -501,4 +547,44 @@ mod tests {
         assert_eq!(entries[1].path(), Path::new("/foo/baz"));
         assert_eq!(entries[2].path(), Path::new("/foo/baz/qux"));
     }
+
+    #[test]
+    #[traced_test]
+    fn test_rpm_changelog() {
+        let mut db = Database::new_test_db();
+
+        let mut tx = db.transaction().expect("failed to start tx");
+        tx.insert_rpm_changelog("abc", "- CVE-2024-1234")
+            .expect("failed to insert changelog");
+        tx.insert(
+            &Rpm::builder()
+                .name("foo")
+                .version("1.2.3")
+                .release("4")
+                .arch("x86_64")
+                .changelog_hash("abc")
+                .source_rpm("foo.src.rpm")
+                .build(),
+        )
+        .expect("failed to insert foo");
+        tx.insert_rpm_changelog("orphan", "- nobody references this")
+            .expect("failed to insert changelog");
+        assert_eq!(
+            tx.delete_unreferenced_rpm_changelogs()
+                .expect("failed to gc changelogs"),
+            1
+        );
+        tx.commit().expect("failed to commit");
+
+        let mut rpm = db
+            .iter::<Rpm>()
+            .expect("failed to prepare iterator")
+            .next()
+            .expect("foo not found");
+        assert_eq!(rpm.changelog(), None);
+        db.load_rpm_changelog(&mut rpm)
+            .expect("failed to load changelog");
+        assert_eq!(rpm.changelog(), Some("- CVE-2024-1234"));
+        assert_eq!(rpm.patched_cves().len(), 1);
+    }
 }
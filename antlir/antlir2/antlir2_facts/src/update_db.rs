@@ -5,19 +5,22 @@
  * LICENSE file in the root directory of this source tree.
  */
 
+use std::io::BufRead as _;
+use std::io::BufReader;
 use std::io::ErrorKind;
+use std::io::Read as _;
 use std::io::Seek;
 use std::io::Write as _;
-use std::os::unix::fs::MetadataExt;
+use std::os::fd::AsRawFd;
 use std::path::Path;
 use std::path::PathBuf;
+use std::process::Stdio;
 
+use antlir2_facts::Key;
 use antlir2_facts::RwDatabase;
 use antlir2_facts::Transaction;
 use antlir2_facts::fact::Fact;
 use antlir2_facts::fact::dir_entry::DirEntry;
-use antlir2_facts::fact::dir_entry::FileCommon;
-use antlir2_facts::fact::dir_entry::Symlink;
 use antlir2_facts::fact::rpm::Rpm;
 use antlir2_facts::fact::user::Group;
 use antlir2_facts::fact::user::User;
@@ -28,18 +31,20 @@ use antlir2_systemd::UnitFile;
 use antlir2_users::group::EtcGroup;
 use antlir2_users::passwd::EtcPasswd;
 use anyhow::Context;
-use anyhow::bail;
 use anyhow::ensure;
 use bon::builder;
 use clap::Parser;
+use fxhash::FxHashMap;
 use fxhash::FxHashSet;
+use serde::Deserialize;
 use tracing::warn;
-use walkdir::WalkDir;
 
 use crate::Error;
 use crate::Result;
 use crate::fact::subvolume::Subvolume;
 
+mod dir_entries;
+
 #[derive(Parser)]
 struct Args {
     #[clap(long)]
@@ -58,64 +63,52 @@ fn populate(
     tx: &mut Transaction,
     root: &Path,
     build_appliance: Option<&Path>,
+    threads: usize,
 ) -> anyhow::Result<()> {
     let root = root.canonicalize().context("while canonicalizing root")?;
-    populate_files(tx, &root)?;
+    populate_files(tx, &root, threads)?;
     populate_usergroups(tx, &root)?;
     populate_rpms(tx, &root, build_appliance)?;
     populate_systemd_units(tx, &root)?;
     Ok(())
 }
 
-fn populate_files(tx: &mut Transaction, root: &Path) -> anyhow::Result<()> {
-    let mut remove: FxHashSet<_> = tx
-        .all_keys::<DirEntry>()?
-        .chain(tx.all_keys::<Subvolume>()?)
-        .collect();
-    for entry in WalkDir::new(root) {
-        let entry = entry?;
-        let full_path = entry.path();
-        let relpath = full_path
-            .strip_prefix(root)
-            .context("all paths must start with root dir")?;
-        let path = Path::new("/").join(relpath);
-        let meta = entry
-            .metadata()
-            .with_context(|| format!("while statting {}", full_path.display()))?;
-        let common = FileCommon::new_with_metadata(path.clone(), &meta);
-        let fact = if entry.file_type().is_dir() {
-            DirEntry::Directory(common.into())
-        } else if entry.file_type().is_symlink() {
-            let raw_target = std::fs::read_link(&full_path)
-                .with_context(|| format!("while reading raw link {}", full_path.display()))?;
-            DirEntry::Symlink(Symlink::new(common, raw_target))
-        } else if entry.file_type().is_file() {
-            DirEntry::RegularFile(common.into())
-        } else {
-            bail!(
-                "{} was not a directory, symlink or file",
-                full_path.display()
-            );
-        };
-        remove.remove(&fact.key());
-        tx.insert(&fact)?;
-        // if this is a subvolume, log it so that antlir is aware that it's not just a directory
-        if meta.ino() == antlir2_btrfs::INO_SUBVOL
-            && antlir2_btrfs::Subvolume::open(full_path).is_ok()
-        {
-            tx.insert(&Subvolume::new(path))?;
+fn populate_files(tx: &mut Transaction, root: &Path, threads: usize) -> anyhow::Result<()> {
+    let mut bulk = tx.bulk()?;
+    let stats = dir_entries::load_stats(&bulk)?;
+    // Bound the number of in-flight entries so that the walker can't get
+    // arbitrarily far ahead of the (single-threaded) db writes
+    let (sender, receiver) = std::sync::mpsc::sync_channel(64 * 1024);
+    std::thread::scope(|scope| -> anyhow::Result<()> {
+        scope.spawn(move || dir_entries::walk(root, threads, sender));
+        for entry in receiver {
+            let entry = entry?;
+            let path = entry.fact.path().to_owned();
+            let key = DirEntry::key(&path);
+            if dir_entries::is_unchanged(&stats, &key, &entry) {
+                bulk.keep::<DirEntry>(key)?;
+            } else {
+                dir_entries::record_stat(&mut bulk, key, &entry)?;
+                bulk.insert(&entry.fact)?;
+            }
+            // if this is a subvolume, log it so that antlir is aware that it's not just a directory
+            if entry.ino == antlir2_btrfs::INO_SUBVOL
+                && matches!(entry.fact, DirEntry::Directory(_))
+                && antlir2_btrfs::Subvolume::open(&root.join_abs(&path)).is_ok()
+            {
+                bulk.insert(&Subvolume::new(path))?;
+            }
         }
-    }
-    for remove in &remove {
-        tx.delete::<DirEntry>(remove)?;
-        tx.delete::<Subvolume>(remove)?;
-    }
+        Ok(())
+    })?;
+    bulk.delete_unseen::<DirEntry>()?;
+    dir_entries::delete_unseen_stats(&mut bulk)?;
+    bulk.delete_unseen::<Subvolume>()?;
+    bulk.finish()?;
     Ok(())
 }
 
 fn populate_usergroups(tx: &mut Transaction, root: &Path) -> anyhow::Result<()> {
-    let mut remove_users: FxHashSet<_> = tx.all_keys::<User>()?.collect();
-    let mut remove_groups: FxHashSet<_> = tx.all_keys::<Group>()?.collect();
     let user_db: EtcPasswd = match std::fs::read_to_string(root.join("etc/passwd")) {
         Ok(contents) => contents.parse().context("while parsing /etc/passwd"),
         Err(e) => match e.kind() {
@@ -123,12 +116,6 @@ fn populate_usergroups(tx: &mut Transaction, root: &Path) -> anyhow::Result<()>
             _ => Err(anyhow::Error::from(e).context("while reading /etc/passwd")),
         },
     }?;
-    for user in user_db.into_records() {
-        let fact = User::new(user.name.clone(), user.uid.into());
-        remove_users.remove(&fact.key());
-        tx.insert(&fact)
-            .with_context(|| format!("while inserting user '{}'", user.name))?;
-    }
     let group_db: EtcGroup = match std::fs::read_to_string(root.join("etc/group")) {
         Ok(contents) => contents.parse().context("while parsing /etc/group"),
         Err(e) => match e.kind() {
@@ -136,18 +123,20 @@ fn populate_usergroups(tx: &mut Transaction, root: &Path) -> anyhow::Result<()>
             _ => Err(anyhow::Error::from(e).context("while reading /etc/group")),
         },
     }?;
+    let mut bulk = tx.bulk()?;
+    for user in user_db.into_records() {
+        let fact = User::new(user.name.clone(), user.uid.into());
+        bulk.insert(&fact)
+            .with_context(|| format!("while inserting user '{}'", user.name))?;
+    }
     for group in group_db.into_records() {
         let fact = Group::new(group.name.clone(), group.gid.into(), group.users);
-        remove_groups.remove(&fact.key());
-        tx.insert(&fact)
+        bulk.insert(&fact)
             .with_context(|| format!("while inserting group '{}'", group.name))?;
     }
-    for remove in &remove_users {
-        tx.delete::<User>(remove)?;
-    }
-    for remove in &remove_groups {
-        tx.delete::<Group>(remove)?;
-    }
+    bulk.delete_unseen::<User>()?;
+    bulk.delete_unseen::<Group>()?;
+    bulk.finish()?;
     Ok(())
 }
 
@@ -201,51 +190,126 @@ fn populate_rpms(
             cmd
         }
     };
+    // Tell the fact-finder about every header that is already recorded (most
+    // likely inherited from the parent layer) so that it only has to fully
+    // decode new or changed packages.
+    let mut known_headers: FxHashMap<String, Key> = FxHashMap::default();
+    let mut known_headers_mfd = memfd::MemfdOptions::default()
+        .close_on_exec(false)
+        .create("rpm_known_headers")?
+        .into_file();
+    for rpm in tx.iter::<Rpm>()? {
+        if let Some(sha1header) = rpm.sha1header() {
+            serde_json::to_writer(
+                &mut known_headers_mfd,
+                &(rpm.name(), sha1header, rpm.changelog_hash()),
+            )?;
+            known_headers_mfd.write_all(b"\n")?;
+            known_headers.insert(sha1header.to_owned(), rpm.key());
+        }
+    }
+    known_headers_mfd.rewind()?;
+    list_cmd
+        .arg("--known-headers-fd")
+        .arg(known_headers_mfd.as_raw_fd().to_string());
+
     let mut finder_script_mfd = memfd::MemfdOptions::default()
         .close_on_exec(false)
         .create("rpm_facts.py")?
         .into_file();
     finder_script_mfd.write_all(RPM_FACTS_SCRIPT.as_bytes())?;
     finder_script_mfd.rewind()?;
-    list_cmd.stdin(finder_script_mfd);
-    let out = list_cmd.output().context("while running fact-finder")?;
-    ensure!(
-        out.status.success(),
-        "rpm fact-finder failed: {}",
-        String::from_utf8_lossy(&out.stderr)
-    );
+    list_cmd
+        .stdin(finder_script_mfd)
+        .stdout(Stdio::piped())
+        .stderr(Stdio::piped());
+    let mut child = list_cmd.spawn().context("while spawning fact-finder")?;
+    // the child has its own copy of this fd now
+    drop(known_headers_mfd);
 
-    let facts: Vec<Rpm> = serde_json::from_slice(&out.stdout).with_context(|| {
-        format!(
-            "while parsing rpm facts: {}\n{}",
-            String::from_utf8_lossy(&out.stdout),
-            String::from_utf8_lossy(&out.stderr),
-        )
-    })?;
+    // Drain stderr on another thread so that a chatty fact-finder can never
+    // block on a full pipe while we're reading facts from stdout.
+    let mut stderr = child.stderr.take().expect("stderr is piped");
+    let stderr = std::thread::spawn(move || {
+        let mut buf = Vec::new();
+        let _ = stderr.read_to_end(&mut buf);
+        buf
+    });
+
+    let stdout = BufReader::new(child.stdout.take().expect("stdout is piped"));
+    // Errors are collected instead of returned right away, so that the
+    // fact-finder is always waited on and its stderr (which most likely
+    // explains the error) is included. Stdout is closed at the end of this,
+    // so that the fact-finder can't block writing to it after an error.
+    let parse_result = (|| {
+        for line in stdout.lines() {
+            let line = line.context("while reading rpm facts")?;
+            match serde_json::from_str::<RpmFactLine>(&line)
+                .with_context(|| format!("while parsing rpm fact line: {line}"))?
+            {
+                RpmFactLine::Unchanged { unchanged } => {
+                    if let Some(key) = known_headers.get(&unchanged) {
+                        remove.remove(key);
+                    }
+                }
+                RpmFactLine::Changelog {
+                    changelog_hash,
+                    changelog,
+                } => {
+                    tx.insert_rpm_changelog(&changelog_hash, &changelog)
+                        .context("while inserting rpm changelog")?;
+                }
+                RpmFactLine::Changed(rpm) => {
+                    remove.remove(&rpm.key());
+                    tx.insert(&rpm)
+                        .with_context(|| format!("while inserting rpm '{rpm}'"))?;
+                }
+            }
+        }
+        anyhow::Ok(())
+    })();
+    let status = child.wait().context("while waiting for fact-finder");
+    let stderr = stderr.join().expect("stderr thread panicked");
+    let stderr = String::from_utf8_lossy(&stderr);
+    // if the facts could not be read, the fact-finder probably failed because
+    // its stdout was closed, so that is not the interesting error
+    parse_result.with_context(|| format!("while reading rpm facts: {stderr}"))?;
+    ensure!(status?.success(), "rpm fact-finder failed: {stderr}");
 
-    for rpm in facts {
-        remove.remove(&rpm.key());
-        tx.insert(&rpm)
-            .with_context(|| format!("while inserting rpm '{rpm}'"))?;
-    }
     for remove in &remove {
         tx.delete::<Rpm>(remove)?;
     }
+    tx.delete_unreferenced_rpm_changelogs()?;
     Ok(())
 }
 
+/// A single line of output from the rpm fact-finder, which is either a full
+/// [Rpm] fact, an acknowledgement that a known header (identified by its
+/// SHA1HEADER) is still installed, or the content of a changelog that is
+/// referenced by [Rpm::changelog_hash].
+#[derive(Deserialize)]
+#[serde(untagged)]
+enum RpmFactLine {
+    Unchanged {
+        unchanged: String,
+    },
+    Changelog {
+        changelog_hash: String,
+        changelog: String,
+    },
+    Changed(Rpm),
+}
+
 fn populate_systemd_units(tx: &mut Transaction, root: &Path) -> anyhow::Result<()> {
-    let mut remove: FxHashSet<_> = tx.all_keys::<UnitFile>()?.collect();
+    let mut bulk = tx.bulk()?;
     for unit in
         antlir2_systemd::list_unit_files(root).context("while listing systemd unit files")?
     {
-        remove.remove(&unit.key());
-        tx.insert(&unit)
+        bulk.insert(&unit)
             .with_context(|| format!("while inserting unit {unit:?}"))?;
     }
-    for remove in &remove {
-        tx.delete::<UnitFile>(remove)?;
-    }
+    bulk.delete_unseen::<UnitFile>()?;
+    bulk.finish()?;
 
     Ok(())
 }
@@ -267,6 +331,9 @@ pub fn sync_db_with_layer(
     db: &Path,
     layer: &Path,
     build_appliance: Option<&Path>,
+    /// Number of threads used to walk the layer, defaults to the number of
+    /// available cpus
+    threads: Option<usize>,
 ) -> Result<RwDatabase> {
     let mut db = RwDatabase::create(db)
         .with_context(|| format!("while preparing db {}", db.display()))
@@ -279,7 +346,12 @@ pub fn sync_db_with_layer(
 
     let root = Root::Subvol(layer);
 
-    populate(&mut tx, root.path(), build_appliance).map_err(Error::Populate)?;
+    let threads = threads.unwrap_or_else(|| {
+        std::thread::available_parallelism()
+            .map(|n| n.get())
+            .unwrap_or(1)
+    });
+    populate(&mut tx, root.path(), build_appliance, threads).map_err(Error::Populate)?;
 
     tx.commit()
         .context("while committing tx")
@@ -0,0 +1,224 @@
+/*
+ * Copyright (c) Meta Platforms, Inc. and affiliates.
+ *
+ * This source code is licensed under the MIT license found in the
+ * LICENSE file in the root directory of this source tree.
+ */
+
+//! Parallel directory walker used to populate [DirEntry] facts.
+//!
+//! Every directory is read by one task on a thread pool, and its children are
+//! `statx`-ed relative to the already-open directory fd (asking the kernel
+//! only for the fields that we actually record) so that no full path
+//! resolution is required for each entry. Subdirectories are fanned out as
+//! new tasks, so large trees are split by subtree across all the threads.
+
+use std::ffi::OsStr;
+use std::os::fd::AsFd;
+use std::os::fd::OwnedFd;
+use std::os::unix::ffi::OsStrExt;
+use std::path::Path;
+use std::path::PathBuf;
+use std::sync::Arc;
+use std::sync::mpsc::SyncSender;
+
+use anyhow::Context;
+use fxhash::FxHashMap;
+use rustix::fs::AtFlags;
+use rustix::fs::CWD;
+use rustix::fs::Dir;
+use rustix::fs::FileType;
+use rustix::fs::Mode;
+use rustix::fs::OFlags;
+use rustix::fs::Statx;
+use rustix::fs::StatxFlags;
+
+use crate::Key;
+use crate::bulk::Bulk;
+use crate::fact::FactKind;
+use crate::fact::dir_entry::DirEntry;
+use crate::fact::dir_entry::FileCommon;
+use crate::fact::dir_entry::Symlink;
+
+const STATX_MASK: StatxFlags = StatxFlags::TYPE
+    .union(StatxFlags::MODE)
+    .union(StatxFlags::UID)
+    .union(StatxFlags::GID)
+    .union(StatxFlags::INO)
+    .union(StatxFlags::CTIME);
+
+/// A single entry discovered by the walker.
+pub(super) struct Entry {
+    pub(super) fact: DirEntry,
+    pub(super) ino: u64,
+    /// ctime in nanoseconds. ctime is updated by the kernel on every change to
+    /// an inode (contents, ownership, mode, link target) and cannot be set
+    /// from userspace, so together with the inode number it identifies an
+    /// unchanged file.
+    pub(super) ctime: i64,
+}
+
+impl Entry {
+    fn new(path: PathBuf, stx: &Statx, dirfd: impl AsFd, name: &OsStr) -> anyhow::Result<Self> {
+        let common = FileCommon::new(path, stx.stx_uid, stx.stx_gid, stx.stx_mode.into());
+        let fact = match FileType::from_raw_mode(stx.stx_mode.into()) {
+            FileType::Directory => DirEntry::Directory(common.into()),
+            FileType::RegularFile => DirEntry::RegularFile(common.into()),
+            FileType::Symlink => {
+                let raw_target =
+                    rustix::fs::readlinkat(dirfd, name, Vec::new()).with_context(|| {
+                        format!("while reading raw link {}", common.path().display())
+                    })?;
+                DirEntry::Symlink(Symlink::new(
+                    common,
+                    PathBuf::from(OsStr::from_bytes(raw_target.as_bytes())),
+                ))
+            }
+            _ => anyhow::bail!(
+                "{} was not a directory, symlink or file",
+                common.path().display()
+            ),
+        };
+        Ok(Self {
+            fact,
+            ino: stx.stx_ino,
+            ctime: stx.stx_ctime.tv_sec * 1_000_000_000 + i64::from(stx.stx_ctime.tv_nsec),
+        })
+    }
+}
+
+/// Walk the entire tree under `root` on a pool of `threads` threads, sending
+/// every entry (including `root` itself as `/`) to `sender`. Entries are sent
+/// in no particular order.
+pub(super) fn walk(root: &Path, threads: usize, sender: SyncSender<anyhow::Result<Entry>>) {
+    let pool = match rayon::ThreadPoolBuilder::new()
+        .num_threads(threads)
+        .thread_name(|i| format!("facts-walk-{i}"))
+        .build()
+    {
+        Ok(pool) => pool,
+        Err(e) => {
+            let _ = sender.send(Err(
+                anyhow::Error::from(e).context("while building thread pool")
+            ));
+            return;
+        }
+    };
+    let root_entry = rustix::fs::statx(CWD, root, AtFlags::SYMLINK_NOFOLLOW, STATX_MASK)
+        .with_context(|| format!("while statting {}", root.display()))
+        .and_then(|stx| Entry::new(PathBuf::from("/"), &stx, CWD, root.as_os_str()));
+    let root_entry = match root_entry {
+        Ok(e) => e,
+        Err(e) => {
+            let _ = sender.send(Err(e));
+            return;
+        }
+    };
+    if sender.send(Ok(root_entry)).is_err() {
+        return;
+    }
+    let root_fd = match rustix::fs::open(
+        root,
+        OFlags::RDONLY | OFlags::DIRECTORY | OFlags::CLOEXEC,
+        Mode::empty(),
+    ) {
+        Ok(fd) => fd,
+        Err(e) => {
+            let _ = sender.send(Err(
+                anyhow::Error::from(e).context(format!("while opening {}", root.display()))
+            ));
+            return;
+        }
+    };
+    pool.scope(|scope| walk_dir(scope, Arc::new(root_fd), PathBuf::from("/"), sender));
+}
+
+fn walk_dir<'s>(
+    scope: &rayon::Scope<'s>,
+    dirfd: Arc<OwnedFd>,
+    path: PathBuf,
+    sender: SyncSender<anyhow::Result<Entry>>,
+) {
+    if let Err(e) = read_dir(scope, &dirfd, &path, &sender) {
+        let _ = sender.send(Err(e.context(format!("while walking {}", path.display()))));
+    }
+}
+
+fn read_dir<'s>(
+    scope: &rayon::Scope<'s>,
+    dirfd: &Arc<OwnedFd>,
+    path: &Path,
+    sender: &SyncSender<anyhow::Result<Entry>>,
+) -> anyhow::Result<()> {
+    let dir = Dir::read_from(dirfd).context("while reading directory")?;
+    for dent in dir {
+        let dent = dent.context("while reading directory entry")?;
+        let name = OsStr::from_bytes(dent.file_name().to_bytes());
+        if name == "." || name == ".." {
+            continue;
+        }
+        let child_path = path.join(name);
+        let stx = rustix::fs::statx(dirfd, name, AtFlags::SYMLINK_NOFOLLOW, STATX_MASK)
+            .with_context(|| format!("while statting {}", child_path.display()))?;
+        let entry = Entry::new(child_path.clone(), &stx, dirfd, name)?;
+        let is_dir = matches!(entry.fact, DirEntry::Directory(_));
+        if sender.send(Ok(entry)).is_err() {
+            // the receiver has gone away (most likely due to an error), there
+            // is no point in continuing to walk
+            return Ok(());
+        }
+        if is_dir {
+            // The child is only opened once its task runs, and queued tasks
+            // share their parent's fd, so the number of open fds is bounded
+            // by the number of running tasks and directories with queued
+            // children, not by how wide the tree is.
+            let parent = dirfd.clone();
+            let name = name.to_owned();
+            let sender = sender.clone();
+            scope.spawn(move |scope| {
+                let child_fd = match rustix::fs::openat(
+                    &*parent,
+                    &name,
+                    OFlags::RDONLY | OFlags::DIRECTORY | OFlags::NOFOLLOW | OFlags::CLOEXEC,
+                    Mode::empty(),
+                ) {
+                    Ok(fd) => fd,
+                    Err(e) => {
+                        let _ = sender.send(Err(anyhow::Error::from(e)
+                            .context(format!("while opening {}", child_path.display()))));
+                        return;
+                    }
+                };
+                drop(parent);
+                walk_dir(scope, Arc::new(child_fd), child_path, sender)
+            });
+        }
+    }
+    Ok(())
+}
+
+// The facts db keeps a cache of the inode number and ctime that each
+// [DirEntry] fact was last generated from, so that entries that are unchanged
+// from the parent layer (which is a snapshot, so inode numbers are preserved)
+// do not need to be re-serialized and re-written. The whole cache is loaded up
+// front (it is only read before any new stats are written), and new stats are
+// written in batches along with the facts.
+
+pub(super) type Stats = FxHashMap<Key, (i64, i64)>;
+
+pub(super) fn load_stats(bulk: &Bulk) -> crate::Result<Stats> {
+    bulk.dir_entry_stats()
+}
+
+pub(super) fn is_unchanged(stats: &Stats, key: &Key, entry: &Entry) -> bool {
+    stats.get(key) == Some(&(entry.ino as i64, entry.ctime))
+}
+
+pub(super) fn record_stat(bulk: &mut Bulk, key: Key, entry: &Entry) -> crate::Result<()> {
+    bulk.record_dir_entry_stat(key, entry.ino as i64, entry.ctime)
+}
+
+/// Remove the cached stats for any entries that no longer exist.
+pub(super) fn delete_unseen_stats(bulk: &mut Bulk) -> crate::Result<usize> {
+    bulk.delete_unseen_rows("dir_entry_stats", DirEntry::KIND)
+}
@@ -4,35 +4,91 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import hashlib
 import json
+import os
 import sys
 
 import rpm
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--installroot", required=True)
+parser.add_argument(
+    "--known-headers-fd",
+    type=int,
+    help="fd to read NDJSON [name, sha1header, changelog_hash] triples that "
+    "are already recorded in the facts db (usually inherited from the parent "
+    "layer)",
+)
 args = parser.parse_args()
 
 
-def _info_from_hdr(hdr):
+def _info_from_hdr(hdr, sha1header, changelog_hash):
     return {
         "name": hdr[rpm.RPMTAG_NAME],
         "epoch": hdr[rpm.RPMTAG_EPOCH] or 0,
         "version": hdr[rpm.RPMTAG_VERSION],
         "release": hdr[rpm.RPMTAG_RELEASE],
         "arch": hdr[rpm.RPMTAG_ARCH] or "noarch",
-        "changelog": "\n".join(hdr[rpm.RPMTAG_CHANGELOGTEXT])
-        if hdr[rpm.RPMTAG_CHANGELOGTEXT]
-        else None,
+        "changelog_hash": changelog_hash,
         "size": hdr[rpm.RPMTAG_SIZE],
         "os": hdr[rpm.RPMTAG_OS],
         "source_rpm": hdr[rpm.RPMTAG_SOURCERPM],
+        "sha1header": sha1header,
     }
 
 
-ts = rpm.TransactionSet(args.installroot)
+def _emit(obj):
+    sys.stdout.write(json.dumps(obj))
+    sys.stdout.write("\n")
+
+
+known = set()
+# changelogs whose content is already in the db (or has been emitted by this
+# process), keyed by content hash
+known_changelogs = set()
+if args.known_headers_fd is not None:
+    with os.fdopen(args.known_headers_fd) as f:
+        for line in f:
+            name, sha1header, changelog_hash = json.loads(line)
+            known.add((name, sha1header))
+            if changelog_hash:
+                known_changelogs.add(changelog_hash)
+
+# Every subpackage built from the same source rpm has the same changelog, so
+# only join and hash the text once per source rpm.
+changelog_hash_by_srpm = {}
 
-output = [_info_from_hdr(hdr) for hdr in ts.dbMatch()]
 
+def _changelog_hash(hdr):
+    srpm = hdr[rpm.RPMTAG_SOURCERPM]
+    if srpm and srpm in changelog_hash_by_srpm:
+        return changelog_hash_by_srpm[srpm]
+    text = hdr[rpm.RPMTAG_CHANGELOGTEXT]
+    if not text:
+        changelog_hash = None
+    else:
+        text = "\n".join(text)
+        changelog_hash = hashlib.sha256(text.encode()).hexdigest()
+        if changelog_hash not in known_changelogs:
+            _emit({"changelog_hash": changelog_hash, "changelog": text})
+            known_changelogs.add(changelog_hash)
+    if srpm:
+        changelog_hash_by_srpm[srpm] = changelog_hash
+    return changelog_hash
+
+
+ts = rpm.TransactionSet(args.installroot)
 
-json.dump(output, sys.stdout)
+# Stream one JSON object per line so that the reader can start inserting facts
+# before the whole rpmdb has been walked. Headers that are byte-for-byte
+# identical to ones already in the db are only acknowledged by their
+# SHA1HEADER, which avoids the (expensive) full header decode. Changelog text is
+# emitted at most once per unique content and referenced by hash.
+for hdr in ts.dbMatch():
+    sha1header = hdr[rpm.RPMTAG_SHA1HEADER]
+    if (hdr[rpm.RPMTAG_NAME], sha1header) in known:
+        _emit({"unchanged": sha1header})
+    else:
+        _emit(_info_from_hdr(hdr, sha1header, _changelog_hash(hdr)))
+sys.stdout.flush()
@@ -157,12 +157,29 @@ fn rpms() {
         Some(3),
         "epoch should be recorded"
     );
+    let mut changelog_rpm = rpms
+        .get("antlir2-changelog")
+        .expect("antlir2-changelog rpm missing")
+        .clone();
+    assert!(
+        changelog_rpm.changelog_hash().is_some(),
+        "changelog should be stored out-of-line"
+    );
+    assert_eq!(
+        changelog_rpm.changelog(),
+        None,
+        "changelog is only loaded on demand"
+    );
+    db.load_rpm_changelog(&mut changelog_rpm)
+        .expect("failed to load changelog");
     assert_eq!(
-        rpms.get("antlir2-changelog")
-            .expect("antlir2-changelog rpm missing")
-            .changelog(),
+        changelog_rpm.changelog(),
         Some("- Example changelog\n- CVE-2024-0101"),
     );
+    assert!(
+        rpms.get("foo").and_then(Rpm::sha1header).is_some(),
+        "sha1header should be recorded"
+    );
 }
 
 #[test]
@@ -217,6 +234,10 @@ fn child_removes_things() {
         !rpm_names.contains("foobar"),
         "'foobar' should have been removed"
     );
+    assert!(
+        rpm_names.contains("foo-epoch"),
+        "unchanged rpms from the parent should be kept"
+    );
 
     assert!(
         db.get::<antlir2_systemd::UnitFile>("foo.service")
@@ -35,6 +35,10 @@ struct Args {
     out: PathBuf,
     #[clap(long)]
     rootless: bool,
+    #[clap(long)]
+    /// Number of threads used to diff the layers (defaults to the number of
+    /// available cpus)
+    threads: Option<usize>,
 }
 
 struct Entry {
@@ -67,9 +71,14 @@ fn main() -> Result<()> {
         antlir2_rootless::unshare_new_userns().context("while setting up userns")?;
     }
 
+    let threads = args.threads.unwrap_or_else(|| {
+        std::thread::available_parallelism()
+            .map(std::num::NonZeroUsize::get)
+            .unwrap_or(1)
+    });
     let stream: Iter<File> = match &args.parent {
-        Some(parent) => Iter::diff(parent, &args.child)?,
-        None => Iter::from_empty(&args.child)?,
+        Some(parent) => Iter::diff_with_threads(parent, &args.child, threads)?,
+        None => Iter::from_empty_with_threads(&args.child, threads)?,
     };
     let mut entries: BTreeMap<PathBuf, Entry> = BTreeMap::new();
     for change in stream {
@@ -0,0 +1,371 @@
+/*
+ * Copyright (c) Meta Platforms, Inc. and affiliates.
+ *
+ * This source code is licensed under the MIT license found in the
+ * LICENSE file in the root directory of this source tree.
+ */
+
+//! Local content-addressed cache of OCI layer blobs.
+//!
+//! A layer blob is fully determined by the subvolume it was built from, the
+//! subvolume of its parent and how the delta was built and compressed (the
+//! make-oci-layer and packager binaries and their parameters), so different
+//! packages that share base layers would otherwise re-hash and re-copy
+//! exactly the same (potentially huge) blobs. Blobs are stored by digest, and
+//! a small index entry maps each layer key to the digest, size and diff_id of
+//! its blob. Index entries are touched whenever they are used and the least
+//! recently used ones are evicted once the cache is over its size budget.
+//!
+//! Blobs are always reflinked or copied in and out of the cache, never
+//! hardlinked, so that buck outputs never share an inode with the cache.
+
+use std::collections::HashMap;
+use std::fs::File;
+use std::io::ErrorKind;
+use std::os::fd::AsRawFd;
+use std::path::Path;
+use std::path::PathBuf;
+use std::sync::Mutex;
+use std::sync::OnceLock;
+use std::time::SystemTime;
+
+use antlir2_btrfs::Subvolume;
+use antlir2_working_volume::WorkingVolume;
+use anyhow::Context;
+use anyhow::Result;
+use cap_std::fs::Dir;
+use serde::Deserialize;
+use serde::Serialize;
+use tracing::debug;
+use tracing::trace;
+
+/// Bump this whenever the format of the index changes. Changes to how blobs
+/// are built are covered by [LayerBuild] instead.
+const CACHE_VERSION: u32 = 2;
+
+pub(crate) const DEFAULT_MAX_BYTES: u64 = 64 << 30;
+
+#[derive(Debug, Clone, PartialEq, Eq, Serialize, Deserialize)]
+pub(crate) struct CachedLayer {
+    /// hex sha256 of the compressed blob
+    pub(crate) digest: String,
+    pub(crate) size: u64,
+    /// "sha256:..." of the uncompressed tar
+    pub(crate) diff_id: String,
+}
+
+/// How the tar and tar.zst of a layer were built from its subvolumes.
+#[derive(Debug, Clone, Deserialize)]
+#[serde(deny_unknown_fields)]
+pub(crate) struct LayerBuild {
+    /// make-oci-layer binary that built the tar
+    make_oci_layer: PathBuf,
+    rootless: bool,
+    /// zstd level that the tar.zst was compressed with
+    zstd_level: i32,
+}
+
+impl LayerBuild {
+    /// Digest of everything other than the subvolumes that the blob depends
+    /// on, including the packager itself.
+    fn digest(&self) -> Result<String> {
+        let packager = std::env::current_exe().context("while finding packager binary")?;
+        let mut hasher = blake3::Hasher::new();
+        hasher.update(file_digest(&packager)?.as_bytes());
+        hasher.update(file_digest(&self.make_oci_layer)?.as_bytes());
+        hasher.update(&[u8::from(self.rootless)]);
+        hasher.update(&self.zstd_level.to_le_bytes());
+        Ok(hasher.finalize().to_hex()[..32].to_owned())
+    }
+}
+
+/// Digest of a file (a binary), only computed once for each path since the
+/// same binaries are part of the key of every layer.
+fn file_digest(path: &Path) -> Result<blake3::Hash> {
+    static DIGESTS: OnceLock<Mutex<HashMap<PathBuf, blake3::Hash>>> = OnceLock::new();
+    let digests = DIGESTS.get_or_init(Default::default);
+    if let Some(digest) = digests.lock().expect("poisoned").get(path) {
+        return Ok(*digest);
+    }
+    let mut hasher = blake3::Hasher::new();
+    std::io::copy(
+        &mut File::open(path).with_context(|| format!("while opening {}", path.display()))?,
+        &mut hasher,
+    )
+    .with_context(|| format!("while hashing {}", path.display()))?;
+    let digest = hasher.finalize();
+    digests
+        .lock()
+        .expect("poisoned")
+        .insert(path.to_owned(), digest);
+    Ok(digest)
+}
+
+pub(crate) struct BlobCache {
+    blobs: Dir,
+    index: Dir,
+    max_bytes: u64,
+}
+
+impl BlobCache {
+    /// Open (or create) the cache in the working volume.
+    pub(crate) fn open(max_bytes: u64) -> Result<Self> {
+        let working_volume = WorkingVolume::ensure().context("while initializing WorkingVolume")?;
+        Self::open_at(&working_volume.path().join("oci-blob-cache"), max_bytes)
+    }
+
+    fn open_at(root: &Path, max_bytes: u64) -> Result<Self> {
+        std::fs::create_dir_all(root.join("blobs"))
+            .context("while creating blob cache blobs dir")?;
+        std::fs::create_dir_all(root.join("index"))
+            .context("while creating blob cache index dir")?;
+        let open = |name| {
+            Dir::open_ambient_dir(root.join(name), cap_std::ambient_authority())
+                .with_context(|| format!("while opening blob cache {name} dir"))
+        };
+        Ok(Self {
+            blobs: open("blobs")?,
+            index: open("index")?,
+            max_bytes,
+        })
+    }
+
+    /// Compute the cache key for the delta between `parent` and `child`
+    /// subvolumes, as built by `build`. Returns None if either is not a btrfs
+    /// subvolume (in which case there is no stable identity to cache by).
+    pub(crate) fn key(child: &Path, parent: Option<&Path>, build: &LayerBuild) -> Option<String> {
+        let uuid = |path: &Path| match Subvolume::open(path).and_then(|s| s.info()) {
+            Ok(info) => Some(info.uuid().simple().to_string()),
+            Err(e) => {
+                debug!("not caching layer for {}: {e:?}", path.display());
+                None
+            }
+        };
+        let child = uuid(child)?;
+        let parent = match parent {
+            Some(p) => uuid(p)?,
+            None => "none".to_owned(),
+        };
+        let build = match build.digest() {
+            Ok(digest) => digest,
+            Err(e) => {
+                debug!("not caching layer for {child}: {e:?}");
+                return None;
+            }
+        };
+        Some(format!("v{CACHE_VERSION}-{child}-{parent}-{build}"))
+    }
+
+    /// Look up a layer, copying its blob into `blobs_dir` on a hit.
+    pub(crate) fn get(&self, key: &str, blobs_dir: &Dir) -> Result<Option<CachedLayer>> {
+        let entry: CachedLayer = match self.index.read(index_name(key)) {
+            Ok(contents) => {
+                serde_json::from_slice(&contents).context("while parsing blob cache entry")?
+            }
+            Err(e) if e.kind() == ErrorKind::NotFound => return Ok(None),
+            Err(e) => return Err(e).context("while reading blob cache entry"),
+        };
+        match self.blobs.metadata(&entry.digest) {
+            Ok(meta) if meta.len() == entry.size => {}
+            // the blob was evicted (or is being written) by a concurrent
+            // process, treat it as a miss
+            _ => return Ok(None),
+        }
+        reflink_or_copy(&self.blobs, &entry.digest, blobs_dir, &entry.digest)
+            .context("while copying cached blob")?;
+        // mark it as recently used
+        if let Ok(f) = self.index.open(index_name(key)) {
+            let _ = f.into_std().set_modified(SystemTime::now());
+        }
+        trace!("blob cache hit for {key}: {}", entry.digest);
+        Ok(Some(entry))
+    }
+
+    /// Add a layer whose blob has already been written into `blobs_dir`.
+    pub(crate) fn insert(&self, key: &str, layer: &CachedLayer, blobs_dir: &Dir) -> Result<()> {
+        if !self.blobs.exists(&layer.digest) {
+            let tmp = format!(".tmp-{}", uuid::Uuid::new_v4());
+            reflink_or_copy(blobs_dir, &layer.digest, &self.blobs, &tmp)
+                .context("while adding blob to cache")?;
+            self.blobs
+                .rename(&tmp, &self.blobs, &layer.digest)
+                .context("while moving cached blob into place")?;
+        }
+        let tmp = format!(".tmp-{}", uuid::Uuid::new_v4());
+        self.index
+            .write(&tmp, serde_json::to_vec(layer)?)
+            .context("while writing blob cache entry")?;
+        self.index
+            .rename(&tmp, &self.index, index_name(key))
+            .context("while moving blob cache entry into place")?;
+        Ok(())
+    }
+
+    /// Evict the least recently used layers until the blobs in the cache fit
+    /// in the size budget.
+    pub(crate) fn evict(&self) -> Result<()> {
+        let mut entries = Vec::new();
+        for dirent in self.index.entries()? {
+            let dirent = dirent?;
+            let name = dirent.file_name();
+            let Some(name) = name.to_str().filter(|n| n.ends_with(".json")) else {
+                continue;
+            };
+            let mtime = dirent.metadata()?.modified()?.into_std();
+            let layer: Option<CachedLayer> = self
+                .index
+                .read(name)
+                .ok()
+                .and_then(|c| serde_json::from_slice(&c).ok());
+            entries.push((mtime, name.to_owned(), layer));
+        }
+        let mut total = 0;
+        for dirent in self.blobs.entries()? {
+            let dirent = dirent?;
+            if !dirent.file_name().to_string_lossy().starts_with('.') {
+                total += dirent.metadata()?.len();
+            }
+        }
+        if total <= self.max_bytes {
+            return Ok(());
+        }
+        // oldest first
+        entries.sort_by_key(|(mtime, _, _)| *mtime);
+        let mut remaining: Vec<Option<String>> = entries
+            .iter()
+            .map(|(_, _, l)| l.as_ref().map(|l| l.digest.clone()))
+            .collect();
+        for (i, (_, name, layer)) in entries.iter().enumerate() {
+            if total <= self.max_bytes {
+                break;
+            }
+            let _ = self.index.remove_file(name);
+            remaining[i] = None;
+            let Some(layer) = layer else {
+                continue;
+            };
+            // the same blob could be referenced by more than one key
+            if remaining.iter().flatten().any(|d| d == &layer.digest) {
+                continue;
+            }
+            if self.blobs.remove_file(&layer.digest).is_ok() {
+                debug!(
+                    "evicted {} ({} bytes) from blob cache",
+                    layer.digest, layer.size
+                );
+                total = total.saturating_sub(layer.size);
+            }
+        }
+        Ok(())
+    }
+}
+
+fn index_name(key: &str) -> String {
+    format!("{key}.json")
+}
+
+/// Make `dst` in `dst_dir` have the same contents as `src` in `src_dir` as
+/// cheaply as possible without sharing the inode: reflink if on the same
+/// filesystem, otherwise fall back to a full copy.
+fn reflink_or_copy(src_dir: &Dir, src: &str, dst_dir: &Dir, dst: &str) -> std::io::Result<()> {
+    let src = src_dir.open(src)?.into_std();
+    // another layer of this package may already have the same blob, which
+    // this replaces
+    let dst = dst_dir.create(dst)?.into_std();
+    if let Err(e) = reflink(&src, &dst) {
+        trace!("reflinking blob failed, copying it: {e}");
+        std::io::copy(&mut &src, &mut &dst)?;
+    }
+    Ok(())
+}
+
+fn reflink(src: &File, dst: &File) -> std::io::Result<()> {
+    // SAFETY: both fds are valid for the duration of this call
+    let ret = unsafe { nix::libc::ioctl(dst.as_raw_fd(), nix::libc::FICLONE, src.as_raw_fd()) };
+    if ret == 0 {
+        Ok(())
+    } else {
+        Err(std::io::Error::last_os_error())
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn layer(digest: &str, size: u64) -> CachedLayer {
+        CachedLayer {
+            digest: digest.to_owned(),
+            size,
+            diff_id: format!("sha256:{digest}"),
+        }
+    }
+
+    #[test]
+    fn insert_get_evict() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let cache = BlobCache::open_at(&tmp.path().join("cache"), 10).expect("failed to open");
+        std::fs::create_dir(tmp.path().join("out")).expect("failed to create out");
+        let out = Dir::open_ambient_dir(tmp.path().join("out"), cap_std::ambient_authority())
+            .expect("failed to open out");
+
+        out.write("aaaa", b"123456").expect("failed to write blob");
+        cache
+            .insert("a", &layer("aaaa", 6), &out)
+            .expect("failed to insert");
+        out.write("bbbb", b"123456").expect("failed to write blob");
+        cache
+            .insert("b", &layer("bbbb", 6), &out)
+            .expect("failed to insert");
+
+        std::fs::create_dir(tmp.path().join("out2")).expect("failed to create out2");
+        let out2 = Dir::open_ambient_dir(tmp.path().join("out2"), cap_std::ambient_authority())
+            .expect("failed to open out2");
+        // make sure that "a" is the most recently used
+        std::thread::sleep(std::time::Duration::from_millis(20));
+        assert_eq!(
+            cache.get("a", &out2).expect("failed to get"),
+            Some(layer("aaaa", 6))
+        );
+        assert_eq!(out2.read("aaaa").expect("blob not copied"), b"123456");
+        // buck outputs must never share an inode with the cache
+        let ino = |path: &str| {
+            std::os::unix::fs::MetadataExt::ino(
+                &std::fs::metadata(tmp.path().join(path)).expect("failed to stat"),
+            )
+        };
+        assert_ne!(ino("cache/blobs/aaaa"), ino("out/aaaa"));
+        assert_ne!(ino("cache/blobs/aaaa"), ino("out2/aaaa"));
+        assert_eq!(cache.get("c", &out2).expect("failed to get"), None);
+
+        // 12 bytes > 10 byte budget, so the least recently used must go
+        cache.evict().expect("failed to evict");
+        assert_eq!(cache.get("b", &out2).expect("failed to get"), None);
+        assert!(cache.get("a", &out2).expect("failed to get").is_some());
+    }
+
+    #[test]
+    fn build_digest() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        std::fs::write(tmp.path().join("a"), "make-oci-layer a").expect("failed to write");
+        std::fs::write(tmp.path().join("b"), "make-oci-layer b").expect("failed to write");
+        let build = |bin: &str, rootless, zstd_level| LayerBuild {
+            make_oci_layer: tmp.path().join(bin),
+            rootless,
+            zstd_level,
+        };
+        let digest = build("a", false, 15).digest().expect("failed to hash");
+        assert_eq!(
+            digest,
+            build("a", false, 15).digest().expect("failed to hash")
+        );
+        for other in [
+            build("b", false, 15),
+            build("a", true, 15),
+            build("a", false, 3),
+        ] {
+            assert_ne!(digest, other.digest().expect("failed to hash"), "{other:?}");
+        }
+        assert!(build("missing", false, 15).digest().is_err());
+    }
+}
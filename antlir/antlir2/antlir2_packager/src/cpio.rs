@@ -5,60 +5,284 @@
  * LICENSE file in the root directory of this source tree.
  */
 
+use std::collections::HashMap;
 use std::fs::File;
+use std::fs::Metadata;
+use std::io::BufWriter;
+use std::io::Write;
+use std::os::unix::ffi::OsStrExt;
+use std::os::unix::ffi::OsStringExt;
+use std::os::unix::fs::FileTypeExt;
+use std::os::unix::fs::MetadataExt;
 use std::path::Path;
 use std::path::PathBuf;
-use std::process::Stdio;
 
-use antlir2_isolate::IsolationContext;
-use antlir2_isolate::unshare;
 use anyhow::Context;
 use anyhow::Result;
+use nix::sys::stat::major;
+use nix::sys::stat::minor;
 use serde::Deserialize;
+use walkdir::WalkDir;
 
-use crate::BuildAppliance;
 use crate::PackageFormat;
-use crate::run_cmd;
 
 #[derive(Debug, Clone, Deserialize)]
 #[serde(deny_unknown_fields)]
-pub struct Cpio {
-    build_appliance: BuildAppliance,
-}
+pub struct Cpio {}
 
 impl PackageFormat for Cpio {
     fn build(&self, out: &Path, layer: &Path) -> Result<()> {
-        File::create(out).context("failed to create output file")?;
-
-        let isol_context = IsolationContext::builder(self.build_appliance.path())
-            .ephemeral(false)
-            .readonly()
-            .tmpfs(Path::new("/__antlir2__/out"))
-            .outputs(("/__antlir2__/out/cpio", out))
-            .inputs((Path::new("/__antlir2__/root"), layer))
-            .inputs((
-                PathBuf::from("/__antlir2__/working_directory"),
-                std::env::current_dir()?,
-            ))
-            .working_directory(Path::new("/__antlir2__/working_directory"))
-            .build();
-
-        let cpio_script = "set -ue -o pipefail; \
-            pushd /__antlir2__/root; \
-            /usr/bin/find . -mindepth 1 ! -type s | \
-            LANG=C /usr/bin/sort | \
-            LANG=C /usr/bin/cpio -o -H newc \
-            > /__antlir2__/out/cpio";
-
-        run_cmd(
-            unshare(isol_context)?
-                .command("/bin/bash")?
-                .arg("-c")
-                .arg(cpio_script)
-                .stdout(Stdio::piped()),
-        )
-        .context("Failed to build cpio archive")?;
-
+        let layer = layer.canonicalize().context("while resolving layer")?;
+        let mut out = BufWriter::with_capacity(
+            1 << 20,
+            File::create(out).context("failed to create output file")?,
+        );
+        write_newc(&mut out, &layer).context("Failed to build cpio archive")?;
+        out.flush().context("while flushing cpio archive")?;
         Ok(())
     }
 }
+
+struct Entry {
+    /// Name as it is recorded in the archive ("./" + path relative to the root)
+    name: Vec<u8>,
+    path: PathBuf,
+    meta: Metadata,
+}
+
+/// Write the tree under `root` as a "newc" (SVR4 without CRC) cpio archive.
+///
+/// This matches `find . -mindepth 1 ! -type s | LANG=C sort | cpio -o -H newc`:
+/// entries are ordered bytewise by their full path, and hardlinked files only
+/// have their contents stored with the last link. Inode numbers are assigned
+/// sequentially instead of being copied from the filesystem and the device
+/// number is omitted, so the archive is reproducible.
+fn write_newc(out: &mut impl Write, root: &Path) -> Result<()> {
+    let mut entries = Vec::new();
+    for entry in WalkDir::new(root).min_depth(1) {
+        let entry = entry?;
+        if entry.file_type().is_socket() {
+            continue;
+        }
+        let mut name = b"./".to_vec();
+        name.extend_from_slice(entry.path().strip_prefix(root)?.as_os_str().as_bytes());
+        let meta = entry
+            .metadata()
+            .with_context(|| format!("while statting {}", entry.path().display()))?;
+        entries.push(Entry {
+            name,
+            path: entry.into_path(),
+            meta,
+        });
+    }
+    entries.sort_unstable_by(|a, b| a.name.cmp(&b.name));
+
+    // count the links to each hardlinked inode that are in the archive, so
+    // that the contents can be written with the last one
+    let mut remaining_links: HashMap<(u64, u64), usize> = HashMap::new();
+    for e in &entries {
+        if e.meta.is_file() && e.meta.nlink() > 1 {
+            *remaining_links
+                .entry((e.meta.dev(), e.meta.ino()))
+                .or_default() += 1;
+        }
+    }
+
+    let mut inodes: HashMap<(u64, u64), u32> = HashMap::new();
+    let mut offset = 0u64;
+    for e in &entries {
+        let next_ino = inodes.len() as u32 + 1;
+        let ino = *inodes
+            .entry((e.meta.dev(), e.meta.ino()))
+            .or_insert(next_ino);
+        let ft = e.meta.file_type();
+        let data: Data = if ft.is_symlink() {
+            Data::Bytes(std::fs::read_link(&e.path)?.into_os_string().into_vec())
+        } else if ft.is_file() {
+            let last_link = match remaining_links.get_mut(&(e.meta.dev(), e.meta.ino())) {
+                Some(remaining) => {
+                    *remaining -= 1;
+                    *remaining == 0
+                }
+                None => true,
+            };
+            if last_link {
+                Data::File(e.meta.len())
+            } else {
+                Data::Bytes(Vec::new())
+            }
+        } else {
+            Data::Bytes(Vec::new())
+        };
+        let filesize = match &data {
+            Data::Bytes(b) => b.len() as u64,
+            Data::File(len) => *len,
+        };
+        let filesize: u32 = filesize.try_into().with_context(|| {
+            format!("{} is too large for a newc cpio archive", e.path.display())
+        })?;
+        let rdev = e.meta.rdev();
+        offset += write_header(
+            out,
+            &Header {
+                ino,
+                mode: e.meta.mode(),
+                uid: e.meta.uid(),
+                gid: e.meta.gid(),
+                nlink: e.meta.nlink() as u32,
+                mtime: e.meta.mtime() as u32,
+                filesize,
+                rdevmajor: major(rdev) as u32,
+                rdevminor: minor(rdev) as u32,
+            },
+            &e.name,
+        )?;
+        let written = match data {
+            Data::Bytes(b) => {
+                out.write_all(&b)?;
+                b.len() as u64
+            }
+            Data::File(len) => {
+                let f = File::open(&e.path)
+                    .with_context(|| format!("while opening {}", e.path.display()))?;
+                let copied = std::io::copy(&mut std::io::Read::take(f, len), out)
+                    .with_context(|| format!("while archiving {}", e.path.display()))?;
+                anyhow::ensure!(copied == len, "{} changed size", e.path.display());
+                copied
+            }
+        };
+        offset += written;
+        offset += pad(out, offset, 4)?;
+    }
+    offset += write_header(
+        out,
+        &Header {
+            nlink: 1,
+            ..Default::default()
+        },
+        b"TRAILER!!!",
+    )?;
+    // like cpio(1), pad the archive out to a full 512 byte block
+    pad(out, offset, 512)?;
+    Ok(())
+}
+
+enum Data {
+    Bytes(Vec<u8>),
+    /// Contents of the file on disk, with the given length
+    File(u64),
+}
+
+#[derive(Default)]
+struct Header {
+    ino: u32,
+    mode: u32,
+    uid: u32,
+    gid: u32,
+    nlink: u32,
+    mtime: u32,
+    filesize: u32,
+    rdevmajor: u32,
+    rdevminor: u32,
+}
+
+/// Write a header and name (padded to a 4 byte boundary), returning the number
+/// of bytes written
+fn write_header(out: &mut impl Write, h: &Header, name: &[u8]) -> std::io::Result<u64> {
+    let header = format!(
+        "070701{:08X}{:08X}{:08X}{:08X}{:08X}{:08X}{:08X}{:08X}{:08X}{:08X}{:08X}{:08X}{:08X}",
+        h.ino,
+        h.mode,
+        h.uid,
+        h.gid,
+        h.nlink,
+        h.mtime,
+        h.filesize,
+        0, // devmajor
+        0, // devminor
+        h.rdevmajor,
+        h.rdevminor,
+        name.len() + 1,
+        0, // check
+    );
+    out.write_all(header.as_bytes())?;
+    out.write_all(name)?;
+    out.write_all(&[0])?;
+    let len = (header.len() + name.len() + 1) as u64;
+    Ok(len + pad(out, len, 4)?)
+}
+
+fn pad(out: &mut impl Write, offset: u64, align: u64) -> std::io::Result<u64> {
+    let padding = (align - offset % align) % align;
+    out.write_all(&vec![0; padding as usize])?;
+    Ok(padding)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// Minimal newc reader, returning (name, ino, nlink, contents) for every
+    /// entry
+    fn read_newc(mut buf: &[u8]) -> Vec<(String, u32, u32, Vec<u8>)> {
+        let mut entries = Vec::new();
+        let mut offset = 0;
+        loop {
+            assert_eq!(&buf[..6], b"070701");
+            let field = |i: usize| {
+                u32::from_str_radix(
+                    std::str::from_utf8(&buf[6 + i * 8..14 + i * 8]).unwrap(),
+                    16,
+                )
+                .unwrap()
+            };
+            let (ino, nlink, filesize, namesize) =
+                (field(0), field(4), field(6) as usize, field(11) as usize);
+            let name = String::from_utf8(buf[110..110 + namesize - 1].to_vec()).unwrap();
+            let data_start = (offset + 110 + namesize).next_multiple_of(4) - offset;
+            let contents = buf[data_start..data_start + filesize].to_vec();
+            if name == "TRAILER!!!" {
+                return entries;
+            }
+            entries.push((name, ino, nlink, contents));
+            let next = (offset + data_start + filesize).next_multiple_of(4) - offset;
+            buf = &buf[next..];
+            offset += next;
+        }
+    }
+
+    #[test]
+    fn sorted_with_hardlinks() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let root = tmp.path();
+        std::fs::create_dir(root.join("b")).expect("failed to create dir");
+        std::fs::write(root.join("b/z"), "z").expect("failed to write");
+        std::fs::write(root.join("a"), "hello").expect("failed to write");
+        std::fs::write(root.join("b-c"), "bc").expect("failed to write");
+        std::fs::hard_link(root.join("a"), root.join("c")).expect("failed to link");
+        std::os::unix::fs::symlink("a", root.join("d")).expect("failed to symlink");
+
+        let mut out = Vec::new();
+        write_newc(&mut out, root).expect("failed to write cpio");
+        assert_eq!(out.len() % 512, 0);
+        let entries: Vec<_> = read_newc(&out)
+            .into_iter()
+            .map(|(name, ino, nlink, contents)| {
+                (name, ino, nlink, String::from_utf8(contents).unwrap())
+            })
+            .collect();
+        assert_eq!(
+            entries,
+            vec![
+                // contents of a hardlinked file are only stored with the last
+                // link
+                ("./a".to_owned(), 1, 2, "".to_owned()),
+                ("./b".to_owned(), 2, 2, "".to_owned()),
+                ("./b-c".to_owned(), 3, 1, "bc".to_owned()),
+                ("./b/z".to_owned(), 4, 1, "z".to_owned()),
+                ("./c".to_owned(), 1, 2, "hello".to_owned()),
+                ("./d".to_owned(), 5, 1, "a".to_owned()),
+            ]
+        );
+    }
+}
@@ -15,6 +15,7 @@ use anyhow::anyhow;
 use clap::Parser;
 use json_arg::JsonFile;
 
+mod blob_cache;
 mod btrfs;
 mod cpio;
 mod docker_archive;
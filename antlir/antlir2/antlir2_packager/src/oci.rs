@@ -13,7 +13,6 @@ use std::io::Write;
 use std::path::Path;
 use std::path::PathBuf;
 use std::str::FromStr;
-use std::sync::Arc;
 
 use anyhow::Context;
 use anyhow::Result;
@@ -32,10 +31,16 @@ use oci_spec::image::OciLayoutBuilder;
 use oci_spec::image::PlatformBuilder;
 use oci_spec::image::RootFsBuilder;
 use oci_spec::image::Sha256Digest;
+use rayon::prelude::*;
 use serde::Deserialize;
 use serde::Serialize;
 use sha2::Digest;
 use sha2::Sha256;
+use tracing::warn;
+
+use crate::blob_cache::BlobCache;
+use crate::blob_cache::CachedLayer;
+use crate::blob_cache::LayerBuild;
 
 #[derive(Debug, Clone, Deserialize)]
 #[serde(deny_unknown_fields)]
@@ -45,6 +50,13 @@ pub struct Oci {
     refname: String,
     target_arch: Arch,
     entrypoint: Vec<String>,
+    /// Size budget of the local layer blob cache, 0 disables the cache
+    #[serde(default = "default_blob_cache_max_bytes")]
+    blob_cache_max_bytes: u64,
+}
+
+fn default_blob_cache_max_bytes() -> u64 {
+    crate::blob_cache::DEFAULT_MAX_BYTES
 }
 
 #[derive(Debug, Clone, Deserialize)]
@@ -52,13 +64,19 @@ pub struct Oci {
 pub struct Delta {
     tar: PathBuf,
     tar_zst: PathBuf,
+    /// Subvolumes that this delta was built from, used to identify it in the
+    /// blob cache
+    #[serde(default)]
+    child_subvol: Option<PathBuf>,
+    #[serde(default)]
+    parent_subvol: Option<PathBuf>,
+    /// How tar and tar_zst were built, layers are only cached when it is
+    /// known
+    #[serde(default)]
+    build: Option<LayerBuild>,
 }
 
-trait Blob {
-    fn to_bytes(&self) -> Result<Arc<Vec<u8>>>;
-}
-
-trait OciObject: Blob {
+trait OciObject: Serialize {
     const MEDIA_TYPE: MediaType;
 }
 
@@ -70,47 +88,158 @@ impl OciObject for oci_spec::image::ImageConfiguration {
     const MEDIA_TYPE: MediaType = MediaType::ImageConfig;
 }
 
-impl<T> Blob for T
-where
-    T: Serialize,
-{
-    fn to_bytes(&self) -> Result<Arc<Vec<u8>>> {
-        serde_json::to_vec_pretty(&self)
-            .context("while serializing object")
-            .map(Arc::new)
-    }
+/// Writer that computes the sha256 and size of everything written through it
+struct HashingWriter<W> {
+    inner: W,
+    hasher: Sha256,
+    len: u64,
 }
 
-struct LayerTarZst(Arc<Vec<u8>>);
+impl<W: Write> HashingWriter<W> {
+    fn new(inner: W) -> Self {
+        Self {
+            inner,
+            hasher: Sha256::new(),
+            len: 0,
+        }
+    }
 
-impl Blob for LayerTarZst {
-    fn to_bytes(&self) -> Result<Arc<Vec<u8>>> {
-        Ok(self.0.clone())
+    fn finish(mut self) -> std::io::Result<(String, u64)> {
+        self.inner.flush()?;
+        Ok((hex::encode(self.hasher.finalize()), self.len))
     }
 }
 
-impl OciObject for LayerTarZst {
-    const MEDIA_TYPE: MediaType = MediaType::ImageLayerZstd;
+impl<W: Write> Write for HashingWriter<W> {
+    fn write(&mut self, buf: &[u8]) -> std::io::Result<usize> {
+        let n = self.inner.write(buf)?;
+        self.hasher.update(&buf[..n]);
+        self.len += n as u64;
+        Ok(n)
+    }
+
+    fn flush(&mut self) -> std::io::Result<()> {
+        self.inner.flush()
+    }
 }
 
-/// Take some OCI object, write it to the blobs dir and return a descriptor
-fn write<O: OciObject>(blobs_dir: &Dir, obj: &O) -> Result<Descriptor> {
-    let bytes = obj.to_bytes().context("while serializing object")?;
-    let sha256 = hex::encode(Sha256::digest(bytes.as_ref()));
-    let mut f = BufWriter::new(
+/// Buffer size used when streaming layers (which may be many GB)
+const STREAM_BUF_SIZE: usize = 1 << 20;
+
+/// Stream some contents into the blobs dir and return a descriptor.
+///
+/// The contents are hashed while being copied into a temporary file in the
+/// blobs dir, which is then renamed to its final content-addressed name, so
+/// only a small buffer of the blob is ever held in memory.
+fn write_blob(
+    blobs_dir: &Dir,
+    media_type: MediaType,
+    mut contents: impl Read,
+) -> Result<Descriptor> {
+    let tmp_name = format!(".tmp-{}", uuid::Uuid::new_v4());
+    let written = (|| {
+        let mut f = HashingWriter::new(BufWriter::with_capacity(
+            STREAM_BUF_SIZE,
+            blobs_dir
+                .create(&tmp_name)
+                .context("while creating blob file")?,
+        ));
+        std::io::copy(&mut contents, &mut f).context("while writing blob")?;
+        let (sha256, size) = f.finish().context("while flushing blob")?;
         blobs_dir
-            .create(&sha256)
-            .context("while creating blob file")?,
-    );
-    f.write_all(bytes.as_ref()).context("while writing blob")?;
+            .rename(&tmp_name, blobs_dir, &sha256)
+            .context("while moving blob into place")?;
+        anyhow::Ok((sha256, size))
+    })();
+    let (sha256, size) = match written {
+        Ok(w) => w,
+        Err(e) => {
+            let _ = blobs_dir.remove_file(&tmp_name);
+            return Err(e);
+        }
+    };
     DescriptorBuilder::default()
-        .media_type(O::MEDIA_TYPE)
+        .media_type(media_type)
         .digest(Sha256Digest::from_str(&sha256)?)
-        .size(bytes.as_ref().len() as u64)
+        .size(size)
         .build()
         .context("while building descriptor")
 }
 
+/// Take some OCI object, write it to the blobs dir and return a descriptor
+fn write<O: OciObject>(blobs_dir: &Dir, obj: &O) -> Result<Descriptor> {
+    let bytes = serde_json::to_vec_pretty(obj).context("while serializing object")?;
+    write_blob(blobs_dir, O::MEDIA_TYPE, bytes.as_slice())
+}
+
+/// Write the compressed layer blob and compute the layer's diff_id (the sha256
+/// of the uncompressed tar) concurrently.
+fn write_layer(blobs_dir: &Dir, delta: &Delta) -> Result<(Descriptor, String)> {
+    let (descriptor, diff_id) = rayon::join(
+        || {
+            let tar_zst = BufReader::with_capacity(
+                STREAM_BUF_SIZE,
+                File::open(&delta.tar_zst).context("while opening tar.zst")?,
+            );
+            write_blob(blobs_dir, MediaType::ImageLayerZstd, tar_zst).context("while writing layer")
+        },
+        || {
+            let mut uncompressed_tar = BufReader::with_capacity(
+                STREAM_BUF_SIZE,
+                File::open(&delta.tar).context("while opening uncompressed tar")?,
+            );
+            let mut hasher = Sha256::new();
+            std::io::copy(&mut uncompressed_tar, &mut hasher).context("while hashing tar")?;
+            anyhow::Ok(format!("sha256:{}", hex::encode(hasher.finalize())))
+        },
+    );
+    Ok((descriptor?, diff_id?))
+}
+
+/// Same as [write_layer], but reuse the blob from the cache if this exact
+/// delta has already been packaged before. Cache failures are never fatal.
+fn write_layer_cached(
+    blobs_dir: &Dir,
+    delta: &Delta,
+    cache: Option<&BlobCache>,
+) -> Result<(Descriptor, String)> {
+    let cache_and_key = cache.and_then(|cache| {
+        let key = BlobCache::key(
+            delta.child_subvol.as_deref()?,
+            delta.parent_subvol.as_deref(),
+            delta.build.as_ref()?,
+        )?;
+        Some((cache, key))
+    });
+    if let Some((cache, key)) = &cache_and_key {
+        match cache.get(key, blobs_dir) {
+            Ok(Some(hit)) => {
+                let descriptor = DescriptorBuilder::default()
+                    .media_type(MediaType::ImageLayerZstd)
+                    .digest(Sha256Digest::from_str(&hit.digest)?)
+                    .size(hit.size)
+                    .build()
+                    .context("while building descriptor")?;
+                return Ok((descriptor, hit.diff_id));
+            }
+            Ok(None) => {}
+            Err(e) => warn!("failed to look up layer in blob cache: {e:?}"),
+        }
+    }
+    let (descriptor, diff_id) = write_layer(blobs_dir, delta)?;
+    if let Some((cache, key)) = &cache_and_key {
+        let layer = CachedLayer {
+            digest: descriptor.digest().digest().to_owned(),
+            size: descriptor.size(),
+            diff_id: diff_id.clone(),
+        };
+        if let Err(e) = cache.insert(key, &layer, blobs_dir) {
+            warn!("failed to add layer to blob cache: {e:?}");
+        }
+    }
+    Ok((descriptor, diff_id))
+}
+
 impl Oci {
     pub(crate) fn build(&self, out: &Path) -> Result<()> {
         std::fs::create_dir_all(out).context("while creating output directory")?;
@@ -141,26 +270,31 @@ impl Oci {
             .build()
             .context("while building platform")?;
 
-        let mut layer_descriptors = Vec::new();
-        let mut rootfs_digest_chain = Vec::new();
-        for delta in &self.deltas {
-            let mut tar_zst = Vec::new();
-            BufReader::new(File::open(&delta.tar_zst).context("while opening tar.zst")?)
-                .read_to_end(&mut tar_zst)
-                .context("while reading tar zst")?;
-            let tar_layer = LayerTarZst(Arc::new(tar_zst));
-            let mut layer_descriptor =
-                write(&blobs_dir, &tar_layer).context("while writing layer")?;
-            layer_descriptor.set_platform(Some(platform.clone()));
-            layer_descriptors.push(layer_descriptor);
-
-            let mut uncompressed_tar =
-                BufReader::new(File::open(&delta.tar).context("while opening uncompressed tar")?);
-            let mut hasher = Sha256::new();
-            std::io::copy(&mut uncompressed_tar, &mut hasher).context("while hashing tar")?;
-            let layer_hash = hex::encode(hasher.finalize());
-            rootfs_digest_chain.push(format!("sha256:{layer_hash}"));
+        let cache = match self.blob_cache_max_bytes {
+            0 => None,
+            max_bytes => BlobCache::open(max_bytes)
+                .inspect_err(|e| warn!("blob cache unavailable: {e:?}"))
+                .ok(),
+        };
+        // every layer (and its diff_id) is hashed independently, so spread
+        // them out across all the cores
+        let layers: Vec<(Descriptor, String)> = self
+            .deltas
+            .par_iter()
+            .map(|delta| write_layer_cached(&blobs_dir, delta, cache.as_ref()))
+            .collect::<Result<_>>()?;
+        if let Some(cache) = &cache {
+            if let Err(e) = cache.evict() {
+                warn!("failed to evict from blob cache: {e:?}");
+            }
         }
+        let (layer_descriptors, rootfs_digest_chain): (Vec<_>, Vec<_>) = layers
+            .into_iter()
+            .map(|(mut descriptor, diff_id)| {
+                descriptor.set_platform(Some(platform.clone()));
+                (descriptor, diff_id)
+            })
+            .unzip();
 
         let image_configuration = ImageConfigurationBuilder::default()
             .architecture(self.target_arch.clone())
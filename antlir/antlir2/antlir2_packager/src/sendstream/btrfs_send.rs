@@ -128,6 +128,9 @@ pub(super) fn build(spec: &Sendstream, out: &Path, layer: &Path) -> Result<()> {
     let _ = std::fs::remove_file(&out_subvol_symlink);
     std::os::unix::fs::symlink(subvol.path(), &out_subvol_symlink)
         .context("while symlinking packaged subvol")?;
+    if let Err(e) = working_volume.record_reference(subvol.path(), &out_subvol_symlink) {
+        warn!("failed to record reference to subvol: {e:#?}");
+    }
 
     Ok(())
 }
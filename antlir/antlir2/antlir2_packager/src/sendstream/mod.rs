@@ -23,12 +23,22 @@ pub struct Sendstream {
     incremental_parent: Option<PathBuf>,
     subvol_symlink: Option<PathBuf>,
     userspace: bool,
+    /// Directly produce a v2 sendstream with file contents compressed with
+    /// zstd at this level (userspace only)
+    #[serde(default)]
+    zstd_level: Option<i32>,
 }
 
 impl PackageFormat for Sendstream {
     fn build(&self, out: &Path, layer: &Path) -> Result<()> {
         match self.userspace {
-            false => btrfs_send::build(self, out, layer),
+            false => {
+                anyhow::ensure!(
+                    self.zstd_level.is_none(),
+                    "zstd_level is only supported by the userspace sendstream writer"
+                );
+                btrfs_send::build(self, out, layer)
+            }
             true => userspace::build(self, out, layer),
         }
     }
@@ -111,6 +111,49 @@ where
         .finish()
 }
 
+/// Write command for a v2 sendstream, see [CommandBuilder::data_v2]
+pub(crate) fn write_v2<P>(path: P, offset: u64, data: &[u8]) -> Vec<u8>
+where
+    P: AsRef<Path>,
+{
+    CommandBuilder::new(15)
+        .tlv(&Tlv::Path(path.as_ref()))
+        .tlv(&Tlv::FileOffset(offset))
+        .data_v2(data)
+        .finish()
+}
+
+/// Write of an already compressed extent (v2 only). The receiver can write
+/// the compressed data to disk as-is, or decompress it if it cannot.
+pub(crate) fn encoded_write<P>(
+    path: P,
+    offset: u64,
+    unencoded_len: u64,
+    compression: Compression,
+    data: &[u8],
+) -> Vec<u8>
+where
+    P: AsRef<Path>,
+{
+    CommandBuilder::new(25)
+        .tlv(&Tlv::Path(path.as_ref()))
+        .tlv(&Tlv::FileOffset(offset))
+        .tlv(&Tlv::UnencodedFileLen(unencoded_len))
+        .tlv(&Tlv::UnencodedLen(unencoded_len))
+        .tlv(&Tlv::UnencodedOffset(0))
+        .tlv(&Tlv::Compression(compression as u32))
+        .tlv(&Tlv::Encryption(0))
+        .data_v2(data)
+        .finish()
+}
+
+/// Values of BTRFS_ENCODED_IO_COMPRESSION_*
+#[derive(Debug, Copy, Clone)]
+#[repr(u32)]
+pub(crate) enum Compression {
+    Zstd = 2,
+}
+
 pub(crate) fn hardlink<P1, P2>(original: P1, link: P2) -> Vec<u8>
 where
     P1: AsRef<Path>,
@@ -0,0 +1,275 @@
+/*
+ * Copyright (c) Meta Platforms, Inc. and affiliates.
+ *
+ * This source code is licensed under the MIT license found in the
+ * LICENSE file in the root directory of this source tree.
+ */
+
+//! Reading file contents and encoding them into write commands is by far the
+//! most expensive part of writing a sendstream, so instead of doing it inline
+//! while walking the layer, [OrderedWriter] queues up the contents of files
+//! (split into fixed size pieces) between the already-encoded metadata
+//! commands and encodes a window of them at a time on the rayon pool. The
+//! encoded pieces are written out in the same order that they were queued in,
+//! and since the piece boundaries only depend on the file sizes, the output
+//! does not depend on how many threads are used.
+
+use std::fs::File;
+use std::io::Write;
+use std::os::unix::fs::FileExt;
+use std::path::Path;
+use std::path::PathBuf;
+
+use anyhow::Context;
+use anyhow::Result;
+use rayon::prelude::*;
+
+use super::command;
+
+/// 60k because we need a little bit of space to to store metadata (so can't
+/// use a full 16-bit size), and 4k boundaries are nice
+const WRITE_SIZE: usize = 61440;
+/// The largest extent that btrfs will compress
+const ENCODED_WRITE_SIZE: usize = 128 << 10;
+const SECTOR_SIZE: usize = 4096;
+/// Files are split into pieces of this size, which is a multiple of both
+/// WRITE_SIZE and ENCODED_WRITE_SIZE so that the commands are the same as if
+/// the whole file had been encoded at once
+const PIECE_SIZE: u64 = (WRITE_SIZE * 128) as u64;
+/// How many bytes of file contents to queue up before encoding them
+const WINDOW_SIZE: u64 = 64 << 20;
+
+#[derive(Debug, Copy, Clone, PartialEq, Eq)]
+pub(crate) enum Encoding {
+    /// v1 write commands
+    Plain,
+    /// v2 encoded writes of zstd-compressed extents at this level, falling
+    /// back to v2 write commands for data that does not compress
+    Zstd(i32),
+}
+
+enum Segment {
+    Encoded(Vec<u8>),
+    Contents {
+        src: PathBuf,
+        relpath: PathBuf,
+        offset: u64,
+        len: u64,
+    },
+}
+
+/// [Write] implementation for sendstream commands, that can also be given the
+/// contents of a file to encode in parallel (see module docs).
+/// [OrderedWriter::finish] must be called to write out everything that is
+/// still queued.
+pub(crate) struct OrderedWriter<W: Write> {
+    inner: W,
+    encoding: Encoding,
+    queue: Vec<Segment>,
+    queued_bytes: u64,
+}
+
+impl<W: Write> OrderedWriter<W> {
+    pub(crate) fn new(inner: W, encoding: Encoding) -> Self {
+        Self {
+            inner,
+            encoding,
+            queue: Vec::new(),
+            queued_bytes: 0,
+        }
+    }
+
+    /// Queue up write commands for the first `len` bytes of `src`, which will
+    /// be written to `relpath` by the receiver
+    pub(crate) fn write_contents(&mut self, src: &Path, relpath: &Path, len: u64) -> Result<()> {
+        let mut offset = 0;
+        while offset < len {
+            let piece = (len - offset).min(PIECE_SIZE);
+            self.queue.push(Segment::Contents {
+                src: src.to_owned(),
+                relpath: relpath.to_owned(),
+                offset,
+                len: piece,
+            });
+            offset += piece;
+            self.queued_bytes += piece;
+            if self.queued_bytes >= WINDOW_SIZE {
+                self.drain()?;
+            }
+        }
+        Ok(())
+    }
+
+    /// Encode everything in the queue and write it out in order
+    fn drain(&mut self) -> Result<()> {
+        let encoding = self.encoding;
+        let encoded = std::mem::take(&mut self.queue)
+            .into_par_iter()
+            .map(|segment| match segment {
+                Segment::Encoded(buf) => Ok(buf),
+                Segment::Contents {
+                    src,
+                    relpath,
+                    offset,
+                    len,
+                } => encode_contents(&src, &relpath, offset, len, encoding),
+            })
+            .collect::<Result<Vec<_>>>()?;
+        self.queued_bytes = 0;
+        for buf in encoded {
+            self.inner.write_all(&buf)?;
+        }
+        Ok(())
+    }
+
+    pub(crate) fn finish(mut self) -> Result<W> {
+        self.drain()?;
+        Ok(self.inner)
+    }
+}
+
+impl<W: Write> Write for OrderedWriter<W> {
+    fn write(&mut self, buf: &[u8]) -> std::io::Result<usize> {
+        if self.queue.is_empty() {
+            // nothing is waiting to be encoded, so there is no need to buffer
+            return self.inner.write(buf);
+        }
+        match self.queue.last_mut() {
+            Some(Segment::Encoded(last)) => last.extend_from_slice(buf),
+            _ => self.queue.push(Segment::Encoded(buf.to_vec())),
+        }
+        Ok(buf.len())
+    }
+
+    fn flush(&mut self) -> std::io::Result<()> {
+        self.drain().map_err(std::io::Error::other)?;
+        self.inner.flush()
+    }
+}
+
+fn encode_contents(
+    src: &Path,
+    relpath: &Path,
+    offset: u64,
+    len: u64,
+    encoding: Encoding,
+) -> Result<Vec<u8>> {
+    let mut data = vec![0; len as usize];
+    File::open(src)
+        .and_then(|f| f.read_exact_at(&mut data, offset))
+        .with_context(|| format!("while reading from file {}", src.display()))?;
+    let mut out = Vec::with_capacity(data.len() + data.len() / 64);
+    match encoding {
+        Encoding::Plain => {
+            for (i, chunk) in data.chunks(WRITE_SIZE).enumerate() {
+                out.extend(command::write(
+                    relpath,
+                    offset + (i * WRITE_SIZE) as u64,
+                    chunk,
+                ));
+            }
+        }
+        Encoding::Zstd(level) => {
+            for (i, chunk) in data.chunks(ENCODED_WRITE_SIZE).enumerate() {
+                let chunk_offset = offset + (i * ENCODED_WRITE_SIZE) as u64;
+                // a partial sector at the end of the file is not worth the
+                // trouble, and the receiver must write it normally anyway
+                let compressed = if chunk.len() % SECTOR_SIZE == 0 {
+                    Some(zstd::bulk::compress(chunk, level).with_context(|| {
+                        format!("while compressing data from {}", src.display())
+                    })?)
+                } else {
+                    None
+                };
+                match compressed {
+                    // like the kernel, only keep compressed extents that save
+                    // at least one sector on disk
+                    Some(compressed)
+                        if compressed.len().next_multiple_of(SECTOR_SIZE) < chunk.len() =>
+                    {
+                        out.extend(command::encoded_write(
+                            relpath,
+                            chunk_offset,
+                            chunk.len() as u64,
+                            command::Compression::Zstd,
+                            &compressed,
+                        ));
+                    }
+                    _ => out.extend(command::write_v2(relpath, chunk_offset, chunk)),
+                }
+            }
+        }
+    }
+    Ok(out)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn write_file(path: &Path, len: usize) {
+        std::fs::write(
+            path,
+            (0..len)
+                .map(|i| if i % 5 == 0 { (i / 7) as u8 } else { b'a' })
+                .collect::<Vec<_>>(),
+        )
+        .expect("failed to write file");
+    }
+
+    #[test]
+    fn same_as_inline() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let big = tmp.path().join("big");
+        let small = tmp.path().join("small");
+        write_file(&big, PIECE_SIZE as usize * 2 + 12345);
+        write_file(&small, 100);
+
+        let mut w = OrderedWriter::new(Vec::new(), Encoding::Plain);
+        w.write_all(b"header").expect("failed to write");
+        w.write_contents(&big, Path::new("big"), PIECE_SIZE * 2 + 12345)
+            .expect("failed to queue");
+        w.write_all(b"middle").expect("failed to write");
+        w.write_contents(&small, Path::new("small"), 100)
+            .expect("failed to queue");
+        w.write_all(b"end").expect("failed to write");
+        let actual = w.finish().expect("failed to finish");
+
+        let mut expected = b"header".to_vec();
+        let big_data = std::fs::read(&big).expect("failed to read");
+        for (i, chunk) in big_data.chunks(WRITE_SIZE).enumerate() {
+            expected.extend(command::write("big", (i * WRITE_SIZE) as u64, chunk));
+        }
+        expected.extend(b"middle");
+        expected.extend(command::write(
+            "small",
+            0,
+            &std::fs::read(&small).expect("failed to read"),
+        ));
+        expected.extend(b"end");
+        assert!(actual == expected);
+    }
+
+    #[test]
+    fn zstd_encoded_writes() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let file = tmp.path().join("file");
+        let len = ENCODED_WRITE_SIZE * 3 + 100;
+        write_file(&file, len);
+        let mut w = OrderedWriter::new(Vec::new(), Encoding::Zstd(3));
+        w.write_contents(&file, Path::new("file"), len as u64)
+            .expect("failed to queue");
+        let out = w.finish().expect("failed to finish");
+        // the three full extents are compressible, the tail is written as-is
+        assert!(out.len() < len / 2, "{}", out.len());
+
+        let mut cmds = Vec::new();
+        let mut buf = out.as_slice();
+        while !buf.is_empty() {
+            let cmd_len = u32::from_le_bytes(buf[..4].try_into().expect("4 bytes")) as usize;
+            cmds.push(u16::from_le_bytes([buf[4], buf[5]]));
+            buf = &buf[10 + cmd_len..];
+        }
+        assert_eq!(cmds, vec![25, 25, 25, 15]);
+    }
+}
@@ -11,7 +11,6 @@ use std::ffi::OsString;
 use std::fs::File;
 use std::io::BufReader;
 use std::io::BufWriter;
-use std::io::Read;
 use std::io::Write;
 use std::os::unix::ffi::OsStrExt;
 use std::os::unix::fs::FileTypeExt;
@@ -31,8 +30,11 @@ use uuid::Uuid;
 use walkdir::DirEntryExt;
 use walkdir::WalkDir;
 
+use self::contents::Encoding;
+use self::contents::OrderedWriter;
 use super::Sendstream;
 mod command;
+mod contents;
 mod tlv;
 mod writer;
 
@@ -42,13 +44,25 @@ pub(super) fn build(spec: &Sendstream, out: &Path, layer: &Path) -> Result<()> {
     let rootless = antlir2_rootless::init().context("while initializing rootless")?;
     let canonical_layer = layer.canonicalize()?;
 
-    let mut f = BufWriter::new(File::create(out).context("while creating output file")?);
+    let encoding = match spec.zstd_level {
+        Some(level) => Encoding::Zstd(level),
+        None => Encoding::Plain,
+    };
+    let mut f = OrderedWriter::new(
+        BufWriter::new(File::create(out).context("while creating output file")?),
+        encoding,
+    );
 
-    // Write the magic sentinel and version number. This packager always
+    // Write the magic sentinel and version number. By default, this packager
     // produces uncompressed v1 sendstreams, and lets the sendstream-upgrade
-    // command upgrade it to v2
+    // command upgrade it to v2. When zstd is requested, it directly produces a
+    // v2 sendstream with compressed encoded writes instead.
     f.write_all(b"btrfs-stream\0")?;
-    f.write_all(&1u32.to_le_bytes())?;
+    let version: u32 = match encoding {
+        Encoding::Plain => 1,
+        Encoding::Zstd(_) => 2,
+    };
+    f.write_all(&version.to_le_bytes())?;
 
     let _root = rootless.escalate()?;
 
@@ -219,25 +233,7 @@ pub(super) fn build(spec: &Sendstream, out: &Path, layer: &Path) -> Result<()> {
                             // append-only files (where len > parent_len but
                             // hash(parent[..parent_len]) == hash(file[..parent_len]))
                             f.write_all(&command::truncate(relpath, meta.size()))?;
-                            let mut infile =
-                                BufReader::new(File::open(entry.path()).with_context(|| {
-                                    format!("while opening file {}", entry.path().display())
-                                })?);
-                            // 60k because we need a little bit of space to to store
-                            // metadata (so can't use a full 16-bit size), and 4k
-                            // boundaries are nice
-                            let mut buf = [0u8; 61440];
-                            let mut offset = 0;
-                            loop {
-                                let read = infile.read(&mut buf).with_context(|| {
-                                    format!("1while reading from file {}", entry.path().display())
-                                })?;
-                                if read == 0 {
-                                    break;
-                                }
-                                f.write_all(&command::write(relpath, offset, &buf[..read]))?;
-                                offset += read as u64;
-                            }
+                            f.write_contents(entry.path(), relpath, meta.len())?;
                         }
                     }
 
@@ -319,25 +315,7 @@ pub(super) fn build(spec: &Sendstream, out: &Path, layer: &Path) -> Result<()> {
                     f.write_all(&command::mksock(relpath, entry.ino()))?;
                 } else {
                     f.write_all(&command::mkfile(relpath, entry.ino()))?;
-                    let mut infile =
-                        BufReader::new(File::open(entry.path()).with_context(|| {
-                            format!("while opening file {}", entry.path().display())
-                        })?);
-                    // 60k because we need a little bit of space to to store
-                    // metadata (so can't use a full 16-bit size), and 4k
-                    // boundaries are nice
-                    let mut buf = [0u8; 61440];
-                    let mut offset = 0;
-                    loop {
-                        let read = infile.read(&mut buf).with_context(|| {
-                            format!("while reading from file {}", entry.path().display())
-                        })?;
-                        if read == 0 {
-                            break;
-                        }
-                        f.write_all(&command::write(relpath, offset, &buf[..read]))?;
-                        offset += read as u64;
-                    }
+                    f.write_contents(entry.path(), relpath, meta.len())?;
                 }
             } else {
                 anyhow::bail!("exactly one of is_dir, is_symlink, is_file must be true");
@@ -379,6 +357,7 @@ pub(super) fn build(spec: &Sendstream, out: &Path, layer: &Path) -> Result<()> {
     }
 
     f.write_all(&command::end())?;
+    let mut f = f.finish().context("while writing file contents")?;
     f.flush().context("while flushing BufWriter")?;
     f.into_inner()
         .context("while dropping BufWriter")?
@@ -411,3 +390,60 @@ fn get_xattrs(path: &Path) -> Result<HashMap<OsString, Vec<u8>>> {
     }
     Ok(xattrs)
 }
+
+#[cfg(test)]
+mod tests {
+    use std::process::Command;
+    use std::time::Instant;
+
+    use super::*;
+
+    fn report(name: &str, out: &Path, start: Instant) {
+        let elapsed = start.elapsed();
+        let len = std::fs::metadata(out).expect("failed to stat output").len();
+        eprintln!(
+            "{name}: {len} bytes in {elapsed:?} ({:.1} MB/s)",
+            len as f64 / elapsed.as_secs_f64() / 1e6
+        );
+    }
+
+    /// Compare `btrfs send` with the userspace writer on the same layer. This
+    /// needs root and a readonly subvolume to send, so it only runs when asked
+    /// to with --ignored and ANTLIR2_SENDSTREAM_BENCH_LAYER set to a layer.
+    #[test]
+    #[ignore]
+    fn bench_kernel_vs_userspace() {
+        let layer = PathBuf::from(
+            std::env::var_os("ANTLIR2_SENDSTREAM_BENCH_LAYER")
+                .expect("ANTLIR2_SENDSTREAM_BENCH_LAYER must be set"),
+        );
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+
+        let out = tmp.path().join("kernel.sendstream");
+        let start = Instant::now();
+        let status = Command::new("btrfs")
+            .arg("send")
+            .arg("-q")
+            .arg("-f")
+            .arg(&out)
+            .arg(&layer)
+            .status()
+            .expect("failed to run btrfs-send");
+        assert!(status.success(), "btrfs-send failed");
+        report("btrfs send", &out, start);
+
+        for zstd_level in [None, Some(3)] {
+            let spec = Sendstream {
+                volume_name: "bench".to_owned(),
+                incremental_parent: None,
+                subvol_symlink: None,
+                userspace: true,
+                zstd_level,
+            };
+            let out = tmp.path().join("userspace.sendstream");
+            let start = Instant::now();
+            build(&spec, &out, &layer).expect("failed to build sendstream");
+            report(&format!("userspace (zstd={zstd_level:?})"), &out, start);
+        }
+    }
+}
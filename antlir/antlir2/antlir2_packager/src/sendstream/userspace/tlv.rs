@@ -32,11 +32,18 @@ pub(crate) enum Tlv<'a> {
     Atime(SystemTime),
     Mtime(SystemTime),
     Ctime(SystemTime),
+    // v2 only
+    UnencodedFileLen(u64),
+    UnencodedLen(u64),
+    UnencodedOffset(u64),
+    Compression(u32),
+    Encryption(u32),
 }
 
 pub(crate) enum TlvData<'a> {
     Bytes(&'a [u8]),
     U64([u8; 8]),
+    U32([u8; 4]),
     Timespec(Vec<u8>),
 }
 
@@ -45,6 +52,7 @@ impl<'a> AsRef<[u8]> for TlvData<'a> {
         match self {
             Self::Bytes(v) => v,
             Self::U64(v) => v.as_ref(),
+            Self::U32(v) => v.as_ref(),
             Self::Timespec(v) => v,
         }
     }
@@ -73,6 +81,11 @@ impl Tlv<'_> {
             Self::Ctime(_) => 9,
             Self::Mtime(_) => 10,
             Self::Atime(_) => 11,
+            Self::UnencodedFileLen(_) => 27,
+            Self::UnencodedLen(_) => 28,
+            Self::UnencodedOffset(_) => 29,
+            Self::Compression(_) => 30,
+            Self::Encryption(_) => 31,
         }
     }
 
@@ -87,7 +100,11 @@ impl Tlv<'_> {
             | Self::Gid(_)
             | Self::Rdev(_)
             | Self::FileOffset(_)
-            | Self::CloneCtransid(_) => 8,
+            | Self::CloneCtransid(_)
+            | Self::UnencodedFileLen(_)
+            | Self::UnencodedLen(_)
+            | Self::UnencodedOffset(_) => 8,
+            Self::Compression(_) | Self::Encryption(_) => 4,
             Self::XattrName(x) | Self::XattrData(x) => x.len() as u16,
             Self::Path(p) | Self::PathTo(p) | Self::PathLink(p) => p.as_os_str().len() as u16,
             Self::Data(v) => v.len() as u16,
@@ -106,7 +123,11 @@ impl Tlv<'_> {
             | Self::Gid(v)
             | Self::Rdev(v)
             | Self::FileOffset(v)
-            | Self::CloneCtransid(v) => TlvData::U64(v.to_le_bytes()),
+            | Self::CloneCtransid(v)
+            | Self::UnencodedFileLen(v)
+            | Self::UnencodedLen(v)
+            | Self::UnencodedOffset(v) => TlvData::U64(v.to_le_bytes()),
+            Self::Compression(v) | Self::Encryption(v) => TlvData::U32(v.to_le_bytes()),
             Self::XattrName(x) | Self::XattrData(x) => TlvData::Bytes(x),
             Self::Path(p) | Self::PathTo(p) | Self::PathLink(p) => {
                 TlvData::Bytes(p.as_os_str().as_bytes())
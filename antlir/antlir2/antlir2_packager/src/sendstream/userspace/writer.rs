@@ -40,6 +40,16 @@ impl CommandBuilder {
         self.buf.extend_from_slice(tlv.data().as_ref());
         self
     }
+
+    /// In v2 sendstreams, the data attribute is always the last one and has
+    /// no length, it just extends to the end of the command (so that it can
+    /// be larger than 64k).
+    pub(crate) fn data_v2(mut self, data: &[u8]) -> Self {
+        self.buf
+            .extend_from_slice(&Tlv::Data(&[]).ty().to_le_bytes());
+        self.buf.extend_from_slice(data);
+        self
+    }
 }
 
 #[cfg(test)]
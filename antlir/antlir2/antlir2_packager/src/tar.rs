@@ -5,69 +5,604 @@
  * LICENSE file in the root directory of this source tree.
  */
 
+use std::collections::BTreeMap;
+use std::collections::HashMap;
 use std::fs::File;
+use std::fs::Metadata;
+use std::io::BufWriter;
+use std::io::Read;
+use std::io::Write;
+use std::os::fd::AsRawFd;
+use std::os::unix::ffi::OsStrExt;
+use std::os::unix::fs::FileExt;
+use std::os::unix::fs::MetadataExt;
 use std::path::Path;
-use std::path::PathBuf;
-use std::process::Stdio;
 
-use antlir2_isolate::IsolationContext;
-use antlir2_isolate::unshare;
 use anyhow::Context;
 use anyhow::Result;
+use nix::errno::Errno;
+use nix::unistd::Whence;
+use nix::unistd::lseek;
 use serde::Deserialize;
+use tar::Builder;
+use tar::EntryType;
+use tar::Header;
+use tar::HeaderMode;
+use walkdir::WalkDir;
 
-use crate::BuildAppliance;
 use crate::PackageFormat;
-use crate::run_cmd;
 
 #[derive(Debug, Clone, Deserialize)]
 #[serde(deny_unknown_fields)]
 pub struct Tar {
-    build_appliance: BuildAppliance,
     preserve_xattrs: bool,
 }
 
 impl PackageFormat for Tar {
     fn build(&self, out: &Path, layer: &Path) -> Result<()> {
-        File::create(out).context("failed to create output file")?;
-
-        let isol_context = IsolationContext::builder(self.build_appliance.path())
-            .ephemeral(false)
-            .readonly()
-            .tmpfs(Path::new("/__antlir2__/out"))
-            .outputs(("/__antlir2__/out/tar", out))
-            .inputs((Path::new("/__antlir2__/root"), layer))
-            .inputs((
-                PathBuf::from("/__antlir2__/working_directory"),
-                std::env::current_dir()?,
-            ))
-            .working_directory(Path::new("/__antlir2__/working_directory"))
-            .build();
-
-        let mut tar_cmd = unshare(isol_context)?.command("tar")?;
-        tar_cmd
-            .arg("--sparse")
-            .arg("--one-file-system")
-            .arg("--acls")
-            // Sorted by name to ensure reproducibility, as well as
-            // predictable ordering when the tar is read as a byte stream.
-            // Some use cases require consumption of tar's contents with a
-            // known ordering, such as when the tar contains incremental
-            // btrfs snapshots that may be opportunistically skipped.
-            .arg("--sort=name")
-            .arg("-C")
-            .arg("/__antlir2__/root")
-            .arg("-c")
-            .arg("-f")
-            .arg("/__antlir2__/out/tar")
-            .arg(".")
-            .stdout(Stdio::piped());
-        if self.preserve_xattrs {
-            tar_cmd.arg("--xattrs");
-        };
+        let layer = layer.canonicalize().context("while resolving layer")?;
+        let out = BufWriter::with_capacity(
+            1 << 20,
+            File::create(out).context("failed to create output file")?,
+        );
+        let mut builder = Builder::new(out);
+        self.append_tree(&mut builder, &layer)
+            .context("Failed to build tar")?;
+        builder
+            .into_inner()
+            .context("while finishing tar")?
+            .flush()
+            .context("while flushing tar")?;
+        Ok(())
+    }
+}
 
-        run_cmd(&mut tar_cmd).context("Failed to build tar")?;
+impl Tar {
+    fn append_tree<W: Write>(&self, builder: &mut Builder<W>, root: &Path) -> Result<()> {
+        // the first member name seen for each inode with multiple links
+        let mut hardlinks: HashMap<(u64, u64), Vec<u8>> = HashMap::new();
+        // Sorted by name to ensure reproducibility, as well as predictable
+        // ordering when the tar is read as a byte stream. Some use cases
+        // require consumption of tar's contents with a known ordering, such
+        // as when the tar contains incremental btrfs snapshots that may be
+        // opportunistically skipped. This is the same order as GNU tar's
+        // --sort=name: each directory is immediately followed by its
+        // (recursive) contents in bytewise order.
+        for entry in WalkDir::new(root)
+            .sort_by_file_name()
+            .same_file_system(true)
+        {
+            let entry = entry?;
+            let relpath = entry.path().strip_prefix(root)?;
+            let ft = entry.file_type();
+            if std::os::unix::fs::FileTypeExt::is_socket(&ft) {
+                // sockets cannot be archived, GNU tar skips them too
+                continue;
+            }
+            let name = member_name(relpath, ft.is_dir());
+            let meta = entry
+                .metadata()
+                .with_context(|| format!("while statting {}", entry.path().display()))?;
 
+            let mut header = Header::new_gnu();
+            header.set_metadata_in_mode(&meta, HeaderMode::Complete);
+
+            builder.append_pax_extensions(
+                self.pax_extensions(entry.path())
+                    .with_context(|| format!("while reading xattrs of {}", relpath.display()))?
+                    .iter()
+                    .map(|(k, v)| (k.as_str(), v.as_slice())),
+            )?;
+
+            if ft.is_symlink() {
+                let target = std::fs::read_link(entry.path())?;
+                append_named(
+                    builder,
+                    &mut header,
+                    &name,
+                    Some(target.as_os_str().as_bytes()),
+                    std::io::empty(),
+                )?;
+            } else if ft.is_file() {
+                if meta.nlink() > 1 {
+                    if let Some(first) = hardlinks.get(&(meta.dev(), meta.ino())) {
+                        header.set_entry_type(EntryType::Link);
+                        header.set_size(0);
+                        append_named(builder, &mut header, &name, Some(first), std::io::empty())?;
+                        continue;
+                    }
+                    hardlinks.insert((meta.dev(), meta.ino()), name.clone());
+                }
+                let f = File::open(entry.path())
+                    .with_context(|| format!("while opening {}", entry.path().display()))?;
+                // like GNU tar --sparse, only store the data of files with holes
+                match sparse_regions(&f, &meta)
+                    .with_context(|| format!("while finding holes in {}", relpath.display()))?
+                {
+                    Some(regions) => {
+                        append_sparse(builder, &mut header, &name, f, &regions, meta.size())
+                    }
+                    None => append_named(builder, &mut header, &name, None, f),
+                }
+                .with_context(|| format!("while archiving {}", relpath.display()))?;
+            } else {
+                // directories, fifos and device nodes have no contents
+                append_named(builder, &mut header, &name, None, std::io::empty())?;
+            }
+        }
         Ok(())
     }
+
+    /// PAX records for the ACLs (always) and other xattrs (if requested) of a
+    /// file, in the same format as GNU tar's --acls and --xattrs.
+    fn pax_extensions(&self, path: &Path) -> Result<BTreeMap<String, Vec<u8>>> {
+        let mut extensions = BTreeMap::new();
+        for name in xattr::list(path)? {
+            let Some(value) = xattr::get(path, &name)? else {
+                continue;
+            };
+            let name = name
+                .to_str()
+                .with_context(|| format!("xattr name '{name:?}' is not valid UTF-8"))?;
+            match name {
+                "system.posix_acl_access" => {
+                    extensions.insert("SCHILY.acl.access".to_owned(), acl_to_text(&value)?);
+                }
+                "system.posix_acl_default" => {
+                    extensions.insert("SCHILY.acl.default".to_owned(), acl_to_text(&value)?);
+                }
+                _ if self.preserve_xattrs => {
+                    extensions.insert(format!("SCHILY.xattr.{name}"), value);
+                }
+                _ => {}
+            }
+        }
+        Ok(extensions)
+    }
+}
+
+/// The member name that GNU tar gives to `relpath` when archiving `tar -C root
+/// -c .`: `./` for the root itself, `./`-prefixed paths for everything else
+/// and a trailing `/` for directories.
+fn member_name(relpath: &Path, is_dir: bool) -> Vec<u8> {
+    let mut name = b"./".to_vec();
+    if relpath != Path::new("") {
+        name.extend_from_slice(relpath.as_os_str().as_bytes());
+        if is_dir {
+            name.push(b'/');
+        }
+    }
+    name
+}
+
+/// Append an entry with exactly this member (and link) name. The tar crate's
+/// own `append_data`/`append_link` normalize names, dropping the `./` prefix
+/// and trailing `/` that GNU tar writes, so names that do not fit in the
+/// header are written as GNU long name records here instead.
+fn append_named<W: Write>(
+    builder: &mut Builder<W>,
+    header: &mut Header,
+    name: &[u8],
+    link_name: Option<&[u8]>,
+    data: impl Read,
+) -> Result<()> {
+    let old = header.as_old_mut();
+    if name.len() > old.name.len() {
+        append_long_name(builder, EntryType::GNULongName, name)?;
+    }
+    old.name.fill(0);
+    let len = name.len().min(old.name.len());
+    old.name[..len].copy_from_slice(&name[..len]);
+    if let Some(link_name) = link_name {
+        if link_name.len() > old.linkname.len() {
+            append_long_name(builder, EntryType::GNULongLink, link_name)?;
+        }
+        let old = header.as_old_mut();
+        old.linkname.fill(0);
+        let len = link_name.len().min(old.linkname.len());
+        old.linkname[..len].copy_from_slice(&link_name[..len]);
+    }
+    header.set_cksum();
+    builder.append(header, data)?;
+    Ok(())
+}
+
+fn append_long_name<W: Write>(
+    builder: &mut Builder<W>,
+    kind: EntryType,
+    name: &[u8],
+) -> Result<()> {
+    // this is what GNU tar (and the tar crate) write
+    let mut header = Header::new_gnu();
+    let long_link = b"././@LongLink";
+    header.as_old_mut().name[..long_link.len()].copy_from_slice(long_link);
+    header.set_mode(0o644);
+    header.set_uid(0);
+    header.set_gid(0);
+    header.set_mtime(0);
+    // + 1 for the trailing nul, like GNU tar
+    header.set_size(name.len() as u64 + 1);
+    header.set_entry_type(kind);
+    header.set_cksum();
+    builder.append(&header, name.chain(&[0u8][..]))?;
+    Ok(())
+}
+
+/// The data regions of a file as (offset, length) pairs, or `None` if it has
+/// no holes. Like GNU tar, only files with fewer blocks allocated than their
+/// size needs are searched for holes, and a file that ends in a hole gets an
+/// empty region at its end so that its size is restored on extraction.
+fn sparse_regions(f: &File, meta: &Metadata) -> Result<Option<Vec<(u64, u64)>>> {
+    let size = meta.size();
+    if size == 0 || meta.blocks() * 512 >= size {
+        return Ok(None);
+    }
+    let fd = f.as_raw_fd();
+    let mut regions = Vec::new();
+    let mut offset = 0;
+    while offset < size {
+        let start = match lseek(fd, offset as i64, Whence::SeekData) {
+            Ok(start) => start as u64,
+            // the rest of the file is a hole
+            Err(Errno::ENXIO) => break,
+            // the filesystem does not support finding holes
+            Err(Errno::EINVAL) if offset == 0 => return Ok(None),
+            Err(e) => return Err(e.into()),
+        };
+        let end = (lseek(fd, start as i64, Whence::SeekHole)? as u64).min(size);
+        regions.push((start, end - start));
+        offset = end;
+    }
+    // for example compressed extents, which take fewer blocks without holes
+    if regions == [(0, size)] {
+        return Ok(None);
+    }
+    if regions
+        .last()
+        .is_none_or(|(offset, len)| offset + len < size)
+    {
+        regions.push((size, 0));
+    }
+    Ok(Some(regions))
+}
+
+/// Append a file with holes as a GNU sparse entry (what GNU tar --sparse
+/// writes in its default format): the header stores the first 4 regions,
+/// extended sparse headers of 21 regions each follow it, and only the data
+/// of the regions is stored after that.
+fn append_sparse<W: Write>(
+    builder: &mut Builder<W>,
+    header: &mut Header,
+    name: &[u8],
+    f: File,
+    regions: &[(u64, u64)],
+    size: u64,
+) -> Result<()> {
+    header.set_entry_type(EntryType::GNUSparse);
+    header.set_size(regions.iter().map(|(_, len)| len).sum());
+    let gnu = header
+        .as_gnu_mut()
+        .context("sparse entries need a GNU header")?;
+    numeric_field(&mut gnu.realsize, size);
+    let (inline, extended) = regions.split_at(regions.len().min(gnu.sparse.len()));
+    for (entry, (offset, len)) in gnu.sparse.iter_mut().zip(inline) {
+        numeric_field(&mut entry.offset, *offset);
+        numeric_field(&mut entry.numbytes, *len);
+    }
+    gnu.isextended[0] = u8::from(!extended.is_empty());
+
+    // The tar crate has no notion of the extended headers, so they are
+    // written as the start of the entry's data, which they are block
+    // aligned with.
+    let mut extended_headers = Vec::new();
+    let mut chunks = extended.chunks(21).peekable();
+    while let Some(chunk) = chunks.next() {
+        let mut block = [0u8; 512];
+        for (entry, (offset, len)) in block.chunks_exact_mut(24).zip(chunk) {
+            let (offset_field, len_field) = entry.split_at_mut(12);
+            numeric_field(offset_field, *offset);
+            numeric_field(len_field, *len);
+        }
+        block[504] = u8::from(chunks.peek().is_some());
+        extended_headers.extend_from_slice(&block);
+    }
+    append_named(
+        builder,
+        header,
+        name,
+        None,
+        extended_headers.as_slice().chain(RegionReader {
+            file: f,
+            regions,
+            pos: 0,
+        }),
+    )
+}
+
+/// Reads the data regions of a sparse file back to back.
+struct RegionReader<'a> {
+    file: File,
+    regions: &'a [(u64, u64)],
+    /// position in the first of `regions`
+    pos: u64,
+}
+
+impl Read for RegionReader<'_> {
+    fn read(&mut self, buf: &mut [u8]) -> std::io::Result<usize> {
+        while let Some(&(offset, len)) = self.regions.first() {
+            if self.pos == len {
+                self.regions = &self.regions[1..];
+                self.pos = 0;
+                continue;
+            }
+            let want = buf.len().min((len - self.pos) as usize);
+            let n = self.file.read_at(&mut buf[..want], offset + self.pos)?;
+            if n == 0 {
+                return Err(std::io::Error::new(
+                    std::io::ErrorKind::UnexpectedEof,
+                    "file shrank while being archived",
+                ));
+            }
+            self.pos += n as u64;
+            return Ok(n);
+        }
+        Ok(0)
+    }
+}
+
+/// Write a numeric header field the way GNU tar does: as nul-terminated
+/// octal if it fits, base-256 otherwise.
+fn numeric_field(dst: &mut [u8], value: u64) {
+    let digits = dst.len() - 1;
+    if value >> (3 * digits) == 0 {
+        dst[..digits].copy_from_slice(format!("{value:0digits$o}").as_bytes());
+        dst[digits] = 0;
+    } else {
+        dst.fill(0);
+        dst[0] = 0x80;
+        let len = dst.len();
+        dst[len - 8..].copy_from_slice(&value.to_be_bytes());
+    }
+}
+
+/// Convert the kernel's binary representation of a POSIX ACL
+/// (system.posix_acl_*) into the short text form used by GNU tar.
+fn acl_to_text(value: &[u8]) -> Result<Vec<u8>> {
+    const ACL_EA_VERSION: u32 = 2;
+    let (version, entries) = value
+        .split_first_chunk::<4>()
+        .context("ACL xattr too short")?;
+    anyhow::ensure!(
+        u32::from_le_bytes(*version) == ACL_EA_VERSION,
+        "unsupported ACL version"
+    );
+    anyhow::ensure!(entries.len() % 8 == 0, "ACL xattr has a partial entry");
+    let entries: Vec<String> = entries
+        .chunks_exact(8)
+        .map(|e| {
+            let tag = u16::from_le_bytes([e[0], e[1]]);
+            let perm = u16::from_le_bytes([e[2], e[3]]);
+            let id = u32::from_le_bytes([e[4], e[5], e[6], e[7]]);
+            let perm = format!(
+                "{}{}{}",
+                if perm & 4 != 0 { 'r' } else { '-' },
+                if perm & 2 != 0 { 'w' } else { '-' },
+                if perm & 1 != 0 { 'x' } else { '-' },
+            );
+            Ok(match tag {
+                0x01 => format!("user::{perm}"),
+                0x02 => format!("user:{id}:{perm}"),
+                0x04 => format!("group::{perm}"),
+                0x08 => format!("group:{id}:{perm}"),
+                0x10 => format!("mask::{perm}"),
+                0x20 => format!("other::{perm}"),
+                _ => anyhow::bail!("unknown ACL tag {tag:#x}"),
+            })
+        })
+        .collect::<Result<_>>()?;
+    Ok(entries.join(",").into_bytes())
+}
+
+#[cfg(test)]
+mod tests {
+    use std::time::Instant;
+
+    use super::*;
+
+    fn build_tree(root: &Path, dirs: usize, files_per_dir: usize) {
+        for d in 0..dirs {
+            let dir = root.join(format!("d{d}"));
+            std::fs::create_dir(&dir).expect("failed to create dir");
+            for f in 0..files_per_dir {
+                std::fs::write(
+                    dir.join(format!("f{f}")),
+                    format!("contents of {d}/{f}\n").repeat(f % 64 + 1),
+                )
+                .expect("failed to write file");
+            }
+        }
+    }
+
+    fn tar_bytes(root: &Path) -> Vec<u8> {
+        let mut builder = Builder::new(Vec::new());
+        Tar {
+            preserve_xattrs: true,
+        }
+        .append_tree(&mut builder, root)
+        .expect("failed to build tar");
+        builder.into_inner().expect("failed to finish tar")
+    }
+
+    #[test]
+    fn sorted_with_hardlinks() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let root = tmp.path();
+        std::fs::create_dir(root.join("b")).expect("failed to create dir");
+        std::fs::write(root.join("b/z"), "z").expect("failed to write");
+        std::fs::write(root.join("a"), "a").expect("failed to write");
+        std::fs::write(root.join("b-c"), "bc").expect("failed to write");
+        std::fs::hard_link(root.join("a"), root.join("c")).expect("failed to link");
+        std::os::unix::fs::symlink("a", root.join("d")).expect("failed to symlink");
+
+        let bytes = tar_bytes(root);
+        let mut archive = tar::Archive::new(bytes.as_slice());
+        let entries: Vec<_> = archive
+            .entries()
+            .expect("failed to read entries")
+            .map(|e| {
+                let e = e.expect("bad entry");
+                (
+                    String::from_utf8(e.path_bytes().into_owned()).expect("utf8"),
+                    e.header().entry_type(),
+                    e.link_name_bytes()
+                        .map(|l| String::from_utf8(l.into_owned()).expect("utf8")),
+                )
+            })
+            .collect();
+        assert_eq!(
+            entries,
+            vec![
+                ("./".to_owned(), EntryType::Directory, None),
+                ("./a".to_owned(), EntryType::Regular, None),
+                ("./b/".to_owned(), EntryType::Directory, None),
+                ("./b/z".to_owned(), EntryType::Regular, None),
+                ("./b-c".to_owned(), EntryType::Regular, None),
+                ("./c".to_owned(), EntryType::Link, Some("./a".to_owned())),
+                ("./d".to_owned(), EntryType::Symlink, Some("a".to_owned())),
+            ]
+        );
+    }
+
+    #[test]
+    fn long_names() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let root = tmp.path();
+        let dir = "d".repeat(80);
+        let file = "f".repeat(80);
+        std::fs::create_dir(root.join(&dir)).expect("failed to create dir");
+        std::fs::write(root.join(&dir).join(&file), "contents").expect("failed to write");
+        std::fs::hard_link(root.join(&dir).join(&file), root.join("link")).expect("failed to link");
+
+        let bytes = tar_bytes(root);
+        let mut archive = tar::Archive::new(bytes.as_slice());
+        let entries: Vec<_> = archive
+            .entries()
+            .expect("failed to read entries")
+            .map(|e| {
+                let mut e = e.expect("bad entry");
+                let link = e
+                    .link_name_bytes()
+                    .map(|l| String::from_utf8(l.into_owned()).expect("utf8"));
+                let path = String::from_utf8(e.path_bytes().into_owned()).expect("utf8");
+                let mut contents = String::new();
+                e.read_to_string(&mut contents)
+                    .expect("failed to read contents");
+                (path, link, contents)
+            })
+            .collect();
+        let long = format!("./{dir}/{file}");
+        assert_eq!(
+            entries,
+            vec![
+                ("./".to_owned(), None, String::new()),
+                (format!("./{dir}/"), None, String::new()),
+                (long.clone(), None, "contents".to_owned()),
+                ("./link".to_owned(), Some(long), String::new()),
+            ]
+        );
+    }
+
+    #[test]
+    fn sparse() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let root = tmp.path();
+        let path = root.join("holes");
+        let size = 64 << 20;
+        let f = File::create(&path).expect("failed to create file");
+        f.set_len(size).expect("failed to set length");
+        // more regions than fit in the header, so that it needs extended
+        // sparse headers, and holes at both ends
+        for i in 0..30u64 {
+            f.write_all_at(
+                format!("region {i}\n").repeat(100).as_bytes(),
+                (1 << 20) + i * (2 << 20),
+            )
+            .expect("failed to write");
+        }
+        drop(f);
+        let meta = std::fs::metadata(&path).expect("failed to stat");
+        if meta.blocks() * 512 >= size {
+            eprintln!("skipping: the filesystem of the tempdir does not support holes");
+            return;
+        }
+
+        let bytes = tar_bytes(root);
+        assert!(
+            bytes.len() < 1 << 20,
+            "holes were archived: {} bytes",
+            bytes.len()
+        );
+        let mut archive = tar::Archive::new(bytes.as_slice());
+        let entries: Vec<_> = archive
+            .entries()
+            .expect("failed to read entries")
+            .map(|e| {
+                let e = e.expect("bad entry");
+                (
+                    String::from_utf8(e.path_bytes().into_owned()).expect("utf8"),
+                    e.header().entry_type(),
+                )
+            })
+            .collect();
+        assert_eq!(
+            entries,
+            vec![
+                ("./".to_owned(), EntryType::Directory),
+                ("./holes".to_owned(), EntryType::GNUSparse),
+            ]
+        );
+
+        let out = tempfile::tempdir().expect("failed to create tempdir");
+        tar::Archive::new(bytes.as_slice())
+            .unpack(out.path())
+            .expect("failed to extract");
+        let extracted = std::fs::read(out.path().join("holes")).expect("failed to read");
+        assert_eq!(extracted.len() as u64, size);
+        assert!(extracted == std::fs::read(&path).expect("failed to read"));
+    }
+
+    #[test]
+    fn acl_text() {
+        let mut acl = 2u32.to_le_bytes().to_vec();
+        for (tag, perm, id) in [
+            (0x01u16, 7u16, u32::MAX),
+            (0x02, 5, 1000),
+            (0x04, 5, u32::MAX),
+            (0x10, 5, u32::MAX),
+            (0x20, 0, u32::MAX),
+        ] {
+            acl.extend(tag.to_le_bytes());
+            acl.extend(perm.to_le_bytes());
+            acl.extend(id.to_le_bytes());
+        }
+        assert_eq!(
+            String::from_utf8(acl_to_text(&acl).expect("failed to convert")).expect("utf8"),
+            "user::rwx,user:1000:r-x,group::r-x,mask::r-x,other::---"
+        );
+    }
+
+    /// Archive a synthetic tree, reporting the time taken and checking that
+    /// the output is reproducible. This is a benchmark, so it only runs when
+    /// asked to with --ignored.
+    #[test]
+    #[ignore]
+    fn bench_synthetic_tree() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        build_tree(tmp.path(), 64, 128);
+
+        let start = Instant::now();
+        let tar = tar_bytes(tmp.path());
+        eprintln!("tar: {} bytes in {:?}", tar.len(), start.elapsed());
+        assert_eq!(tar, tar_bytes(tmp.path()), "tar is not reproducible");
+    }
 }
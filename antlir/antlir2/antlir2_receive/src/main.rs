@@ -43,6 +43,13 @@ pub(crate) struct Receive {
     #[clap(long, default_value = "btrfs")]
     /// path to 'btrfs' command
     btrfs: PathBuf,
+    #[clap(long, value_enum, default_value_t = sendstream::Receiver::Btrfs)]
+    /// How to apply sendstreams
+    sendstream_receiver: sendstream::Receiver,
+    #[clap(long)]
+    /// Number of threads used by the userspace sendstream receiver (defaults
+    /// to the number of CPUs)
+    receive_threads: Option<usize>,
     #[clap(long)]
     facts_db_out: PathBuf,
     #[clap(long)]
@@ -184,6 +191,9 @@ impl Receive {
 
         let _ = std::fs::remove_file(&self.output);
         std::os::unix::fs::symlink(subvol.path(), &self.output).context("while making symlink")?;
+        if let Err(e) = working_volume.record_reference(subvol.path(), &self.output) {
+            warn!("failed to record reference to subvol: {e:#?}");
+        }
 
         Ok(())
     }
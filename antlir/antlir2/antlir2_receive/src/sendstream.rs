@@ -13,15 +13,47 @@ use antlir2_working_volume::WorkingVolume;
 use anyhow::Context;
 use anyhow::Result;
 use anyhow::ensure;
+use clap::ValueEnum;
 use tracing::trace;
+use tracing::warn;
 
 use crate::Receive;
 
+mod userspace;
+
+#[derive(Debug, Copy, Clone, PartialEq, Eq, ValueEnum)]
+pub(crate) enum Receiver {
+    /// Use 'btrfs receive'
+    Btrfs,
+    /// Apply the sendstream with the userspace receiver, which parses ahead
+    /// and applies independent file writes concurrently. Falls back to
+    /// 'btrfs receive' for sendstreams that it does not support.
+    Userspace,
+}
+
 pub(crate) fn recv_sendstream(args: &Receive, dst: &Path, wv: &WorkingVolume) -> Result<()> {
     // make sure that working_dir is btrfs before we try to invoke
     // 'btrfs' so that we can fail with a nicely categorized error
     antlir2_btrfs::ensure_path_is_on_btrfs(wv.path())?;
+    if args.sendstream_receiver == Receiver::Userspace {
+        let threads = args.receive_threads.unwrap_or_else(|| {
+            std::thread::available_parallelism()
+                .map(std::num::NonZeroUsize::get)
+                .unwrap_or(1)
+        });
+        match userspace::receive(&args.source, dst, threads)
+            .context("while receiving sendstream in userspace")?
+        {
+            userspace::Outcome::Received => return Ok(()),
+            userspace::Outcome::Unsupported(reason) => {
+                warn!("falling back to btrfs-receive: {reason}");
+            }
+        }
+    }
+    recv_with_btrfs(args, dst, wv)
+}
 
+fn recv_with_btrfs(args: &Receive, dst: &Path, wv: &WorkingVolume) -> Result<()> {
     let recv_tmp = tempfile::tempdir_in(wv.path())?;
     let mut cmd = Command::new(&args.btrfs);
     cmd.arg("--quiet")
@@ -0,0 +1,884 @@
+/*
+ * Copyright (c) Meta Platforms, Inc. and affiliates.
+ *
+ * This source code is licensed under the MIT license found in the
+ * LICENSE file in the root directory of this source tree.
+ */
+
+//! Receive a sendstream without `btrfs receive`.
+//!
+//! `btrfs receive` applies every command in stream order on a single thread,
+//! so receiving a large layer is one long chain of small, synchronous writes.
+//! Here the stream is parsed ahead on a separate thread, consecutive commands
+//! that only touch the contents or metadata of one path (writes, truncates,
+//! ownership, modes, times and xattrs) are batched together, and the batches
+//! for different paths are applied concurrently on a pool of workers.
+//!
+//! Commands that change the shape of the tree (creating, renaming, linking
+//! and removing entries, or cloning between files) are applied in stream
+//! order on the receiving thread, after waiting for every in-flight batch on
+//! a path that they could affect (the path itself, any of its ancestors or
+//! any of its descendants). Batches for the same path are applied in order.
+//! Once a file has more than one link, its data could be written through any
+//! of its paths, so batches for all such paths are applied one at a time.
+//!
+//! Only full sendstreams are supported. Incremental sendstreams need the
+//! parent subvolume to be found by its uuid, which is left to `btrfs receive`.
+
+use std::collections::HashSet;
+use std::collections::VecDeque;
+use std::ffi::CString;
+use std::ffi::OsStr;
+use std::fs::File;
+use std::os::fd::AsRawFd;
+use std::os::unix::ffi::OsStrExt;
+use std::os::unix::fs::DirBuilderExt;
+use std::os::unix::fs::FileExt;
+use std::os::unix::fs::OpenOptionsExt;
+use std::os::unix::fs::PermissionsExt;
+use std::path::Path;
+use std::path::PathBuf;
+use std::sync::Arc;
+use std::sync::mpsc::Receiver;
+use std::sync::mpsc::SyncSender;
+use std::thread::JoinHandle;
+use std::time::Instant;
+use std::time::SystemTime;
+
+use antlir2_btrfs::Subvolume;
+use anyhow::Context;
+use anyhow::Result;
+use anyhow::bail;
+use anyhow::ensure;
+use nix::libc;
+use sendstream_parser::Command;
+use sendstream_parser::wire::MappedSendstream;
+use tracing::info;
+use tracing::trace;
+use uuid::Uuid;
+
+/// The parser hands over commands in messages of at most this many commands
+/// or bytes of data
+const OPS_PER_MESSAGE: usize = 1024;
+const BYTES_PER_MESSAGE: usize = 1 << 20;
+/// How many messages the parser may get ahead of the receiving thread
+const PARSE_AHEAD: usize = 32;
+/// A batch for a single path is submitted once it holds this much data, so
+/// that large files are written while the rest of them is still being parsed
+const BYTES_PER_BATCH: usize = 8 << 20;
+
+/// Result of trying to receive a sendstream in userspace.
+pub(crate) enum Outcome {
+    Received,
+    /// The sendstream uses something that is not supported here, and nothing
+    /// has been left at the destination
+    Unsupported(String),
+}
+
+/// Owned version of [sendstream_parser::Command], so that it can be sent to
+/// other threads.
+#[derive(Debug)]
+enum Op {
+    Subvol {
+        uuid: Uuid,
+    },
+    Snapshot,
+    Mkfile(PathBuf),
+    Mkdir(PathBuf),
+    Mkspecial {
+        path: PathBuf,
+        mode: u32,
+        rdev: u64,
+    },
+    Symlink {
+        link_name: PathBuf,
+        target: PathBuf,
+    },
+    Rename {
+        from: PathBuf,
+        to: PathBuf,
+    },
+    Link {
+        link_name: PathBuf,
+        target: PathBuf,
+    },
+    Unlink(PathBuf),
+    Rmdir(PathBuf),
+    Clone {
+        uuid: Uuid,
+        src: PathBuf,
+        src_offset: u64,
+        len: u64,
+        dst: PathBuf,
+        dst_offset: u64,
+    },
+    UpdateExtent,
+    End,
+    /// Operations that only affect the inode at this path
+    Inode(PathBuf, InodeOp),
+}
+
+#[derive(Debug)]
+enum InodeOp {
+    Write {
+        offset: u64,
+        data: Vec<u8>,
+    },
+    Truncate(u64),
+    Chmod(u32),
+    Chown {
+        uid: u32,
+        gid: u32,
+    },
+    Utimes {
+        atime: SystemTime,
+        mtime: SystemTime,
+    },
+    SetXattr {
+        name: Vec<u8>,
+        data: Vec<u8>,
+    },
+    RemoveXattr(Vec<u8>),
+}
+
+impl InodeOp {
+    fn data_len(&self) -> usize {
+        match self {
+            Self::Write { data, .. } => data.len(),
+            Self::SetXattr { data, .. } => data.len(),
+            _ => 0,
+        }
+    }
+}
+
+impl From<&Command<'_>> for Op {
+    fn from(cmd: &Command<'_>) -> Self {
+        let inode = |path: &Path, op| Self::Inode(path.to_owned(), op);
+        match cmd {
+            Command::Subvol(s) => Self::Subvol { uuid: s.uuid() },
+            Command::Snapshot(_) => Self::Snapshot,
+            Command::Mkfile(m) => Self::Mkfile(m.path().as_path().to_owned()),
+            Command::Mkdir(m) => Self::Mkdir(m.path().as_path().to_owned()),
+            Command::Mknod(m) => Self::mkspecial(m),
+            Command::Mkfifo(m) => Self::mkspecial(m),
+            Command::Mksock(m) => Self::mkspecial(m),
+            Command::Symlink(s) => Self::Symlink {
+                link_name: s.link_name().to_owned(),
+                target: s.target().as_path().to_owned(),
+            },
+            Command::Rename(r) => Self::Rename {
+                from: r.from().to_owned(),
+                to: r.to().to_owned(),
+            },
+            Command::Link(l) => Self::Link {
+                link_name: l.link_name().to_owned(),
+                target: l.target().as_path().to_owned(),
+            },
+            Command::Unlink(u) => Self::Unlink(u.path().to_owned()),
+            Command::Rmdir(r) => Self::Rmdir(r.path().to_owned()),
+            Command::Clone(c) => Self::Clone {
+                uuid: c.uuid(),
+                src: c.src_path().to_owned(),
+                src_offset: c.src_offset().as_u64(),
+                len: c.len().as_u64(),
+                dst: c.dst_path().to_owned(),
+                dst_offset: c.dst_offset().as_u64(),
+            },
+            Command::UpdateExtent(_) => Self::UpdateExtent,
+            Command::End => Self::End,
+            Command::Write(w) => inode(
+                w.path(),
+                InodeOp::Write {
+                    offset: w.offset().as_u64(),
+                    data: w.data().as_slice().to_vec(),
+                },
+            ),
+            Command::Truncate(t) => inode(t.path(), InodeOp::Truncate(t.size())),
+            Command::Chmod(c) => inode(c.path(), InodeOp::Chmod(c.mode().permissions().mode())),
+            Command::Chown(c) => inode(
+                c.path(),
+                InodeOp::Chown {
+                    uid: c.uid().as_raw(),
+                    gid: c.gid().as_raw(),
+                },
+            ),
+            Command::Utimes(u) => inode(
+                u.path(),
+                InodeOp::Utimes {
+                    atime: *u.atime(),
+                    mtime: *u.mtime(),
+                },
+            ),
+            Command::SetXattr(x) => inode(
+                x.path(),
+                InodeOp::SetXattr {
+                    name: x.name().as_slice().to_vec(),
+                    data: x.data().as_slice().to_vec(),
+                },
+            ),
+            Command::RemoveXattr(x) => {
+                inode(x.path(), InodeOp::RemoveXattr(x.name().as_slice().to_vec()))
+            }
+        }
+    }
+}
+
+impl Op {
+    fn mkspecial(m: &sendstream_parser::Mkspecial<'_>) -> Self {
+        Self::Mkspecial {
+            path: m.path().as_path().to_owned(),
+            // includes the file type bits, which is exactly what mknod wants
+            mode: m.mode().permissions().mode(),
+            rdev: m.rdev().as_u64(),
+        }
+    }
+
+    fn data_len(&self) -> usize {
+        match self {
+            Self::Inode(_, op) => op.data_len(),
+            _ => 0,
+        }
+    }
+}
+
+struct Parser {
+    messages: Receiver<Vec<Op>>,
+    thread: JoinHandle<Result<u128>>,
+}
+
+impl Parser {
+    /// Parse the sendstream on a separate thread, so that parsing overlaps
+    /// with applying the commands.
+    fn spawn(source: &Path) -> Result<Self> {
+        let source = source.to_owned();
+        let (tx, messages) = std::sync::mpsc::sync_channel(PARSE_AHEAD);
+        let thread = std::thread::Builder::new()
+            .name("sendstream-parse".to_owned())
+            .spawn(move || parse_into(&source, tx))
+            .context("while spawning parser thread")?;
+        Ok(Self { messages, thread })
+    }
+
+    /// Wait for the parser to finish, returning the number of commands parsed
+    fn join(self) -> Result<u128> {
+        drop(self.messages);
+        self.thread.join().expect("parser thread panicked")
+    }
+}
+
+fn parse_into(source: &Path, tx: SyncSender<Vec<Op>>) -> Result<u128> {
+    let stream = MappedSendstream::open(source)
+        .with_context(|| format!("while opening {}", source.display()))?;
+    let mut count = 0;
+    let mut message = Vec::with_capacity(OPS_PER_MESSAGE);
+    let mut message_bytes = 0;
+    for cmd in stream.commands() {
+        let op = Op::from(&cmd.context("while parsing sendstream")?);
+        count += 1;
+        message_bytes += op.data_len();
+        let end = matches!(op, Op::End);
+        message.push(op);
+        if end || message.len() >= OPS_PER_MESSAGE || message_bytes >= BYTES_PER_MESSAGE {
+            message_bytes = 0;
+            // if the receiver is gone, it already failed or gave up
+            if tx.send(std::mem::take(&mut message)).is_err() {
+                return Ok(count);
+            }
+        }
+    }
+    if !message.is_empty() {
+        let _ = tx.send(message);
+    }
+    Ok(count)
+}
+
+/// A batch of [InodeOp]s for one path that has been handed to the pool
+struct InFlight {
+    path: PathBuf,
+    done: Receiver<Result<()>>,
+}
+
+impl InFlight {
+    fn wait(self) -> Result<()> {
+        self.done
+            .recv()
+            .context("receive worker exited without a result")?
+            .with_context(|| format!("while applying commands to {}", self.path.display()))
+    }
+}
+
+/// Applies commands to the received subvolume, see the module docs.
+struct Applier {
+    root: Arc<Path>,
+    pool: rayon::ThreadPool,
+    max_in_flight: usize,
+    in_flight: VecDeque<InFlight>,
+    /// The batch that is currently being accumulated
+    batch: Option<(PathBuf, Vec<InodeOp>, usize)>,
+    /// Paths of files that (may) have more than one link
+    linked: HashSet<PathBuf>,
+}
+
+impl Applier {
+    fn new(root: &Path, threads: usize) -> Result<Self> {
+        let threads = threads.max(1);
+        Ok(Self {
+            root: root.into(),
+            pool: rayon::ThreadPoolBuilder::new()
+                .num_threads(threads)
+                .thread_name(|i| format!("sendstream-apply-{i}"))
+                .build()
+                .context("while building thread pool")?,
+            max_in_flight: threads * 4,
+            in_flight: VecDeque::new(),
+            batch: None,
+            linked: HashSet::new(),
+        })
+    }
+
+    fn push_inode_op(&mut self, path: PathBuf, op: InodeOp) -> Result<()> {
+        if self.batch.as_ref().is_none_or(|(p, _, _)| *p != path) {
+            self.submit()?;
+            self.batch = Some((path, Vec::new(), 0));
+        }
+        let (_, ops, bytes) = self.batch.as_mut().expect("batch was just started");
+        *bytes += op.data_len();
+        ops.push(op);
+        if *bytes >= BYTES_PER_BATCH {
+            self.submit()?;
+        }
+        Ok(())
+    }
+
+    /// Hand the current batch to the pool
+    fn submit(&mut self) -> Result<()> {
+        let Some((path, ops, _)) = self.batch.take() else {
+            return Ok(());
+        };
+        // batches for the same inode must be applied in order
+        if self.linked.contains(&path) {
+            Self::wait_for(&mut self.in_flight, |p| self.linked.contains(p))?;
+        } else {
+            Self::wait_for(&mut self.in_flight, |p| p == path)?;
+        }
+        while self.in_flight.len() >= self.max_in_flight {
+            self.in_flight.pop_front().expect("not empty").wait()?;
+        }
+        let (tx, done) = std::sync::mpsc::sync_channel(1);
+        let root = self.root.clone();
+        let job_path = path.clone();
+        self.pool.spawn(move || {
+            let _ = tx.send(apply_inode_ops(&root, &job_path, ops));
+        });
+        self.in_flight.push_back(InFlight { path, done });
+        Ok(())
+    }
+
+    /// Wait for every in-flight batch on a path matching `pred`
+    fn wait_for(in_flight: &mut VecDeque<InFlight>, pred: impl Fn(&Path) -> bool) -> Result<()> {
+        let (matching, rest) = std::mem::take(in_flight)
+            .into_iter()
+            .partition::<VecDeque<_>, _>(|f| pred(&f.path));
+        *in_flight = rest;
+        for f in matching {
+            f.wait()?;
+        }
+        Ok(())
+    }
+
+    /// Wait for everything that could be affected by a structural change to
+    /// any of `paths`
+    fn barrier<P: AsRef<Path>>(&mut self, paths: &[P]) -> Result<()> {
+        self.submit()?;
+        Self::wait_for(&mut self.in_flight, |p| {
+            paths
+                .iter()
+                .any(|q| p.starts_with(q) || q.as_ref().starts_with(p))
+        })
+    }
+
+    fn finish(&mut self) -> Result<()> {
+        self.submit()?;
+        Self::wait_for(&mut self.in_flight, |_| true)
+    }
+
+    fn abs(&self, path: &Path) -> PathBuf {
+        self.root.join(path)
+    }
+
+    fn apply_structural(&mut self, op: Op) -> Result<()> {
+        match &op {
+            Op::Mkfile(path) => {
+                self.barrier(&[path])?;
+                File::options()
+                    .write(true)
+                    .create_new(true)
+                    .mode(0o600)
+                    .open(self.abs(path))
+                    .map(|_| ())
+            }
+            Op::Mkdir(path) => {
+                self.barrier(&[path])?;
+                std::fs::DirBuilder::new()
+                    .mode(0o700)
+                    .create(self.abs(path))
+            }
+            Op::Mkspecial { path, mode, rdev } => {
+                self.barrier(&[path])?;
+                let cpath = cstring(&self.abs(path))?;
+                // SAFETY: cpath is a valid nul-terminated string
+                cvt(unsafe { libc::mknod(cpath.as_ptr(), *mode, *rdev as libc::dev_t) })
+            }
+            Op::Symlink { link_name, target } => {
+                self.barrier(&[link_name])?;
+                std::os::unix::fs::symlink(target, self.abs(link_name))
+            }
+            Op::Rename { from, to } => {
+                self.barrier(&[from, to])?;
+                self.linked = std::mem::take(&mut self.linked)
+                    .into_iter()
+                    .map(|p| match p.strip_prefix(from) {
+                        Ok(rel) => to.join(rel),
+                        Err(_) => p,
+                    })
+                    .collect();
+                std::fs::rename(self.abs(from), self.abs(to))
+            }
+            Op::Link { link_name, target } => {
+                // data commands for an inode with multiple links could be
+                // issued through any of its paths, so be conservative
+                self.finish()?;
+                self.linked.insert(link_name.clone());
+                self.linked.insert(target.clone());
+                std::fs::hard_link(self.abs(target), self.abs(link_name))
+            }
+            Op::Unlink(path) => {
+                self.barrier(&[path])?;
+                self.linked.remove(path);
+                std::fs::remove_file(self.abs(path))
+            }
+            Op::Rmdir(path) => {
+                self.barrier(&[path])?;
+                std::fs::remove_dir(self.abs(path))
+            }
+            Op::Clone {
+                src,
+                src_offset,
+                len,
+                dst,
+                dst_offset,
+                ..
+            } => {
+                self.barrier(&[src, dst])?;
+                clone_range(
+                    &File::open(self.abs(src))?,
+                    *src_offset,
+                    *len,
+                    &File::options().write(true).open(self.abs(dst))?,
+                    *dst_offset,
+                )
+            }
+            Op::Inode(..) | Op::Subvol { .. } | Op::Snapshot | Op::UpdateExtent | Op::End => {
+                unreachable!("not a structural op: {op:?}")
+            }
+        }
+        .with_context(|| format!("while applying {op:?}"))
+    }
+}
+
+fn cstring(path: &Path) -> std::io::Result<CString> {
+    CString::new(path.as_os_str().as_bytes()).map_err(std::io::Error::other)
+}
+
+fn cvt(ret: libc::c_int) -> std::io::Result<()> {
+    if ret == 0 {
+        Ok(())
+    } else {
+        Err(std::io::Error::last_os_error())
+    }
+}
+
+fn timespec(t: SystemTime) -> libc::timespec {
+    let d = t.duration_since(SystemTime::UNIX_EPOCH).unwrap_or_default();
+    libc::timespec {
+        tv_sec: d.as_secs() as libc::time_t,
+        tv_nsec: d.subsec_nanos() as _,
+    }
+}
+
+/// Apply a batch of commands to one path, opening it at most once.
+fn apply_inode_ops(root: &Path, path: &Path, ops: Vec<InodeOp>) -> Result<()> {
+    let path = root.join(path);
+    let mut file: Option<File> = None;
+    for op in ops {
+        match &op {
+            InodeOp::Write { offset, data } => {
+                open_once(&mut file, &path)?.write_all_at(data, *offset)
+            }
+            InodeOp::Truncate(size) => open_once(&mut file, &path)?.set_len(*size),
+            InodeOp::Chmod(mode) => {
+                std::fs::set_permissions(&path, std::fs::Permissions::from_mode(*mode))
+            }
+            InodeOp::Chown { uid, gid } => std::os::unix::fs::lchown(&path, Some(*uid), Some(*gid)),
+            InodeOp::Utimes { atime, mtime } => {
+                let cpath = cstring(&path)?;
+                let times = [timespec(*atime), timespec(*mtime)];
+                // SAFETY: cpath is a valid nul-terminated string and times
+                // has exactly the two entries that utimensat reads
+                cvt(unsafe {
+                    libc::utimensat(
+                        libc::AT_FDCWD,
+                        cpath.as_ptr(),
+                        times.as_ptr(),
+                        libc::AT_SYMLINK_NOFOLLOW,
+                    )
+                })
+            }
+            InodeOp::SetXattr { name, data } => xattr::set(&path, OsStr::from_bytes(name), data),
+            InodeOp::RemoveXattr(name) => xattr::remove(&path, OsStr::from_bytes(name)),
+        }
+        .with_context(|| format!("while applying {op:?}"))?;
+    }
+    Ok(())
+}
+
+fn open_once<'f>(file: &'f mut Option<File>, path: &Path) -> std::io::Result<&'f File> {
+    if file.is_none() {
+        *file = Some(File::options().write(true).open(path)?);
+    }
+    Ok(file.as_ref().expect("just opened"))
+}
+
+#[repr(C)]
+struct FileCloneRange {
+    src_fd: i64,
+    src_offset: u64,
+    src_length: u64,
+    dest_offset: u64,
+}
+
+nix::ioctl_write_ptr!(ficlonerange, 0x94, 13, FileCloneRange);
+
+/// Share the extents of a range of `src` with `dst` (which is what the
+/// sending side did), falling back to copying the data if that fails (for
+/// example, because the range is not block aligned).
+fn clone_range(
+    src: &File,
+    src_offset: u64,
+    len: u64,
+    dst: &File,
+    dst_offset: u64,
+) -> std::io::Result<()> {
+    let args = FileCloneRange {
+        src_fd: src.as_raw_fd().into(),
+        src_offset,
+        src_length: len,
+        dest_offset: dst_offset,
+    };
+    // SAFETY: both fds are valid for the duration of this call and args
+    // matches the kernel's struct file_clone_range
+    match unsafe { ficlonerange(dst.as_raw_fd(), &args) } {
+        Ok(_) => return Ok(()),
+        Err(e) => trace!("FICLONERANGE failed, copying instead: {e}"),
+    }
+    let mut buf = vec![0; len.min(1 << 20) as usize];
+    let mut done = 0;
+    while done < len {
+        let want = (len - done).min(buf.len() as u64) as usize;
+        let n = src.read_at(&mut buf[..want], src_offset + done)?;
+        if n == 0 {
+            return Err(std::io::ErrorKind::UnexpectedEof.into());
+        }
+        dst.write_all_at(&buf[..n], dst_offset + done)?;
+        done += n as u64;
+    }
+    Ok(())
+}
+
+/// Receive the (full) sendstream in `source` as a new subvolume at `dst`.
+pub(crate) fn receive(source: &Path, dst: &Path, threads: usize) -> Result<Outcome> {
+    let start = Instant::now();
+    let stream_bytes = std::fs::metadata(source)
+        .with_context(|| format!("while statting {}", source.display()))?
+        .len();
+    let parser = Parser::spawn(source)?;
+
+    let mut messages = parser.messages.iter().flatten().peekable();
+    let subvol_uuid = match messages.peek() {
+        Some(Op::Subvol { uuid }) => *uuid,
+        Some(Op::Snapshot) => {
+            drop(messages);
+            // the parser stopping early is expected here
+            let _ = parser.join();
+            return Ok(Outcome::Unsupported("incremental sendstream".to_owned()));
+        }
+        Some(op) => bail!("sendstream starts with {op:?} instead of a subvol"),
+        None => {
+            drop(messages);
+            parser.join()?;
+            bail!("sendstream is empty");
+        }
+    };
+    messages.next();
+
+    let subvol = Subvolume::create(dst).context("while creating subvol")?;
+    let mut applier = Applier::new(subvol.path(), threads)?;
+    let mut unsupported = None;
+    let mut ended = false;
+    for op in messages.by_ref() {
+        if ended {
+            unsupported = Some("more than one sendstream in one file".to_owned());
+            break;
+        }
+        match op {
+            Op::Inode(path, op) => applier.push_inode_op(path, op)?,
+            Op::End => ended = true,
+            Op::Subvol { .. } | Op::Snapshot => bail!("unexpected subvol/snapshot in sendstream"),
+            Op::UpdateExtent => {
+                unsupported = Some("sendstream without file data".to_owned());
+                break;
+            }
+            Op::Clone { uuid, .. } if uuid != subvol_uuid => {
+                unsupported = Some(format!("clone from another subvolume ({uuid})"));
+                break;
+            }
+            op => applier.apply_structural(op)?,
+        }
+    }
+    drop(messages);
+    applier.finish()?;
+    if let Some(reason) = unsupported {
+        let _ = parser.join();
+        subvol
+            .delete()
+            .map_err(|(_, e)| e)
+            .context("while deleting partially received subvol")?;
+        return Ok(Outcome::Unsupported(reason));
+    }
+    let commands = parser.join()?;
+    ensure!(ended, "sendstream ended without an end command");
+
+    let elapsed = start.elapsed();
+    info!(
+        "received {commands} commands ({stream_bytes} bytes) in {elapsed:?}: {:.1} MB/s, {:.0} commands/s",
+        stream_bytes as f64 / elapsed.as_secs_f64() / 1e6,
+        commands as f64 / elapsed.as_secs_f64(),
+    );
+    Ok(Outcome::Received)
+}
+
+#[cfg(test)]
+mod tests {
+    #[cfg(image_test)]
+    use std::collections::BTreeMap;
+    #[cfg(image_test)]
+    use std::collections::HashMap;
+    use std::os::unix::fs::MetadataExt;
+
+    use super::*;
+
+    fn write(path: &str, offset: u64, data: &str) -> Op {
+        Op::Inode(
+            path.into(),
+            InodeOp::Write {
+                offset,
+                data: data.as_bytes().to_vec(),
+            },
+        )
+    }
+
+    /// Apply `ops` like [receive] does, but to a plain directory
+    fn apply(root: &Path, ops: Vec<Op>) {
+        let mut applier = Applier::new(root, 8).expect("failed to create applier");
+        for op in ops {
+            match op {
+                Op::Inode(path, op) => applier.push_inode_op(path, op),
+                op => applier.apply_structural(op),
+            }
+            .expect("failed to apply op");
+        }
+        applier.finish().expect("failed to finish");
+    }
+
+    fn read(root: &Path, path: &str) -> String {
+        std::fs::read_to_string(root.join(path)).expect("failed to read")
+    }
+
+    #[test]
+    fn renamed_ancestors() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        apply(
+            tmp.path(),
+            vec![
+                Op::Mkdir("a".into()),
+                Op::Mkfile("a/f".into()),
+                Op::Mkdir("a/d".into()),
+                Op::Mkfile("a/d/g".into()),
+                write("a/f", 0, "hello"),
+                write("a/d/g", 0, "world"),
+                Op::Rename {
+                    from: "a".into(),
+                    to: "b".into(),
+                },
+                write("b/f", 5, " there"),
+                Op::Rename {
+                    from: "b/d".into(),
+                    to: "d".into(),
+                },
+                write("d/g", 0, "W"),
+            ],
+        );
+        assert!(!tmp.path().join("a").exists());
+        assert_eq!(read(tmp.path(), "b/f"), "hello there");
+        assert_eq!(read(tmp.path(), "d/g"), "World");
+    }
+
+    #[test]
+    fn writes_through_hardlinks_stay_in_order() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        apply(
+            tmp.path(),
+            vec![
+                Op::Mkfile("x".into()),
+                write("x", 0, "aaaaaaaa"),
+                Op::Link {
+                    link_name: "y".into(),
+                    target: "x".into(),
+                },
+                write("y", 0, "bb"),
+                write("x", 1, "c"),
+                Op::Inode("y".into(), InodeOp::Truncate(4)),
+                write("x", 4, "dd"),
+                Op::Rename {
+                    from: "y".into(),
+                    to: "z".into(),
+                },
+                write("z", 6, "e"),
+                write("x", 7, "f"),
+            ],
+        );
+        assert_eq!(read(tmp.path(), "x"), "bcaaddef");
+        assert_eq!(read(tmp.path(), "z"), "bcaaddef");
+    }
+
+    #[test]
+    fn same_path_batches_stay_in_order() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let mut ops = vec![Op::Mkfile("a".into()), Op::Mkfile("b".into())];
+        // interleaving the paths makes every write its own batch
+        for i in 0..1000 {
+            ops.push(write("a", 0, &format!("{i:04}")));
+            ops.push(write("b", 0, &format!("{i:04}")));
+        }
+        ops.push(Op::Inode("a".into(), InodeOp::Chmod(0o640)));
+        ops.push(Op::Inode("a".into(), InodeOp::Chmod(0o604)));
+        apply(tmp.path(), ops);
+        assert_eq!(read(tmp.path(), "a"), "0999");
+        assert_eq!(read(tmp.path(), "b"), "0999");
+        assert_eq!(
+            std::fs::metadata(tmp.path().join("a"))
+                .expect("failed to stat")
+                .mode()
+                & 0o7777,
+            0o604
+        );
+    }
+
+    /// Everything about the tree at `root` that a receiver is responsible for
+    #[cfg(image_test)]
+    fn describe(root: &Path) -> BTreeMap<PathBuf, String> {
+        fn walk(
+            root: &Path,
+            relpath: &Path,
+            inodes: &mut HashMap<u64, PathBuf>,
+            out: &mut BTreeMap<PathBuf, String>,
+        ) {
+            let path = root.join(relpath);
+            let meta = std::fs::symlink_metadata(&path).expect("failed to stat");
+            let mut desc = format!(
+                "mode={:o} uid={} gid={} rdev={} size={} mtime={}.{}",
+                meta.mode(),
+                meta.uid(),
+                meta.gid(),
+                meta.rdev(),
+                meta.size(),
+                meta.mtime(),
+                meta.mtime_nsec(),
+            );
+            let mut xattrs: Vec<_> = xattr::list(&path).expect("failed to list xattrs").collect();
+            xattrs.sort();
+            for name in xattrs {
+                let value = xattr::get(&path, &name).expect("failed to get xattr");
+                desc.push_str(&format!(" xattr:{name:?}={value:?}"));
+            }
+            if meta.is_symlink() {
+                let target = std::fs::read_link(&path).expect("failed to readlink");
+                desc.push_str(&format!(" target={}", target.display()));
+            } else if meta.is_file() {
+                if let Some(first) = inodes.get(&meta.ino()) {
+                    desc.push_str(&format!(" link={}", first.display()));
+                } else {
+                    inodes.insert(meta.ino(), relpath.to_owned());
+                }
+                // don't read all of the sparse 100G file
+                if meta.size() < 1 << 20 {
+                    let contents = std::fs::read(&path).expect("failed to read");
+                    desc.push_str(&format!(" contents={contents:?}"));
+                }
+            }
+            out.insert(relpath.to_owned(), desc);
+            if meta.is_dir() {
+                let mut children: Vec<_> = std::fs::read_dir(&path)
+                    .expect("failed to read dir")
+                    .map(|e| e.expect("bad dir entry").file_name())
+                    .collect();
+                children.sort();
+                for child in children {
+                    walk(root, &relpath.join(child), inodes, out);
+                }
+            }
+        }
+        let mut out = BTreeMap::new();
+        walk(root, Path::new(""), &mut HashMap::new(), &mut out);
+        out
+    }
+
+    /// Receive the full sendstream in the demo with both `btrfs receive` and
+    /// the userspace receiver and make sure that they agree.
+    #[cfg(image_test)]
+    #[test]
+    fn matches_btrfs_receive() {
+        let stream = std::fs::read("/demo.sendstream").expect("failed to read demo");
+        // the demo is a full sendstream followed by an incremental one, which
+        // is not supported here, so only receive the first one
+        let magic = b"btrfs-stream\0";
+        let second = stream[1..]
+            .windows(magic.len())
+            .position(|w| w == magic)
+            .expect("demo has two sendstreams")
+            + 1;
+        std::fs::write("/work/full.sendstream", &stream[..second]).expect("failed to write");
+
+        std::fs::create_dir("/work/btrfs").expect("failed to create dir");
+        let status = std::process::Command::new("btrfs")
+            .args(["receive", "/work/btrfs", "-f", "/work/full.sendstream"])
+            .status()
+            .expect("failed to run btrfs receive");
+        assert!(status.success(), "btrfs receive failed");
+
+        match receive(
+            Path::new("/work/full.sendstream"),
+            Path::new("/work/userspace"),
+            4,
+        )
+        .expect("failed to receive")
+        {
+            Outcome::Received => {}
+            Outcome::Unsupported(reason) => panic!("demo was not received: {reason}"),
+        }
+
+        let expected = describe(Path::new("/work/btrfs/demo"));
+        assert!(expected.contains_key(Path::new("hello/msg-hard")));
+        assert_eq!(describe(Path::new("/work/userspace")), expected);
+    }
+}
@@ -5,21 +5,182 @@
  * LICENSE file in the root directory of this source tree.
  */
 
+use std::collections::HashSet;
+use std::ffi::OsStr;
+use std::fs::File;
+use std::io::ErrorKind;
+use std::io::Write;
+use std::os::unix::ffi::OsStrExt;
+use std::os::unix::ffi::OsStringExt;
 use std::os::unix::fs::MetadataExt;
 use std::path::Path;
+use std::path::PathBuf;
 use std::time::Duration;
+use std::time::Instant;
+use std::time::SystemTime;
 
 use antlir2_btrfs::Subvolume;
+use tracing::debug;
 use tracing::warn;
 
 use crate::Error;
 use crate::Result;
 use crate::WorkingVolume;
 
-static AGE_THRESHOLD: Duration = Duration::from_days(14);
+static DEFAULT_MAX_AGE: Duration = Duration::from_days(14);
+/// Recently used subvolumes are never collected, even if that means going over
+/// the byte budget, since they are very likely to still be referenced by buck.
+static DEFAULT_MIN_AGE: Duration = Duration::from_secs(60 * 60);
+
+/// How the working volume should be garbage collected.
+#[derive(Debug, Clone, PartialEq, Eq)]
+pub struct GcPolicy {
+    /// Subvolumes that have not been used in this long are always collected.
+    pub max_age: Duration,
+    /// Subvolumes that have been used more recently than this are never
+    /// collected.
+    pub min_age: Duration,
+    /// If set, the least recently used subvolumes that are no longer
+    /// referenced by any output are collected until the (estimated) size of
+    /// all the subvolumes fits in this many bytes.
+    pub max_bytes: Option<u64>,
+}
+
+impl Default for GcPolicy {
+    fn default() -> Self {
+        Self {
+            max_age: DEFAULT_MAX_AGE,
+            min_age: DEFAULT_MIN_AGE,
+            max_bytes: None,
+        }
+    }
+}
+
+/// Summary of a garbage collection run.
+#[derive(Debug, Clone, Default)]
+pub struct GcReport {
+    pub deleted: usize,
+    /// Estimated bytes that will be freed. Subvolumes share extents with their
+    /// snapshots, so this is an upper bound.
+    pub reclaimed_bytes: u64,
+    pub remaining: usize,
+    pub remaining_bytes: u64,
+    pub elapsed: Duration,
+}
+
+#[derive(Debug, Clone, PartialEq, Eq)]
+struct Candidate {
+    path: PathBuf,
+    last_used: SystemTime,
+    /// Only computed when there is a byte budget
+    size: Option<u64>,
+    /// Whether any output might still point to this subvolume
+    referenced: bool,
+}
+
+/// Split `candidates` into the ones that `policy` says to delete (least
+/// recently used first) and the ones to keep.
+fn plan(
+    mut candidates: Vec<Candidate>,
+    policy: &GcPolicy,
+    now: SystemTime,
+) -> (Vec<Candidate>, Vec<Candidate>) {
+    // least recently used first
+    candidates.sort_by_key(|c| c.last_used);
+    let mut total: u64 = candidates.iter().filter_map(|c| c.size).sum();
+    let mut delete = Vec::new();
+    let mut keep = Vec::new();
+    for c in candidates {
+        let age = now.duration_since(c.last_used).unwrap_or_default();
+        let over_budget = policy.max_bytes.is_some_and(|max| total > max);
+        if age >= policy.max_age || (over_budget && age >= policy.min_age && !c.referenced) {
+            total = total.saturating_sub(c.size.unwrap_or_default());
+            delete.push(c);
+        } else {
+            keep.push(c);
+        }
+    }
+    (delete, keep)
+}
 
 impl WorkingVolume {
-    pub fn garbage_collect_old_subvols(&self) -> Result<()> {
+    /// Directory of small marker files (one per subvolume) that record when a
+    /// subvolume was last used (mtime) and the outputs that point to it
+    /// (contents). Subvolume sizes are cached next to them in `.size` files.
+    fn gc_dir(&self) -> PathBuf {
+        self.path().join("gc")
+    }
+
+    fn gc_marker(&self, subvol: &Path) -> Option<PathBuf> {
+        subvol.file_name().map(|name| self.gc_dir().join(name))
+    }
+
+    /// Resolve `subvol` to its marker file, if it is in this working volume.
+    fn own_marker(&self, subvol: &Path) -> Result<Option<PathBuf>> {
+        let subvol = subvol.canonicalize().map_err(Error::GarbageCollect)?;
+        let root = self.path().canonicalize().map_err(Error::GarbageCollect)?;
+        if !subvol.starts_with(root) {
+            // not one of ours
+            return Ok(None);
+        }
+        std::fs::create_dir_all(self.gc_dir()).map_err(Error::GarbageCollect)?;
+        Ok(self.gc_marker(&subvol))
+    }
+
+    /// Record that a subvolume in this working volume was just used (for
+    /// example, as the parent of a new layer), so that it is collected after
+    /// subvolumes that were used less recently.
+    pub fn mark_used(&self, subvol: &Path) -> Result<()> {
+        let Some(marker) = self.own_marker(subvol)? else {
+            return Ok(());
+        };
+        match File::options().write(true).open(&marker) {
+            Ok(f) => f.set_modified(SystemTime::now()),
+            Err(e) if e.kind() == ErrorKind::NotFound => File::create(&marker).map(|_| ()),
+            Err(e) => Err(e),
+        }
+        .map_err(Error::GarbageCollect)
+    }
+
+    /// Record that `symlink` (a buck output) points to `subvol`. Subvolumes
+    /// are never collected to fit in the byte budget while any of the symlinks
+    /// recorded for them (or any symlinks at all, if none were recorded) might
+    /// still be used to reach them.
+    pub fn record_reference(&self, subvol: &Path, symlink: &Path) -> Result<()> {
+        let Some(marker) = self.own_marker(subvol)? else {
+            return Ok(());
+        };
+        let symlink = std::path::absolute(symlink).map_err(Error::GarbageCollect)?;
+        let mut line = symlink.into_os_string().into_vec();
+        line.push(b'\n');
+        // appends of one short line are atomic, so concurrent builds can all
+        // record their references in the same marker
+        File::options()
+            .create(true)
+            .append(true)
+            .open(&marker)
+            .and_then(|mut f| f.write_all(&line))
+            .map_err(Error::GarbageCollect)
+    }
+
+    pub fn garbage_collect_old_subvols(&self) -> Result<GcReport> {
+        self.garbage_collect(&GcPolicy::default())
+    }
+
+    /// Delete subvolumes that are too old, then the least recently used
+    /// unreferenced ones until the rest fit in the byte budget.
+    ///
+    /// Subvolumes are only measured when there is a byte budget, so this
+    /// should only be given one outside of the build (in `antlir2 gc`).
+    ///
+    /// Deletion is asynchronous: the btrfs ioctl unlinks the subvolume
+    /// immediately and leaves freeing the extents to the kernel's cleaner
+    /// thread, so this does not wait for the space to actually be reclaimed.
+    pub fn garbage_collect(&self, policy: &GcPolicy) -> Result<GcReport> {
+        let start = Instant::now();
+        let now = SystemTime::now();
+        let mut candidates = Vec::new();
+        let mut live_markers = HashSet::new();
         for entry in std::fs::read_dir(self.subvols_path())
             .map_err(Error::GarbageCollect)?
             // subvolumes used to be created in the root of antlir2-out, so we
@@ -32,21 +193,317 @@ impl WorkingVolume {
                 // not a subvol
                 continue;
             }
-            if let Some(age) = meta.created().ok().and_then(|t| t.elapsed().ok()) {
-                if age >= AGE_THRESHOLD {
-                    let path = entry.path();
-                    if let Err(e) = try_gc_subvol(&path) {
-                        warn!("failed to gc subvol {}: {e}", path.display());
+            let path = entry.path();
+            let Some(marker) = self.gc_marker(&path) else {
+                continue;
+            };
+            let marker_meta = std::fs::metadata(&marker).ok();
+            let last_used = [
+                meta.created().ok(),
+                marker_meta.as_ref().and_then(|m| m.modified().ok()),
+            ]
+            .into_iter()
+            .flatten()
+            .max()
+            .unwrap_or(SystemTime::UNIX_EPOCH);
+            let evictable = now.duration_since(last_used).unwrap_or_default() >= policy.min_age;
+            let referenced =
+                policy.max_bytes.is_none() || !evictable || is_referenced(&path, &marker);
+            let size_file = marker.with_extension("size");
+            let size = match policy.max_bytes {
+                // a subvol that was only just created may still be getting
+                // built, so only use a size that was already measured
+                Some(_) if !evictable => read_size(&size_file),
+                Some(_) => Some(cached_size(&path, &size_file)),
+                None => None,
+            };
+            live_markers.insert(marker);
+            live_markers.insert(size_file);
+            candidates.push(Candidate {
+                path,
+                last_used,
+                size,
+                referenced,
+            });
+        }
+
+        let (delete, keep) = plan(candidates, policy, now);
+        let mut report = GcReport::default();
+        for c in delete {
+            match try_gc_subvol(&c.path) {
+                Ok(()) => {
+                    debug!(
+                        "deleted subvol {} (last used {:?} ago, {:?} bytes)",
+                        c.path.display(),
+                        now.duration_since(c.last_used).unwrap_or_default(),
+                        c.size
+                    );
+                    report.deleted += 1;
+                    report.reclaimed_bytes += c.size.unwrap_or_default();
+                    if let Some(marker) = self.gc_marker(&c.path) {
+                        live_markers.remove(&marker.with_extension("size"));
+                        let _ = std::fs::remove_file(marker.with_extension("size"));
+                        live_markers.remove(&marker);
+                        let _ = std::fs::remove_file(&marker);
                     }
                 }
+                Err(e) => {
+                    warn!("failed to gc subvol {}: {e}", c.path.display());
+                    report.remaining += 1;
+                    report.remaining_bytes += c.size.unwrap_or_default();
+                }
+            }
+        }
+        for c in keep {
+            report.remaining += 1;
+            report.remaining_bytes += c.size.unwrap_or_default();
+        }
+        self.remove_stale_markers(&live_markers);
+        report.elapsed = start.elapsed();
+        Ok(report)
+    }
+
+    fn remove_stale_markers(&self, live: &HashSet<PathBuf>) {
+        let Ok(entries) = std::fs::read_dir(self.gc_dir()) else {
+            return;
+        };
+        for entry in entries.flatten() {
+            if !live.contains(&entry.path()) {
+                let _ = std::fs::remove_file(entry.path());
             }
         }
-        Ok(())
     }
 }
 
+/// Whether any of the outputs recorded in `marker` still point to `subvol`.
+/// Subvolumes without any recorded outputs (or whose marker cannot be read)
+/// are assumed to be referenced, since there is no way to know otherwise.
+fn is_referenced(subvol: &Path, marker: &Path) -> bool {
+    let Ok(contents) = std::fs::read(marker) else {
+        return true;
+    };
+    let mut symlinks = contents
+        .split(|b| *b == b'\n')
+        .filter(|l| !l.is_empty())
+        .map(|l| Path::new(OsStr::from_bytes(l)))
+        .peekable();
+    if symlinks.peek().is_none() {
+        return true;
+    }
+    let Ok(subvol) = subvol.canonicalize() else {
+        return true;
+    };
+    symlinks.any(|symlink| symlink.canonicalize().is_ok_and(|target| target == subvol))
+}
+
+fn read_size(size_file: &Path) -> Option<u64> {
+    std::fs::read_to_string(size_file)
+        .ok()
+        .and_then(|s| s.trim().parse().ok())
+}
+
+/// Estimated size of a subvolume, which is cached in `size_file` since
+/// subvolumes are (almost always) readonly once they are built.
+fn cached_size(subvol: &Path, size_file: &Path) -> u64 {
+    if let Some(size) = read_size(size_file) {
+        return size;
+    }
+    match estimate_size(subvol) {
+        Ok(size) => {
+            let _ = std::fs::create_dir_all(size_file.parent().expect("in gc dir"))
+                .and_then(|()| std::fs::write(size_file, size.to_string()));
+            size
+        }
+        Err(e) => {
+            warn!("failed to measure subvol {}: {e}", subvol.display());
+            0
+        }
+    }
+}
+
+/// Sum of the allocated size of every inode in the subvolume (without
+/// descending into nested subvolumes), counting hardlinks only once.
+fn estimate_size(root: &Path) -> std::io::Result<u64> {
+    let root_meta = std::fs::symlink_metadata(root)?;
+    let dev = root_meta.dev();
+    let mut seen = HashSet::new();
+    let mut total = root_meta.blocks() * 512;
+    let mut stack = vec![root.to_owned()];
+    while let Some(dir) = stack.pop() {
+        for entry in std::fs::read_dir(&dir)? {
+            let entry = entry?;
+            let meta = entry.metadata()?;
+            if meta.dev() != dev {
+                continue;
+            }
+            if meta.nlink() > 1 && !meta.is_dir() && !seen.insert(meta.ino()) {
+                continue;
+            }
+            total += meta.blocks() * 512;
+            if meta.is_dir() {
+                stack.push(entry.path());
+            }
+        }
+    }
+    Ok(total)
+}
+
 fn try_gc_subvol(path: &Path) -> Result<()> {
     let subvol = Subvolume::open(path)?;
     subvol.delete().map_err(|(_, err)| err)?;
     Ok(())
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn estimate_size_counts_hardlinks_once() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let root = tmp.path();
+        std::fs::create_dir(root.join("dir")).expect("failed to create dir");
+        std::fs::write(root.join("dir/file"), vec![1u8; 1 << 20]).expect("failed to write");
+        let before = estimate_size(root).expect("failed to estimate");
+        assert!(before >= 1 << 20, "{before}");
+        std::fs::hard_link(root.join("dir/file"), root.join("link")).expect("failed to link");
+        assert_eq!(estimate_size(root).expect("failed to estimate"), before);
+    }
+
+    const HOUR: Duration = Duration::from_secs(60 * 60);
+
+    fn candidate(name: &str, age: Duration, size: u64, referenced: bool) -> Candidate {
+        Candidate {
+            path: PathBuf::from(name),
+            last_used: SystemTime::UNIX_EPOCH + Duration::from_days(365) - age,
+            size: Some(size),
+            referenced,
+        }
+    }
+
+    /// Returns the names of the deleted candidates (in order) and how many
+    /// were kept.
+    fn run_plan(candidates: Vec<Candidate>, policy: &GcPolicy) -> (Vec<String>, usize) {
+        let now = SystemTime::UNIX_EPOCH + Duration::from_days(365);
+        let (delete, keep) = plan(candidates, policy, now);
+        let deleted = delete
+            .into_iter()
+            .map(|c| c.path.display().to_string())
+            .collect();
+        (deleted, keep.len())
+    }
+
+    #[test]
+    fn max_age_without_budget() {
+        let (deleted, kept) = run_plan(
+            vec![
+                candidate("new", HOUR * 2, 100, false),
+                candidate("old", Duration::from_days(15), 100, true),
+                candidate("older", Duration::from_days(30), 100, false),
+            ],
+            &GcPolicy::default(),
+        );
+        // too old is collected even if it is still referenced
+        assert_eq!(deleted, vec!["older", "old"]);
+        assert_eq!(kept, 1);
+    }
+
+    #[test]
+    fn budget_evicts_least_recently_used_first() {
+        let (deleted, kept) = run_plan(
+            vec![
+                candidate("b", HOUR * 3, 100, false),
+                candidate("a", HOUR * 4, 100, false),
+                candidate("d", HOUR * 5, 100, false),
+                candidate("c", HOUR * 2, 100, false),
+            ],
+            &GcPolicy {
+                max_bytes: Some(250),
+                ..Default::default()
+            },
+        );
+        assert_eq!(deleted, vec!["d", "a"]);
+        assert_eq!(kept, 2);
+    }
+
+    #[test]
+    fn budget_skips_young_and_referenced() {
+        let (deleted, kept) = run_plan(
+            vec![
+                candidate("young", HOUR / 2, 1000, false),
+                candidate("referenced", HOUR * 10, 1000, true),
+                candidate("unreferenced", HOUR * 5, 1000, false),
+                candidate("unreferenced-newer", HOUR * 2, 1000, false),
+            ],
+            &GcPolicy {
+                max_bytes: Some(0),
+                ..Default::default()
+            },
+        );
+        // everything that can be evicted is, but the budget cannot be met
+        assert_eq!(deleted, vec!["unreferenced", "unreferenced-newer"]);
+        assert_eq!(kept, 2);
+    }
+
+    #[test]
+    fn budget_already_met() {
+        let (deleted, kept) = run_plan(
+            vec![
+                candidate("a", HOUR * 5, 100, false),
+                candidate("b", HOUR * 2, 100, false),
+            ],
+            &GcPolicy {
+                max_bytes: Some(200),
+                ..Default::default()
+            },
+        );
+        assert_eq!(deleted, Vec::<String>::new());
+        assert_eq!(kept, 2);
+    }
+
+    #[test]
+    fn references() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let root = tmp.path();
+        std::fs::create_dir(root.join("subvol")).expect("failed to create dir");
+        std::fs::create_dir(root.join("other")).expect("failed to create dir");
+        let marker = root.join("marker");
+
+        // nothing recorded, so it cannot be known to be unreferenced
+        assert!(is_referenced(&root.join("subvol"), &marker));
+        std::fs::write(&marker, "").expect("failed to write marker");
+        assert!(is_referenced(&root.join("subvol"), &marker));
+
+        std::os::unix::fs::symlink(root.join("subvol"), root.join("out"))
+            .expect("failed to symlink");
+        std::fs::write(&marker, format!("{}\n", root.join("out").display()))
+            .expect("failed to write marker");
+        assert!(is_referenced(&root.join("subvol"), &marker));
+
+        // the output was rebuilt and now points somewhere else
+        std::fs::remove_file(root.join("out")).expect("failed to remove symlink");
+        std::os::unix::fs::symlink(root.join("other"), root.join("out"))
+            .expect("failed to symlink");
+        assert!(!is_referenced(&root.join("subvol"), &marker));
+
+        // or the output was deleted
+        std::fs::remove_file(root.join("out")).expect("failed to remove symlink");
+        assert!(!is_referenced(&root.join("subvol"), &marker));
+    }
+
+    #[test]
+    fn sizes_are_cached() {
+        let tmp = tempfile::tempdir().expect("failed to create tempdir");
+        let root = tmp.path();
+        std::fs::create_dir(root.join("subvol")).expect("failed to create dir");
+        std::fs::write(root.join("subvol/file"), vec![1u8; 1 << 16]).expect("failed to write");
+        let size_file = root.join("gc/subvol.size");
+        assert_eq!(read_size(&size_file), None);
+        let size = cached_size(&root.join("subvol"), &size_file);
+        assert!(size >= 1 << 16, "{size}");
+        assert_eq!(read_size(&size_file), Some(size));
+        // the cached size is used instead of walking the subvol again
+        std::fs::write(root.join("subvol/file2"), vec![1u8; 1 << 16]).expect("failed to write");
+        assert_eq!(cached_size(&root.join("subvol"), &size_file), size);
+    }
+}
@@ -27,6 +27,8 @@ use tracing::trace;
 use uuid::Uuid;
 
 mod gc;
+pub use gc::GcPolicy;
+pub use gc::GcReport;
 
 #[derive(Debug, thiserror::Error)]
 pub enum Error {
@@ -274,7 +274,6 @@ def _new_compressed_package_rule(
 _cpio, _cpio_anon = _new_package_rule(
     format = "cpio",
     sudo = True,
-    uses_build_appliance = True,
 )
 
 _cpio_gz = _new_compressed_package_rule(
@@ -375,7 +374,6 @@ _squashfs, squashfs_anon = _new_package_rule(
 _tar, tar_anon = _new_package_rule(
     format = "tar",
     sudo = True,
-    uses_build_appliance = True,
     force_extension = "tar",
     rule_attrs = {
         "preserve_xattrs": attrs.bool(default = True),
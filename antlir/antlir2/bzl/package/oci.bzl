@@ -8,9 +8,26 @@ load(":cfg.bzl", "layer_attrs", "package_cfg")
 load(":defs.bzl", "common_attrs", "default_attrs")
 load(":macro.bzl", "package_macro")
 
+# compression level of layer blobs
+_ZSTD_LEVEL = 15
+
+# How the tar and tar_zst of a layer were built, which (along with the
+# subvolumes and the packager itself) is the key that the packager caches
+# layer blobs by
+OciLayerBuild = record(
+    make_oci_layer = Artifact,
+    rootless = bool,
+    zstd_level = int,
+)
+
 OciLayer = record(
     tar = Artifact,
     tar_zst = Artifact,
+    # the subvolumes this layer was diffed from, which identify its contents
+    # in the packager's local blob cache
+    child_subvol = Artifact,
+    parent_subvol = Artifact | None,
+    build = OciLayerBuild,
 )
 
 OciLayersInfo = provider(fields = [
@@ -52,7 +69,7 @@ def _oci_layers_impl(ctx: AnalysisContext) -> list[Provider]:
             cmd_args(
                 "zstd",
                 "--compress",
-                "-15",
+                "-{}".format(_ZSTD_LEVEL),
                 "-T0",  # we like threads
                 tar,
                 "-o",
@@ -64,6 +81,13 @@ def _oci_layers_impl(ctx: AnalysisContext) -> list[Provider]:
         oci_layers.append((child_phase, OciLayer(
             tar = tar,
             tar_zst = tar_zst,
+            child_subvol = child_contents.subvol_symlink,
+            parent_subvol = parent.subvol_symlink if parent else None,
+            build = OciLayerBuild(
+                make_oci_layer = ctx.attrs._make_oci_layer[DefaultInfo].default_outputs[0],
+                rootless = ctx.attrs._rootless,
+                zstd_level = _ZSTD_LEVEL,
+            ),
         )))
 
     return [
@@ -107,14 +131,17 @@ def _impl(ctx: AnalysisContext) -> Promise:
             sub_targets_layers[str(i)] = [DefaultInfo(sub_targets = multi_layer_subtargets)]
 
         out = ctx.actions.declare_output(ctx.label.name, dir = True)
+        oci_spec = {
+            "deltas": deltas,
+            "entrypoint": ctx.attrs.entrypoint,
+            "ref": ctx.attrs.ref,
+            "target_arch": ctx.attrs._target_arch,
+        }
+        if ctx.attrs.blob_cache_max_bytes != None:
+            oci_spec["blob_cache_max_bytes"] = ctx.attrs.blob_cache_max_bytes
         spec = ctx.actions.write_json(
             "spec.json",
-            {"oci": {
-                "deltas": deltas,
-                "entrypoint": ctx.attrs.entrypoint,
-                "ref": ctx.attrs.ref,
-                "target_arch": ctx.attrs._target_arch,
-            }},
+            {"oci": oci_spec},
             with_inputs = True,
         )
         ctx.actions.run(
@@ -149,6 +176,12 @@ def _impl(ctx: AnalysisContext) -> Promise:
     ]).promise.map(_with_anon)
 
 oci_attrs = {
+    "blob_cache_max_bytes": attrs.option(
+        attrs.int(),
+        default = None,
+        doc = "Size budget of the packager's local cache of layer blobs (64 GiB " +
+              "if unset). 0 disables the cache.",
+    ),
     "entrypoint": attrs.list(attrs.string(), doc = "Command to run as the main process"),
     "ref": attrs.string(
         default = native.read_config("build_info", "revision", "local"),
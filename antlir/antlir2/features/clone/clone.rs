@@ -12,7 +12,8 @@ use std::os::unix::fs::MetadataExt;
 use std::path::Path;
 
 use antlir2_compile::CompilerContext;
-use antlir2_compile::util::copy_with_metadata;
+use antlir2_compile::util::CopyEntry;
+use antlir2_compile::util::copy_tree;
 use antlir2_depgraph_if::Requirement;
 use antlir2_depgraph_if::Validator;
 use antlir2_depgraph_if::item::FileType;
@@ -244,6 +245,17 @@ impl antlir2_compile::CompileFeature for Clone {
             .context("only subvol_symlink is supported")?
             .join_abs(&self.src_path)
             .canonicalize()?;
+        let src_facts = antlir2_facts::RoDatabase::open(&self.src_layer.facts_db)
+            .context("while opening src_layer facts db")?;
+        let fixed_ids = match &self.usergroup {
+            Some(usergroup) => Some((ctx.uid(&usergroup.user)?, ctx.gid(&usergroup.group)?)),
+            None => None,
+        };
+        // src id -> dst id, most trees only have a handful of distinct owners
+        let mut uids = HashMap::new();
+        let mut gids = HashMap::new();
+
+        let mut entries = Vec::new();
         for entry in WalkDir::new(&src_root) {
             let entry = entry.map_err(std::io::Error::from)?;
             if self.omit_outer_dir && entry.path() == src_root.as_path() {
@@ -272,54 +284,70 @@ impl antlir2_compile::CompileFeature for Clone {
             };
 
             let dst_path = ctx.dst_path(self.dst_path.join(relpath.as_ref()))?;
-            copy_with_metadata(entry.path(), &dst_path, None, None)?;
 
             // {ug}ids might not map to the same names in both images, so make
             // sure that we look up the src ids and copy the _names_ instead of
             // just the ids
-
-            let src_facts = antlir2_facts::RoDatabase::open(&self.src_layer.facts_db)
-                .context("while opening src_layer facts db")?;
-
             let meta = entry.metadata().map_err(std::io::Error::from)?;
-
-            let (new_uid, new_gid) = match &self.usergroup {
-                Some(usergroup) => (ctx.uid(&usergroup.user)?, ctx.gid(&usergroup.group)?),
-                None => (
-                    ctx.uid(
-                        src_facts
-                            .iter::<User>()
-                            .context("while iterating over src users")?
-                            .find(|u| u.id() == meta.uid())
-                            .with_context(|| {
-                                format!(
-                                    "src_layer {} missing entry for user id {}",
-                                    self.src_layer.label,
-                                    meta.uid()
-                                )
-                            })?
-                            .name(),
-                    )?,
-                    ctx.gid(
-                        src_facts
-                            .iter::<Group>()
-                            .context("while iterating over src groups")?
-                            .find(|g| g.id() == meta.gid())
-                            .with_context(|| {
-                                format!(
-                                    "src_layer {} missing entry for group id {}",
-                                    self.src_layer.label,
-                                    meta.gid()
-                                )
-                            })?
-                            .name(),
-                    )?,
-                ),
+            let (new_uid, new_gid) = match fixed_ids {
+                Some(ids) => ids,
+                None => {
+                    let new_uid = match uids.get(&meta.uid()) {
+                        Some(uid) => *uid,
+                        None => {
+                            let uid = ctx.uid(
+                                src_facts
+                                    .iter::<User>()
+                                    .context("while iterating over src users")?
+                                    .find(|u| u.id() == meta.uid())
+                                    .with_context(|| {
+                                        format!(
+                                            "src_layer {} missing entry for user id {}",
+                                            self.src_layer.label,
+                                            meta.uid()
+                                        )
+                                    })?
+                                    .name(),
+                            )?;
+                            uids.insert(meta.uid(), uid);
+                            uid
+                        }
+                    };
+                    let new_gid = match gids.get(&meta.gid()) {
+                        Some(gid) => *gid,
+                        None => {
+                            let gid = ctx.gid(
+                                src_facts
+                                    .iter::<Group>()
+                                    .context("while iterating over src groups")?
+                                    .find(|g| g.id() == meta.gid())
+                                    .with_context(|| {
+                                        format!(
+                                            "src_layer {} missing entry for group id {}",
+                                            self.src_layer.label,
+                                            meta.gid()
+                                        )
+                                    })?
+                                    .name(),
+                            )?;
+                            gids.insert(meta.gid(), gid);
+                            gid
+                        }
+                    };
+                    (new_uid, new_gid)
+                }
             };
 
-            tracing::trace!("lchown {}:{} {}", new_uid, new_gid, dst_path.display());
-            std::os::unix::fs::lchown(&dst_path, Some(new_uid.into()), Some(new_gid.into()))?;
+            tracing::trace!("chown {}:{} {}", new_uid, new_gid, dst_path.display());
+            entries.push(CopyEntry {
+                src: entry.path().to_owned(),
+                dst: dst_path,
+                is_dir: entry.file_type().is_dir(),
+                uid: Some(new_uid.into()),
+                gid: Some(new_gid.into()),
+            });
         }
+        copy_tree(&entries)?;
         Ok(())
     }
 }
@@ -14,6 +14,8 @@ use std::os::unix::fs::fchown;
 use std::path::Path;
 
 use antlir2_compile::CompilerContext;
+use antlir2_compile::util::CopyEntry;
+use antlir2_compile::util::copy_tree;
 use antlir2_compile::util::copy_with_metadata;
 use antlir2_depgraph_if::Requirement;
 use antlir2_depgraph_if::Validator;
@@ -342,6 +344,7 @@ impl antlir2_compile::CompileFeature for Install {
         };
         if self.is_dir() {
             debug!("{:?} is a dir", self.src);
+            let mut entries = Vec::new();
             for entry in WalkDir::new(&self.src) {
                 let entry = entry.map_err(std::io::Error::from)?;
                 let relpath = entry
@@ -364,13 +367,15 @@ impl antlir2_compile::CompileFeature for Install {
                     continue;
                 }
 
-                copy_with_metadata(
-                    entry.path(),
-                    &dst_path,
-                    Some(uid.as_raw()),
-                    Some(gid.as_raw()),
-                )?;
+                entries.push(CopyEntry {
+                    src: entry.path().to_owned(),
+                    dst: dst_path,
+                    is_dir: entry.file_type().is_dir(),
+                    uid: Some(uid.as_raw()),
+                    gid: Some(gid.as_raw()),
+                });
             }
+            copy_tree(&entries)?;
 
             let dir_path = ctx.dst_path(&self.dst)?;
             for (key, val) in self.xattrs.iter() {
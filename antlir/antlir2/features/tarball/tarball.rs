@@ -5,10 +5,15 @@
  * LICENSE file in the root directory of this source tree.
  */
 
+use std::collections::VecDeque;
 use std::fs::File;
 use std::io::BufReader;
+use std::io::ErrorKind;
+use std::io::Read;
+use std::ops::Range;
 use std::os::unix::ffi::OsStrExt;
 use std::path::PathBuf;
+use std::sync::mpsc::Receiver;
 
 use antlir2_compile::CompilerContext;
 use antlir2_depgraph_if::Requirement;
@@ -23,12 +28,16 @@ use antlir2_features::types::PathInLayer;
 use anyhow::Context;
 use anyhow::Result;
 use anyhow::anyhow;
-use flate2::read::GzDecoder;
+use flate2::read::MultiGzDecoder;
+use memmap2::Mmap;
+use rayon::prelude::*;
 use serde::Deserialize;
 use tar::Archive;
 use tempfile::TempDir;
+use tracing::debug;
 use tracing::warn;
 use zstd::stream::read::Decoder as ZstdDecoder;
+use zstd::zstd_safe;
 
 pub type Feature = Tarball;
 
@@ -40,46 +49,189 @@ pub struct Tarball {
     pub strip_components: usize,
 }
 
-enum ArchiveReader<'a> {
-    Uncompressed(BufReader<File>),
-    Gz(GzDecoder<BufReader<File>>),
-    Zstd(ZstdDecoder<'a, BufReader<BufReader<File>>>),
+/// Size of the chunks handed from a [ReadAhead] thread to its consumer
+const READ_AHEAD_CHUNK_SIZE: usize = 1 << 20;
+/// Number of chunks that a [ReadAhead] thread may get ahead of its consumer
+const READ_AHEAD_DEPTH: usize = 16;
+/// Frames that decompress to more than this are not decoded in parallel, since
+/// a whole batch of decompressed frames is held in memory at once.
+const MAX_PARALLEL_FRAME_SIZE: u64 = 32 << 20;
+
+/// Runs a [Read] implementation (file reads and decompression) on a dedicated
+/// thread, so that it is pipelined with whatever is consuming the stream
+/// (parsing the archive and writing out files).
+struct ReadAhead {
+    rx: Receiver<std::io::Result<Vec<u8>>>,
+    chunk: Vec<u8>,
+    pos: usize,
+}
+
+impl ReadAhead {
+    fn new<R: Read + Send + 'static>(mut inner: R) -> Self {
+        let (tx, rx) = std::sync::mpsc::sync_channel(READ_AHEAD_DEPTH);
+        std::thread::Builder::new()
+            .name("tarball-read".to_owned())
+            .spawn(move || {
+                loop {
+                    let mut chunk = vec![0; READ_AHEAD_CHUNK_SIZE];
+                    let res = match inner.read(&mut chunk) {
+                        Ok(0) => return,
+                        Ok(n) => {
+                            chunk.truncate(n);
+                            Ok(chunk)
+                        }
+                        Err(e) if e.kind() == ErrorKind::Interrupted => continue,
+                        Err(e) => Err(e),
+                    };
+                    let failed = res.is_err();
+                    // the consumer stopped reading (most likely because it
+                    // failed), so there is no point in continuing
+                    if tx.send(res).is_err() || failed {
+                        return;
+                    }
+                }
+            })
+            .expect("failed to spawn read-ahead thread");
+        Self {
+            rx,
+            chunk: Vec::new(),
+            pos: 0,
+        }
+    }
 }
 
-impl std::io::Read for ArchiveReader<'_> {
+impl Read for ReadAhead {
     fn read(&mut self, buf: &mut [u8]) -> std::io::Result<usize> {
-        match self {
-            ArchiveReader::Uncompressed(r) => r.read(buf),
-            ArchiveReader::Gz(r) => r.read(buf),
-            ArchiveReader::Zstd(r) => r.read(buf),
+        if self.pos == self.chunk.len() {
+            match self.rx.recv() {
+                Ok(chunk) => {
+                    self.chunk = chunk?;
+                    self.pos = 0;
+                }
+                // the reader thread is done
+                Err(_) => return Ok(0),
+            }
+        }
+        let n = std::cmp::min(buf.len(), self.chunk.len() - self.pos);
+        buf[..n].copy_from_slice(&self.chunk[self.pos..self.pos + n]);
+        self.pos += n;
+        Ok(n)
+    }
+}
+
+/// Decoder for zstd streams that consist of many independent frames (as
+/// produced by pzstd or antlir2's own package compression), which decodes
+/// batches of frames in parallel and returns them in order. A single frame
+/// stream (like the default output of `zstd -T0`) can only be decoded serially.
+struct ParallelZstdDecoder {
+    src: Mmap,
+    /// Compressed frames that have not yet been decoded
+    frames: VecDeque<(Range<usize>, usize)>,
+    decoded: VecDeque<Vec<u8>>,
+    pos: usize,
+}
+
+impl ParallelZstdDecoder {
+    /// Returns None if `file` is not a multi-frame zstd stream where every
+    /// frame declares a reasonably small decompressed size.
+    fn new(file: &File) -> std::io::Result<Option<Self>> {
+        // SAFETY: buck-out sources are never modified in place
+        let src = unsafe { Mmap::map(file) }?;
+        let mut frames = VecDeque::new();
+        let mut offset = 0;
+        while offset < src.len() {
+            let rest = &src[offset..];
+            let Ok(len) = zstd_safe::find_frame_compressed_size(rest) else {
+                // leave it to the streaming decoder to report a useful error
+                return Ok(None);
+            };
+            let content_size = match zstd_safe::get_frame_content_size(rest) {
+                Ok(Some(size)) if size <= MAX_PARALLEL_FRAME_SIZE => size as usize,
+                _ => return Ok(None),
+            };
+            if len == 0 {
+                return Ok(None);
+            }
+            frames.push_back((offset..offset + len, content_size));
+            offset += len;
+        }
+        if frames.len() < 2 {
+            return Ok(None);
+        }
+        debug!("decoding {} zstd frames in parallel", frames.len());
+        Ok(Some(Self {
+            src,
+            frames,
+            decoded: VecDeque::new(),
+            pos: 0,
+        }))
+    }
+}
+
+impl Read for ParallelZstdDecoder {
+    fn read(&mut self, buf: &mut [u8]) -> std::io::Result<usize> {
+        loop {
+            if let Some(front) = self.decoded.front() {
+                if self.pos < front.len() {
+                    let n = std::cmp::min(buf.len(), front.len() - self.pos);
+                    buf[..n].copy_from_slice(&front[self.pos..self.pos + n]);
+                    self.pos += n;
+                    return Ok(n);
+                }
+                self.decoded.pop_front();
+                self.pos = 0;
+                continue;
+            }
+            if self.frames.is_empty() {
+                return Ok(0);
+            }
+            let batch: Vec<_> = self
+                .frames
+                .drain(..std::cmp::min(self.frames.len(), rayon::current_num_threads() * 2))
+                .collect();
+            let src = &self.src;
+            self.decoded = batch
+                .into_par_iter()
+                .map(|(range, content_size)| zstd::bulk::decompress(&src[range], content_size))
+                .collect::<std::io::Result<_>>()?;
         }
     }
 }
 
 impl Tarball {
     #[tracing::instrument(err)]
-    fn open_archive(&self) -> Result<Archive<ArchiveReader>> {
+    fn open_archive(&self) -> Result<Archive<ReadAhead>> {
         let extension = self.src.extension().with_context(|| {
             format!(
                 "archive must have extension, but got '{}'",
                 self.src.display()
             )
         })?;
-        let file = BufReader::new(
-            File::open(&self.src)
-                .with_context(|| format!("while opening {}", self.src.display()))?,
-        );
-        match extension.as_bytes() {
-            b"tar" => Ok(Archive::new(ArchiveReader::Uncompressed(file))),
-            b"gz" => Ok(Archive::new(ArchiveReader::Gz(GzDecoder::new(file)))),
-            b"zst" | b"zstd" => Ok(Archive::new(ArchiveReader::Zstd(
-                ZstdDecoder::new(file).expect("infallible since no dictionary is being used"),
-            ))),
-            _ => Err(anyhow!(
-                "invalid tar extension: {}",
-                extension.to_string_lossy(),
-            )),
-        }
+        let file = File::open(&self.src)
+            .with_context(|| format!("while opening {}", self.src.display()))?;
+        // Decompression happens on the read-ahead thread, which leaves the
+        // calling thread free to parse entries and write them out.
+        let reader = match extension.as_bytes() {
+            b"tar" => ReadAhead::new(file),
+            // archives may have more than one gzip member (for example, if they
+            // were compressed in parallel blocks), and all of them must be read
+            b"gz" => ReadAhead::new(MultiGzDecoder::new(BufReader::new(file))),
+            b"zst" | b"zstd" => {
+                match ParallelZstdDecoder::new(&file).context("while scanning zstd frames")? {
+                    Some(decoder) => ReadAhead::new(decoder),
+                    None => ReadAhead::new(
+                        ZstdDecoder::new(file).context("while creating zstd decoder")?,
+                    ),
+                }
+            }
+            _ => {
+                return Err(anyhow!(
+                    "invalid tar extension: {}",
+                    extension.to_string_lossy(),
+                ));
+            }
+        };
+        Ok(Archive::new(reader))
     }
 }
 
@@ -209,3 +361,41 @@ impl antlir2_compile::CompileFeature for Tarball {
         Ok(())
     }
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn parallel_zstd_frames() {
+        let data: Vec<u8> = (0..(3 << 20)).map(|i| (i % 251) as u8).collect();
+        let mut compressed = Vec::new();
+        for block in data.chunks(1 << 20) {
+            compressed.extend(zstd::bulk::compress(block, 3).expect("failed to compress"));
+        }
+        let tmp = tempfile::NamedTempFile::new().expect("failed to create tempfile");
+        std::fs::write(tmp.path(), &compressed).expect("failed to write");
+
+        let decoder = ParallelZstdDecoder::new(tmp.as_file())
+            .expect("failed to scan frames")
+            .expect("multi-frame stream must be decoded in parallel");
+        assert_eq!(decoder.frames.len(), 3);
+        let mut decoded = Vec::new();
+        ReadAhead::new(decoder)
+            .read_to_end(&mut decoded)
+            .expect("failed to decode");
+        assert!(decoded == data);
+
+        // a single frame stream falls back to the streaming decoder
+        std::fs::write(
+            tmp.path(),
+            zstd::bulk::compress(&data, 3).expect("failed to compress"),
+        )
+        .expect("failed to write");
+        assert!(
+            ParallelZstdDecoder::new(&File::open(tmp.path()).expect("failed to open"))
+                .expect("failed to scan frames")
+                .is_none()
+        );
+    }
+}
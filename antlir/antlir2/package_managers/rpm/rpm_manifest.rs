@@ -80,7 +80,16 @@ fn main() -> Result<()> {
     let args = Args::parse();
     let db = RoDatabase::open(&args.facts_db).context("while opening facts db")?;
     let mut out = BufWriter::new(File::create(&args.out).context("while creating output file")?);
-    let rpms = db.iter::<Rpm>()?.map(ManifestRpm::from).collect();
+    let rpms = db
+        .iter::<Rpm>()?
+        .map(|mut rpm| {
+            // changelogs are stored out-of-line and must be explicitly loaded
+            // to find any patched CVEs
+            db.load_rpm_changelog(&mut rpm)
+                .with_context(|| format!("while loading changelog for {rpm}"))?;
+            Ok(ManifestRpm::from(rpm))
+        })
+        .collect::<Result<_>>()?;
     let manifests = Manifest { rpms };
     serde_json::to_writer(&mut out, &manifests).context("while serializing manifest")?;
     Ok(())
@@ -610,6 +610,8 @@ mod tests {
     use std::collections::BTreeSet;
     use std::fmt::Write;
     use std::io::Cursor;
+    use std::time::Duration;
+    use std::time::Instant;
 
     use similar_asserts::SimpleDiff;
 
@@ -706,4 +708,85 @@ mod tests {
             panic!("sendstream did not include some commands: {:?}", missing,);
         }
     }
+
+    #[test]
+    fn iterate_demo() {
+        let data = include_bytes!("../testdata/demo.sendstream");
+        let mut parsed_txt = String::new();
+        let mut sendstream_index = 0;
+        let mut num_cmds_parsed = 0;
+        for cmd in wire::commands(data) {
+            let cmd = cmd.expect("while parsing");
+            serialize_cmd(&mut sendstream_index, &mut parsed_txt, &cmd);
+            num_cmds_parsed += 1;
+        }
+        let good_txt = include_str!("../testdata/demo.txt");
+        if parsed_txt != good_txt {
+            panic!(
+                "{}",
+                SimpleDiff::from_str(&parsed_txt, good_txt, "parsed", "good")
+            )
+        }
+        assert_eq!(num_cmds_parsed, 94);
+    }
+
+    #[test]
+    fn iterate_truncated() {
+        let data = include_bytes!("../testdata/demo.sendstream");
+        // chop off the final End command
+        let cmds: Vec<_> = wire::commands(&data[..data.len() - 10]).collect();
+        assert_eq!(cmds.len(), 94);
+        assert!(cmds[..93].iter().all(|c| c.is_ok()));
+        assert!(matches!(cmds[93], Err(Error::Incomplete)), "{:?}", cmds[93]);
+    }
+
+    fn report(name: &str, cmds: usize, bytes: usize, elapsed: Duration) {
+        eprintln!(
+            "{name}: {cmds} commands ({bytes} bytes) in {elapsed:?}: {:.1} MB/s, {:.0} commands/s",
+            bytes as f64 / elapsed.as_secs_f64() / 1e6,
+            cmds as f64 / elapsed.as_secs_f64(),
+        );
+    }
+
+    /// Not much of an assertion, but compares the throughput of the async
+    /// parser and the mapped iterator on a synthetically scaled up copy of the
+    /// demo sendstream. This is a benchmark, so it only runs with --ignored.
+    #[tokio::test]
+    #[ignore]
+    async fn bench_scaled_demo() {
+        const COPIES: usize = 200;
+        let data = include_bytes!("../testdata/demo.sendstream").repeat(COPIES);
+        let path = std::env::temp_dir().join(format!(
+            "sendstream_parser-bench-{}.sendstream",
+            std::process::id()
+        ));
+        std::fs::write(&path, &data).expect("while writing scaled sendstream");
+
+        let start = Instant::now();
+        let num_cmds_parsed = wire::parse(Cursor::new(&data), |_| wire::ParserControl::KeepGoing)
+            .await
+            .expect("while parsing");
+        report(
+            "async",
+            num_cmds_parsed as usize,
+            data.len(),
+            start.elapsed(),
+        );
+        assert_eq!(num_cmds_parsed, 94 * COPIES as u128);
+
+        let start = Instant::now();
+        let mapped = wire::MappedSendstream::open(&path).expect("while mapping");
+        let mut num_cmds_parsed = 0;
+        let mut data_bytes = 0;
+        for cmd in mapped.commands() {
+            if let Command::Write(w) = cmd.expect("while parsing") {
+                data_bytes += w.data().len();
+            }
+            num_cmds_parsed += 1;
+        }
+        report("mapped", num_cmds_parsed, data.len(), start.elapsed());
+        std::fs::remove_file(&path).expect("while removing scaled sendstream");
+        assert_eq!(num_cmds_parsed, 94 * COPIES);
+        assert!(data_bytes > 0);
+    }
 }
@@ -5,6 +5,9 @@
  * LICENSE file in the root directory of this source tree.
  */
 
+use std::fs::File;
+use std::path::Path;
+
 use nom::IResult;
 use nom::Parser as _;
 
@@ -13,7 +16,11 @@ static MAGIC_HEADER: &[u8] = b"btrfs-stream\0";
 pub(crate) mod cmd;
 mod tlv;
 
+use bytes::Buf as _;
 use bytes::BytesMut;
+use memmap2::Advice;
+use memmap2::Mmap;
+use memmap2::UncheckedAdvice;
 use tokio::io::AsyncRead;
 use tokio::io::AsyncReadExt;
 
@@ -33,6 +40,11 @@ fn parse_header<'a>(input: &'a [u8]) -> IResult<&'a [u8], u32> {
     Ok((remainder, version))
 }
 
+/// How much to try to read from the source at once. Commands are at most a
+/// little over 64KiB, so this is usually enough to parse several commands
+/// without going back to the reader.
+const READ_SIZE: usize = 256 << 10;
+
 /// Parse an async source of bytes, expecting to find it to contain one or more sendstreams.
 /// Because the parsed commands reference data owned by the source, we do not collect the commands.
 /// Instead, we allow the caller to process them via `f`, which can instruct the processing to
@@ -50,14 +62,17 @@ where
     R: AsyncRead + Unpin + Send,
     F: FnMut(&crate::Command<'_>) -> ParserControl + Send,
 {
-    let mut unparsed = BytesMut::with_capacity(1000);
+    let mut unparsed = BytesMut::with_capacity(READ_SIZE);
     let mut command_count = 0;
     let mut header: Option<u32> = None;
     'read_bytes: loop {
+        // parsed commands are consumed from the front of the buffer without
+        // copying the rest, this lets BytesMut reclaim that space
+        unparsed.reserve(READ_SIZE);
         let bytes_read = reader.read_buf(&mut unparsed).await?;
         if bytes_read != 0 || !unparsed.is_empty() {
             while header.is_some() {
-                match crate::Command::parse(&unparsed) {
+                let consumed = match crate::Command::parse(&unparsed) {
                     Ok((remainder, command)) => {
                         command_count += 1;
                         if let ParserControl::Enough = f(&command) {
@@ -65,11 +80,9 @@ where
                             return Ok(command_count);
                         }
                         if let crate::Command::End = command {
-                            unparsed = remainder.into();
                             header = None;
-                            continue 'read_bytes;
                         }
-                        unparsed = remainder.into();
+                        unparsed.len() - remainder.len()
                     }
                     Err(nom::Err::Error(err)) | Err(nom::Err::Failure(err)) => {
                         Err(crate::Error::Unparsable(format!("{err:?}")))?
@@ -77,16 +90,21 @@ where
                     Err(nom::Err::Incomplete(_)) => {
                         if bytes_read == 0 {
                             // we've found extra data that cannot be parsed w/nothing more to read
-                            Err(crate::Error::TrailingData(unparsed.clone().into()))?
+                            Err(crate::Error::TrailingData(unparsed.to_vec()))?
                         }
                         continue 'read_bytes;
                     }
+                };
+                unparsed.advance(consumed);
+                if header.is_none() {
+                    continue 'read_bytes;
                 }
             }
             match parse_header(&unparsed) {
-                Ok((remainder, _version)) => {
-                    header = Some(_version);
-                    unparsed = remainder.into();
+                Ok((remainder, version)) => {
+                    header = Some(version);
+                    let consumed = unparsed.len() - remainder.len();
+                    unparsed.advance(consumed);
                 }
                 Err(nom::Err::Error(err)) | Err(nom::Err::Failure(err)) => {
                     Err(crate::Error::Unparsable(format!("{err:?}")))?
@@ -103,3 +121,148 @@ where
     }
     Ok(command_count)
 }
+
+/// Iterate over the commands in a buffer that holds one or more complete
+/// sendstreams (with the same expectations as [parse]).
+///
+/// Unlike [parse], this does not need to copy anything: every [crate::Command]
+/// borrows its paths and data directly from `input`, so it can be kept around
+/// for as long as `input` is. Iteration stops after the first error.
+pub fn commands(input: &[u8]) -> Commands<'_> {
+    Commands {
+        input,
+        len: input.len(),
+        in_stream: false,
+        done: false,
+        map: None,
+        released: 0,
+    }
+}
+
+/// See [commands] and [MappedSendstream::commands]
+pub struct Commands<'a> {
+    input: &'a [u8],
+    /// Length of the original input
+    len: usize,
+    in_stream: bool,
+    done: bool,
+    /// When iterating over a mapped file, pages that have already been parsed
+    /// are periodically released, so that the resident size of an arbitrarily
+    /// large sendstream stays bounded
+    map: Option<&'a Mmap>,
+    released: usize,
+}
+
+/// Parsed pages of a mapped sendstream are released in chunks of this size
+const RELEASE_SIZE: usize = 64 << 20;
+
+impl<'a> Commands<'a> {
+    /// Number of bytes of the input that have been parsed so far
+    pub fn offset(&self) -> usize {
+        self.len - self.input.len()
+    }
+
+    fn fail(&mut self, err: nom::Err<nom::error::Error<&[u8]>>) -> crate::Error {
+        self.done = true;
+        match err {
+            nom::Err::Incomplete(_) => crate::Error::Incomplete,
+            nom::Err::Error(err) | nom::Err::Failure(err) => {
+                crate::Error::Unparsable(format!("{err:?}"))
+            }
+        }
+    }
+
+    fn maybe_release(&mut self) {
+        let Some(map) = self.map else {
+            return;
+        };
+        let offset = self.offset();
+        if offset - self.released < RELEASE_SIZE {
+            return;
+        }
+        let end = offset - offset % page_size();
+        // SAFETY: the mapping is a read-only mapping of a file, so dropping
+        // pages only means that they are read back in from the file if any
+        // command that is still alive touches them again
+        let _ = unsafe {
+            map.unchecked_advise_range(
+                UncheckedAdvice::DontNeed,
+                self.released,
+                end - self.released,
+            )
+        };
+        self.released = end;
+    }
+}
+
+impl<'a> Iterator for Commands<'a> {
+    type Item = crate::Result<crate::Command<'a>>;
+
+    fn next(&mut self) -> Option<Self::Item> {
+        if self.done {
+            return None;
+        }
+        if !self.in_stream {
+            if self.input.is_empty() {
+                self.done = true;
+                return None;
+            }
+            match parse_header(self.input) {
+                Ok((remainder, _version)) => {
+                    self.input = remainder;
+                    self.in_stream = true;
+                }
+                Err(err) => return Some(Err(self.fail(err))),
+            }
+        }
+        match crate::Command::parse(self.input) {
+            Ok((remainder, command)) => {
+                self.input = remainder;
+                if let crate::Command::End = command {
+                    self.in_stream = false;
+                }
+                self.maybe_release();
+                Some(Ok(command))
+            }
+            Err(err) => Some(Err(self.fail(err))),
+        }
+    }
+}
+
+fn page_size() -> usize {
+    nix::unistd::sysconf(nix::unistd::SysconfVar::PAGE_SIZE)
+        .ok()
+        .flatten()
+        .map_or(4096, |size| size as usize)
+}
+
+/// A sendstream file that is mapped into memory, so that it can be parsed
+/// without reading (and copying) it into a buffer first.
+pub struct MappedSendstream {
+    map: Mmap,
+}
+
+impl MappedSendstream {
+    pub fn open(path: impl AsRef<Path>) -> crate::Result<Self> {
+        let file = File::open(path)?;
+        // SAFETY: sendstreams are written once and not modified while they
+        // are being parsed
+        let map = unsafe { Mmap::map(&file)? };
+        // readahead is much more useful than keeping pages around once they
+        // have been parsed
+        let _ = map.advise(Advice::Sequential);
+        Ok(Self { map })
+    }
+
+    pub fn as_bytes(&self) -> &[u8] {
+        &self.map
+    }
+
+    /// Iterate over the commands in the file, see [commands].
+    pub fn commands(&self) -> Commands<'_> {
+        Commands {
+            map: Some(&self.map),
+            ..commands(&self.map)
+        }
+    }
+}
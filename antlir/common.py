@@ -6,19 +6,24 @@
 
 "Utilities to make Python systems programming more palatable."
 
+import asyncio
 import inspect
 import logging
 import os
 import platform
+import random
 import sys
+import threading
 import time
-from collections.abc import Callable, Iterable
+from collections.abc import Awaitable, Callable, Iterable
 from functools import wraps
 from typing import TypeVar
 
 
 T = TypeVar("T")
 _mockable_retry_fn_sleep = time.sleep
+_mockable_async_retry_fn_sleep = asyncio.sleep
+_mockable_retry_fn_random = random.random
 _mockable_platform_release = platform.release
 
 
@@ -92,13 +97,81 @@ def not_none(var: T | None, var_name: str = "", detail: str | None = None) -> T:
     raise AssertionError(f"{expr_str} must not be None{detail_str}")
 
 
+class RetryBudget:
+    """A retry budget that can be shared by many callers of `retry_fn` and
+    friends, to keep a failing dependency from causing a retry storm.
+
+    Every retry spends one token, and every call that succeeds without
+    retrying earns `ratio` tokens back, up to `max_tokens` (which is also the
+    initial balance).  Once the budget is spent, failures are re-raised
+    immediately, until enough calls have succeeded again.
+    """
+
+    def __init__(self, *, max_tokens: float = 10, ratio: float = 0.1) -> None:
+        self.max_tokens = max_tokens
+        self.ratio = ratio
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+
+def backoff_delays(
+    initial: float, retries: int, *, factor: float = 2, max_delay: float = 60
+) -> list[float]:
+    """Exponential backoff delays for `retry_fn` and friends: `initial`,
+    `initial * factor`, ... capped at `max_delay` seconds.  Combine with
+    `jitter` to keep many clients from retrying in lockstep."""
+    return [min(max_delay, initial * factor**i) for i in range(retries)]
+
+
+def _jittered(delay: float, jitter: float) -> float:
+    # `jitter` is the fraction of the delay that is random, so 1 sleeps for
+    # anywhere between 0 and `delay` ("full jitter")
+    return delay * (1 - jitter * _mockable_retry_fn_random()) if jitter else delay
+
+
+def _log_retry(
+    what: str | Callable[[], str],
+    i: int,
+    delays: Iterable[float],
+    delay: float,
+    log_exception: bool,
+) -> None:
+    level = logging.ERROR if log_exception else logging.DEBUG
+    if not log.isEnabledFor(level):
+        return
+    # `what` can be a function so that messages are only formatted on failure
+    if callable(what):
+        what = what()
+    log.log(
+        level,
+        # pyre-fixme[6]: Expected `Sized` for 1st param but got
+        #  `Iterable[float]`.
+        f"\n\n[Retry {i + 1} of {len(delays)}] {what} -- waiting "
+        f"{delay} seconds.\n\n",
+        exc_info=log_exception,
+    )
+
+
 def retry_fn(
     retryable_fn: Callable[[], T],
     is_exception_retryable: Callable[[Exception], bool] | None = None,
     *,
     delays: Iterable[float],
-    what: str,
+    what: str | Callable[[], str],
     log_exception: bool = True,
+    jitter: float = 0,
+    budget: RetryBudget | None = None,
 ) -> T:
     """Allows functions to be retried `len(delays)` times, with each iteration
     sleeping for its respective index into `delays`. `is_exception_retryable`
@@ -106,39 +179,50 @@ def retry_fn(
     evaluate to False, at which case no retry will occur and the exception will
     be re-raised. If the exception is not re-raised, the retry message will be
     logged to either DEBUG or ERROR depending whether `log_exception` is True.
+    `what` can also be a function returning the message, which is only called
+    if a retry is actually logged.
 
-    Delays are in seconds.
+    Delays are in seconds (see `backoff_delays`), and `jitter` (from 0 to 1)
+    is the fraction of each delay that is randomized.  If a `budget` is
+    given, a retry is only made if the budget allows it.
     """
     for i, delay in enumerate(delays):
         try:
-            return retryable_fn()
+            result = retryable_fn()
         except Exception as e:
             if is_exception_retryable and not is_exception_retryable(e):
                 raise
-            log.log(
-                logging.ERROR if log_exception else logging.DEBUG,
-                # pyre-fixme[6]: Expected `Sized` for 1st param but got
-                #  `Iterable[float]`.
-                f"\n\n[Retry {i + 1} of {len(delays)}] {what} -- waiting "
-                f"{delay} seconds.\n\n",
-                exc_info=log_exception,
-            )
+            if budget is not None and not budget.try_spend():
+                raise
+            delay = _jittered(delay, jitter)
+            _log_retry(what, i, delays, delay, log_exception)
             _mockable_retry_fn_sleep(delay)
+        else:
+            if budget is not None and i == 0:
+                budget.record_success()
+            return result
     return retryable_fn()  # With 0 retries, we should still run the function.
 
 
+def _lazy_format(format_msg: str, fn, args, kwargs) -> Callable[[], str]:
+    # `getcallargs` is relatively slow, so only do it if the message is needed
+    return lambda: format_msg.format(**inspect.getcallargs(fn, *args, **kwargs))
+
+
 def retryable(
     format_msg: str,
     delays: Iterable[float],
     *,
     is_exception_retryable: Callable[[Exception], bool] | None = None,
     log_exception: bool = True,
+    jitter: float = 0,
+    budget: RetryBudget | None = None,
 ):
     """Decorator used to retry a function if exceptions are thrown. `format_msg`
     should be a format string that can access any args provided to the
     decorated function. `delays` are the delays between retries, in seconds.
-    `is_exception_retryable` and `log_exception` are forwarded to `retry_fn`,
-    see its docblock.
+    `is_exception_retryable`, `log_exception`, `jitter` and `budget` are
+    forwarded to `retry_fn`, see its docblock.
     """
     # Prevent aliasing, iterator exhaustion, and other weirdness.
     # Indeterminate retry would require changing the API anyway.
@@ -147,13 +231,14 @@ def retryable(
     def wrapper(fn):
         @wraps(fn)
         def decorated(*args, **kwargs):
-            fn_args = inspect.getcallargs(fn, *args, **kwargs)
             return retry_fn(
                 lambda: fn(*args, **kwargs),
                 is_exception_retryable,
                 delays=delays,
-                what=format_msg.format(**fn_args),
+                what=_lazy_format(format_msg, fn, args, kwargs),
                 log_exception=log_exception,
+                jitter=jitter,
+                budget=budget,
             )
 
         return decorated
@@ -162,36 +247,36 @@ def retryable(
 
 
 async def async_retry_fn(
-    retryable_fn: Callable[[], T],
+    retryable_fn: Callable[[], Awaitable[T]],
     is_exception_retryable: Callable[[Exception], bool] | None = None,
     *,
     delays: Iterable[float],
-    what: str,
+    what: str | Callable[[], str],
     log_exception: bool = True,
+    jitter: float = 0,
+    budget: RetryBudget | None = None,
 ) -> T:
-    """Similar to retry_fn except the function is executed asynchronously.
-    See retry_fn docblock for details.
+    """Similar to retry_fn except the function is executed asynchronously,
+    and the delays do not block the event loop, so other tasks keep running
+    while this one waits to retry.  See retry_fn docblock for details.
     """
     for i, delay in enumerate(delays):
         try:
-            # pyre-fixme[12]: Expected an awaitable but got `T`.
-            return await retryable_fn()
+            result = await retryable_fn()
         except Exception as e:
             if is_exception_retryable and not is_exception_retryable(e):
                 raise
-            log.log(
-                logging.ERROR if log_exception else logging.DEBUG,
-                # pyre-fixme[6]: Expected `Sized` for 1st param but got
-                #  `Iterable[float]`.
-                f"\n\n[Retry {i + 1} of {len(delays)}] {what} -- waiting "
-                f"{delay} seconds.\n\n",
-                exc_info=log_exception,
-            )
-            time.sleep(delay)
-    return (
-        # pyre-fixme[12]: Expected an awaitable but got `T`.
-        await retryable_fn()
-    )  # With 0 retries, we should still run the function.
+            if budget is not None and not budget.try_spend():
+                raise
+            delay = _jittered(delay, jitter)
+            _log_retry(what, i, delays, delay, log_exception)
+            await _mockable_async_retry_fn_sleep(delay)
+        else:
+            if budget is not None and i == 0:
+                budget.record_success()
+            return result
+    # With 0 retries, we should still run the function.
+    return await retryable_fn()
 
 
 def async_retryable(
@@ -200,12 +285,14 @@ def async_retryable(
     *,
     is_exception_retryable: Callable[[Exception], bool] | None = None,
     log_exception: bool = True,
+    jitter: float = 0,
+    budget: RetryBudget | None = None,
 ):
     """Decorator used to retry an asynchronous function if exceptions are
     thrown. `format_msg` should be a format string that can access any args
     provided to the decorated function. `delays` are the delays between
-    retries, in seconds. `is_exception_retryable` and `log_exception` are
-    forwarded to `async_retry_fn`, see its docblock.
+    retries, in seconds. `is_exception_retryable`, `log_exception`, `jitter`
+    and `budget` are forwarded to `async_retry_fn`, see its docblock.
     """
     # Prevent aliasing, iterator exhaustion, and other weirdness.
     # Indeterminate retry would require changing the API anyway.
@@ -214,13 +301,14 @@ def async_retryable(
     def wrapper(fn):
         @wraps(fn)
         async def decorated(*args, **kwargs):
-            fn_args = inspect.getcallargs(fn, *args, **kwargs)
             return await async_retry_fn(
                 lambda: fn(*args, **kwargs),
                 is_exception_retryable,
                 delays=delays,
-                what=format_msg.format(**fn_args),
+                what=_lazy_format(format_msg, fn, args, kwargs),
                 log_exception=log_exception,
+                jitter=jitter,
+                budget=budget,
             )
 
         return decorated
@@ -23,64 +23,123 @@ Future: Once `deepfrozen` is landed, this sort of thing should get nicer.
 
 from collections.abc import Mapping
 from enum import Enum
-from types import MappingProxyType
 
 
 # Classes inheriting from this are ignored by freeze().
 class DoNotFreeze:
-    pass
+    __slots__ = ()
 
 
-class frozendict(Mapping, tuple, DoNotFreeze):
-    __slots__ = ()
+class frozendict(Mapping, DoNotFreeze):
+    """
+    An immutable, hashable `dict`.  Equality is the same as for `dict`, and
+    the (order-insensitive) hash is only computed once, since frozendicts
+    are commonly used as set members and dict keys.
+    """
+
+    __slots__ = ("_d", "_hash")
 
     def __new__(cls, *args, **kwargs):
-        return tuple.__new__(cls, (MappingProxyType(dict(*args, **kwargs)),))
+        self = object.__new__(cls)
+        self._d = dict(*args, **kwargs)
+        return self
+
+    def __reduce__(self):
+        return (type(self), (self._d,))
 
     def __contains__(self, key):
-        return key in tuple.__getitem__(self, 0)
+        return key in self._d
 
     def __getitem__(self, key):
-        return tuple.__getitem__(self, 0)[key]
+        return self._d[key]
 
     def __len__(self) -> int:
-        return len(tuple.__getitem__(self, 0))
+        return len(self._d)
 
     def __iter__(self):
-        return iter(tuple.__getitem__(self, 0))
+        return iter(self._d)
 
     def keys(self):
-        return tuple.__getitem__(self, 0).keys()
+        return self._d.keys()
 
     def values(self):
-        return tuple.__getitem__(self, 0).values()
+        return self._d.values()
 
     def items(self):
-        return tuple.__getitem__(self, 0).items()
+        return self._d.items()
 
     def get(self, key, default=None):
-        return tuple.__getitem__(self, 0).get(key, default)
+        return self._d.get(key, default)
 
     def __eq__(self, other):
-        if isinstance(other, __class__):
-            other = tuple.__getitem__(other, 0)
-        return tuple.__getitem__(self, 0).__eq__(other)
+        if isinstance(other, frozendict):
+            if self is other:
+                return True
+            other = other._d
+        return self._d == other
 
     def __ne__(self, other) -> bool:
         return not self == other
 
     def __repr__(self) -> str:
-        return f"{type(self).__name__}({repr(dict(tuple.__getitem__(self, 0)))})"
+        return f"{type(self).__name__}({repr(self._d)})"
 
     def __hash__(self) -> int:
-        # Although python dictionaries are order preserving,
-        # we hash order-insensitive because that's how dict equality works.
-        return hash(frozenset(self.items()))  # Future: more efficient hash?
+        try:
+            return self._hash
+        except AttributeError:
+            # Although python dictionaries are order preserving,
+            # we hash order-insensitive because that's how dict equality
+            # works.  Computed lazily, since the values may be unhashable.
+            self._hash = hash(frozenset(self._d.items()))
+            return self._hash
+
+
+_PRIMITIVES = (bytes, Enum, float, int, str, type(None))
+
+# How to freeze each kind of container, see `_kind`
+_TUPLE, _NAMEDTUPLE, _DICT, _SET, _AS_IS = range(5)
+
+_MISSING = object()
+
+
+def _is_namedtuple(obj) -> bool:
+    # This is a lame-o way of identifying `NamedTuple`s. Using
+    # `deepfrozen` would avoid this kludge.
+    return (
+        isinstance(obj, tuple)
+        and hasattr(obj, "_replace")
+        and hasattr(obj, "_fields")
+        and hasattr(obj, "_make")
+    )
+
+
+def _kind(obj) -> int:
+    # Exact built-in types are by far the most common, so avoid the
+    # `isinstance` / `hasattr` chain for them.
+    t = type(obj)
+    if t is list or t is tuple:
+        return _TUPLE
+    if t is dict:
+        return _DICT
+    if t is set or t is frozenset:
+        return _SET
+    if _is_namedtuple(obj):
+        return _NAMEDTUPLE
+    if isinstance(obj, (list, tuple)):
+        return _TUPLE
+    if isinstance(obj, dict):
+        return _DICT
+    if isinstance(obj, (set, frozenset)):
+        return _SET
+    if isinstance(obj, DoNotFreeze):
+        return _AS_IS
+    raise NotImplementedError(t)
 
 
 def freeze(obj, *, _memo=None, **kwargs):
     # Don't bother memoizing primitive types
-    if isinstance(obj, (bytes, Enum, float, int, str, type(None))):
+    if isinstance(obj, _PRIMITIVES):
         return obj
 
     if _memo is None:
@@ -91,32 +150,95 @@ def freeze(obj, *, _memo=None, **kwargs):
 
     if hasattr(obj, "freeze"):
         frozen = obj.freeze(_memo=_memo, **kwargs)
-    else:
-        # At the moment, I don't have a need for passing extra data into
-        # items that live inside containers.  If we're relaxing this, just
-        # be sure to add `**kwargs` to each `freeze()` call below.
-        assert kwargs == {}, kwargs
-        # This is a lame-o way of identifying `NamedTuple`s. Using
-        # `deepfrozen` would avoid this kludge.
-        if (
-            isinstance(obj, tuple)
-            and hasattr(obj, "_replace")
-            and hasattr(obj, "_fields")
-            and hasattr(obj, "_make")
-        ):
-            frozen = obj._make(freeze(i, _memo=_memo) for i in obj)
-        elif isinstance(obj, (list, tuple)):
-            frozen = tuple(freeze(i, _memo=_memo) for i in obj)
-        elif isinstance(obj, dict):
-            frozen = frozendict(
-                {freeze(k, _memo=_memo): freeze(v, _memo=_memo) for k, v in obj.items()}
-            )
-        elif isinstance(obj, (set, frozenset)):
-            frozen = frozenset(freeze(i, _memo=_memo) for i in obj)
-        elif isinstance(obj, DoNotFreeze):
-            frozen = obj
+        _memo[id(obj)] = frozen
+        return frozen
+
+    # At the moment, I don't have a need for passing extra data into
+    # items that live inside containers.  If we're relaxing this, just
+    # be sure to add `**kwargs` to each `freeze()` call below.
+    assert kwargs == {}, kwargs
+    return _freeze_tree(obj, _memo)
+
+
+def _freeze_tree(root, memo):
+    """
+    Iteratively freezes a tree of containers, so that deep inputs cannot hit
+    the recursion limit.
+
+    Immutable containers (`tuple`, `frozenset` and `NamedTuple`) whose items
+    are already frozen are returned as-is instead of being copied.  Every
+    container is added to `memo`, including the as-is ones, so that a
+    subtree that is shared by many parents is only walked once.
+    """
+
+    # Each frame is [obj, kind, items to freeze, next index, frozen items,
+    # whether any item changed]. Dicts are flattened to [k0, v0, k1, ...].
+    def new_frame(obj):
+        kind = _kind(obj)
+        if kind == _AS_IS:
+            return None
+        if kind == _DICT:
+            items = [x for kv in obj.items() for x in kv]
+        elif kind == _SET:
+            items = list(obj)
         else:
-            raise NotImplementedError(type(obj))
-
-    _memo[id(obj)] = frozen
-    return frozen
+            items = obj
+        return [obj, kind, items, 0, [], False]
+
+    root_frame = new_frame(root)
+    if root_frame is None:
+        return root
+    stack = [root_frame]
+    in_progress = {id(root)}
+    while True:
+        frame = stack[-1]
+        obj, kind, items, i, out, changed = frame
+        pushed = False
+        while i < len(items):
+            item = items[i]
+            i += 1
+            if isinstance(item, _PRIMITIVES):
+                out.append(item)
+                continue
+            item_id = id(item)
+            frozen = memo.get(item_id, _MISSING)
+            if frozen is _MISSING:
+                if hasattr(item, "freeze"):
+                    frozen = item.freeze(_memo=memo)
+                    memo[item_id] = frozen
+                else:
+                    child = new_frame(item)
+                    if child is not None:
+                        if item_id in in_progress:
+                            raise ValueError(
+                                "Cannot freeze a self-referential "
+                                f"{type(item).__name__}"
+                            )
+                        frame[3] = i
+                        frame[5] = changed
+                        stack.append(child)
+                        in_progress.add(item_id)
+                        pushed = True
+                        break
+                    frozen = item
+            changed = changed or frozen is not item
+            out.append(frozen)
+        if pushed:
+            continue
+
+        if kind == _TUPLE:
+            frozen = obj if type(obj) is tuple and not changed else tuple(out)
+        elif kind == _NAMEDTUPLE:
+            frozen = obj if not changed else obj._make(out)
+        elif kind == _DICT:
+            frozen = frozendict(zip(out[::2], out[1::2]))
+        else:
+            frozen = obj if type(obj) is frozenset and not changed else frozenset(out)
+        memo[id(obj)] = frozen
+        stack.pop()
+        in_progress.discard(id(obj))
+        if not stack:
+            return frozen
+        parent = stack[-1]
+        parent[4].append(frozen)
+        parent[5] = parent[5] or frozen is not obj
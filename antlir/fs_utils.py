@@ -7,14 +7,17 @@
 "Utilities to make Python systems programming more palatable."
 
 import argparse
+import fcntl
+import functools
+import hashlib
 import importlib.resources
+import importlib.util
 import os
 import shlex
 import tempfile
 from collections.abc import Generator, Iterable, Iterator
 from contextlib import contextmanager
-from typing import AnyStr, IO, Union
-
+from typing import AnyStr, IO, Optional, Union
 
 # We need this for lists that can contain a combination of `str` and `bytes`,
 # which is very common with `subprocess`. See https://fburl.com/wiki/dqrqyd8r.
@@ -28,6 +31,23 @@ def _byteme(s: AnyStr) -> bytes:
     return s.encode() if isinstance(s, str) else s
 
 
+# Many paths (image roots, parent directories) get split and normalized over
+# and over, so remember the most recent results.  These are bounded so that
+# walking a huge tree does not pin every path in memory.
+_CACHE_SIZE = 2**16
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def _split(path: bytes) -> tuple["Path", "Path"]:
+    head, tail = os.path.split(path)
+    return _new_path(head), _new_path(tail)
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def _normpath(path: bytes) -> "Path":
+    return _new_path(os.path.normpath(path))
+
+
 # `pathlib` refuses to operate on `bytes`, which is the only sane way on Linux.
 class Path(bytes):
     """
@@ -53,6 +73,11 @@ class Path(bytes):
       - `Optional[Path]`: `or_none`
     """
 
+    # No per-instance `__dict__`, since programs may hold millions of paths.
+    # `bytes` subtypes cannot have non-empty slots, so any cached state (like
+    # split components) lives in the bounded module-level caches above.
+    __slots__ = ()
+
     def __new__(cls, arg, *args, **kwargs):
         return super().__new__(cls, _byteme(arg), *args, **kwargs)
 
@@ -67,7 +92,9 @@ class Path(bytes):
         return cls(v)
 
     def __eq__(self, obj) -> bool:
-        if not isinstance(obj, (bytes, type(None))):
+        if isinstance(obj, bytes):
+            return bytes.__eq__(self, obj)
+        if obj is not None:
             # NB: The verbose error can be expensive, but this error must
             # never occur in correct code, so optimize for debuggability.
             raise TypeError(
@@ -79,8 +106,8 @@ class Path(bytes):
     def __ne__(self, obj) -> bool:
         return not self.__eq__(obj)
 
-    def __hash__(self) -> int:
-        return super().__hash__()
+    # Not a Python-level override, so hashing stays as cheap as for `bytes`.
+    __hash__ = bytes.__hash__
 
     @classmethod
     # pyre-fixme[14]: `join` overrides method defined in `bytes` inconsistently.
@@ -91,10 +118,10 @@ class Path(bytes):
         return Path(os.path.join(_byteme(paths[0]), *(_byteme(p) for p in paths[1:])))
 
     def __truediv__(self, right: AnyStr) -> "Path":
-        return Path(os.path.join(self, _byteme(right)))
+        return _join2(self, right)
 
     def __rtruediv__(self, left: AnyStr) -> "Path":
-        return Path(os.path.join(_byteme(left), self))
+        return _join2(left, self)
 
     def exists(self, raise_permission_error: bool = False) -> bool:
         if not raise_permission_error:
@@ -109,19 +136,18 @@ class Path(bytes):
         return Path(os.path.abspath(self))
 
     def basename(self) -> "Path":
-        return Path(os.path.basename(self))
+        return _split(self)[1]
 
     def dirname(self) -> "Path":
-        return Path(os.path.dirname(self))
+        return _split(self)[0]
 
     def islink(self) -> bool:
         return os.path.islink(self)
 
-    # NB: A lazy `gen_dir_names()` was briefly considered, but rejected (for
-    # now) because:
-    #   (1) `listdir` is clearly analogous to the standard `os` module
-    #   (2) `gen_dir_paths` has just 1 use-case in `test_parse_repodata.py`
-    #   (3) `listdir` is shorter, and the cost of a spurious list is low
+    # NB: For a single directory, the cost of a spurious list is low and
+    # `listdir` is clearly analogous to the standard `os` module.  Code that
+    # needs to look at the type of each entry, or to visit a whole tree,
+    # should use the lazy `scandir` / `walk` instead.
     def listdir(self) -> list["Path"]:
         """
         Prefer over `os.listdir` for conciseness, and because downstream
@@ -129,8 +155,61 @@ class Path(bytes):
         """
         return [Path(p) for p in os.listdir(self)]
 
+    def scandir(self) -> Iterator[os.DirEntry]:
+        """
+        Lazily yields the `os.DirEntry` of each entry in this directory.
+
+        `DirEntry` knows its file type from the directory listing itself, and
+        caches the result of `stat()`, so checking the type of an entry
+        usually costs no extra syscalls.  `entry.path` is `bytes`.
+        """
+        with os.scandir(self) as it:
+            yield from it
+
+    def walk(
+        self, *, max_depth: Optional[int] = None, one_filesystem: bool = False
+    ) -> Iterator[tuple["Path", list[os.DirEntry], list[os.DirEntry]]]:
+        """
+        Like `os.walk` (top-down), but yields `(dirpath, dirs, files)` where
+        `dirs` and `files` are lists of `os.DirEntry`, so their (cached) type
+        and stat information can be used without more syscalls.
+
+        Differences from `os.walk`:
+          - Symlinks are never followed, and a symlink to a directory is
+            listed in `files`, since an image's symlinks are not meaningful
+            on the host.
+          - Errors from listing a directory are raised, not ignored.
+
+        Like with `os.walk`, removing entries from `dirs` prunes them from
+        the walk.  The contents of directories `max_depth` levels below
+        this one are not listed (0 only lists this directory).  With
+        `one_filesystem`, directories on other devices are still listed in
+        `dirs`, but are not descended into (like `find -xdev`).
+        """
+        root_dev = os.stat(self).st_dev if one_filesystem else None
+        stack = [(self, 0)]
+        while stack:
+            dirpath, depth = stack.pop()
+            dirs, files = [], []
+            for entry in dirpath.scandir():
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+            yield dirpath, dirs, files
+            if max_depth is not None and depth >= max_depth:
+                continue
+            # Pushed in reverse to visit subdirectories in listing order.
+            for entry in reversed(dirs):
+                if (
+                    root_dev is not None
+                    and entry.stat(follow_symlinks=False).st_dev != root_dev
+                ):
+                    continue
+                stack.append((_new_path(entry.path), depth + 1))
+
     def normpath(self) -> "Path":
-        return Path(os.path.normpath(self))
+        return _normpath(self)
 
     def realpath(self) -> "Path":
         return Path(os.path.realpath(self))
@@ -156,7 +235,7 @@ class Path(bytes):
         # Future: if there's a legitimate reason to allow other `errors`,
         # this can be fixed -- just make `surrogatescape` a normal default.
         assert errors == "surrogateescape", errors
-        return super().decode(encoding, errors)
+        return bytes.decode(self, encoding, errors)
 
     @classmethod
     def from_argparse(cls, s: str) -> "Path":
@@ -230,17 +309,17 @@ class Path(bytes):
             # filesystem path.  However, we get all the needed signal
             # from running `test-fs-utils-path-resource-*' in
             # `@mode/dev` and `@mode/opt'.
-            #
+            cache = _ResourceCache.from_env() if exe else None
+            if cache is not None:
+                with cache.materialize(package, name, rsrc_in) as path:
+                    yield path
+                return
             # Wrap in a temporary directory so we can `chmod 755` below.
             with temp_dir() as td:  # pragma: no cover
                 with open(td / name, "wb") as rsrc_out:
                     # We can't use `os.sendfile` because `rsrc_in` may
                     # not be backed by a real FD.
-                    while True:
-                        # Read 512KiB chunks to mask the syscall cost
-                        chunk = rsrc_in.read(2**19)
-                        if not chunk:
-                            break
+                    for chunk in _read_chunks(rsrc_in):
                         rsrc_out.write(chunk)
                 if exe:
                     # The temporary directory protects us from undesired
@@ -259,11 +338,242 @@ class Path(bytes):
 
     def __format__(self, spec: str) -> str:
         "Allow usage of `Path` in f-strings."
-        return self.decode(errors="surrogateescape").__format__(spec)
+        return bytes.decode(self, "utf-8", "surrogateescape").__format__(spec)
 
     def __str__(self) -> str:
         'Matches `__format__` since people expect `f"{p}" == str(p)`.'
-        return self.decode(errors="surrogateescape")
+        return bytes.decode(self, "utf-8", "surrogateescape")
+
+
+_new_path = functools.partial(bytes.__new__, Path)
+
+
+def _join2(left, right) -> Path:
+    """
+    `os.path.join` of two components, without its generic argument handling
+    in the common case where both are already `bytes` (or `Path`).
+    """
+    if isinstance(left, str):
+        left = left.encode()
+    if isinstance(right, str):
+        right = right.encode()
+    if type(left) not in (bytes, Path) or type(right) not in (bytes, Path):
+        # Let `os.path.join` accept or reject anything unusual, exactly as
+        # it did before this fast path existed.
+        return Path(os.path.join(left, right))
+    if right.startswith(b"/"):
+        return _new_path(right)
+    if not left or left.endswith(b"/"):
+        return _new_path(left + right)
+    return _new_path(left + b"/" + right)
+
+
+def _read_chunks(f: IO[bytes]) -> Iterator[bytes]:
+    while True:
+        # Read 512KiB chunks to mask the syscall cost
+        chunk = f.read(2**19)
+        if not chunk:
+            return
+        yield chunk
+
+
+class _ResourceCache:
+    """
+    Opt-in persistent cache of the resources that `Path.resource(...,
+    exe=True)` has to materialize, enabled by setting
+    `ANTLIR_RESOURCE_CACHE_DIR`.  Without it, every call from every process
+    copies the resource into a new temporary directory.
+
+    Layout:
+      - `blobs/<sha256>/<name>`: executable copies of resources, keyed by
+        the hash of their contents (and keeping their name, since some
+        binaries care about `argv[0]`).
+      - `index/<key>`: symlinks to blobs, keyed by the identity of the
+        resource and of the archive it came from, so that a hit does not
+        need to read the resource at all.
+
+    Files are written under unique temporary names and then linked or
+    renamed into place, so other processes only ever see complete files.
+    Blobs hold a shared `flock` while they are in use, and only unlocked
+    blobs are evicted once the cache is over `ANTLIR_RESOURCE_CACHE_MAX_BYTES`
+    (least recently used first).  Adding blobs takes a shared lock on the
+    whole cache, and eviction an exclusive one, so a blob cannot be deleted
+    between being added and being locked.
+    """
+
+    DEFAULT_MAX_BYTES = 2**30
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blobs = root / "blobs"
+        self.index = root / "index"
+
+    @classmethod
+    def from_env(cls) -> Optional["_ResourceCache"]:
+        root = os.environ.get("ANTLIR_RESOURCE_CACHE_DIR")
+        if not root:
+            return None
+        max_bytes = os.environ.get("ANTLIR_RESOURCE_CACHE_MAX_BYTES")
+        return cls(Path(root), int(max_bytes) if max_bytes else cls.DEFAULT_MAX_BYTES)
+
+    @contextmanager
+    def _root_lock(self, op: int) -> Iterator[bool]:
+        fd = os.open(self.root / "lock", os.O_RDONLY | os.O_CREAT | os.O_CLOEXEC)
+        try:
+            try:
+                fcntl.flock(fd, op)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def materialize(self, package, name: str, rsrc_in: IO[bytes]) -> Iterator[Path]:
+        # Only the current user (and `root`) may use cached executables.
+        for d in (self.root, self.blobs, self.index):
+            os.makedirs(d, mode=0o700, exist_ok=True)
+        key = _resource_key(package, name, rsrc_in)
+        if key is not None:
+            try:
+                blob = self.index / os.readlink(self.index / key)
+            except FileNotFoundError:
+                pass
+            else:
+                fd = _lock_blob(blob)
+                if fd is not None:
+                    try:
+                        yield blob.normpath()
+                    finally:
+                        os.close(fd)
+                    return
+        fd, blob = self._insert(name, key, rsrc_in)
+        try:
+            self.evict()
+            yield blob
+        finally:
+            os.close(fd)
+
+    def _insert(
+        self, name: str, key: Optional[str], rsrc_in: IO[bytes]
+    ) -> tuple[int, Path]:
+        "Adds `rsrc_in` to the cache, returning its blob and a locked fd."
+        tmp_fd, tmp = tempfile.mkstemp(dir=self.blobs, prefix=b".tmp-")
+        tmp = Path(tmp)
+        try:
+            h = hashlib.sha256()
+            with os.fdopen(tmp_fd, "wb") as out:
+                for chunk in _read_chunks(rsrc_in):
+                    h.update(chunk)
+                    out.write(chunk)
+                os.fchmod(out.fileno(), 0o755)
+            with self._root_lock(fcntl.LOCK_SH):
+                blob_dir = self.blobs / h.hexdigest()
+                os.makedirs(blob_dir, exist_ok=True)
+                blob = blob_dir / name
+                try:
+                    # Unlike `rename`, this never replaces a blob that
+                    # another process may already be using.
+                    os.link(tmp, blob)
+                except FileExistsError:
+                    pass
+                fd = _lock_blob(blob)
+                # Eviction is excluded by the cache lock
+                assert fd is not None, blob
+                if key is not None:
+                    tmp_link = self.index / f".tmp-{key}-{os.urandom(8).hex()}"
+                    os.symlink(blob.relpath(self.index), tmp_link)
+                    os.rename(tmp_link, self.index / key)
+                return fd, blob
+        finally:
+            os.unlink(tmp)
+
+    def evict(self) -> None:
+        "Delete the least recently used blobs that are not in use."
+        with self._root_lock(fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+            if not locked:
+                # Another process is adding or evicting, and it will evict
+                # later if needed.
+                return
+            blobs = []
+            for blob_dir in self.blobs.scandir():
+                if blob_dir.name.startswith(b".tmp-"):
+                    continue
+                for blob in Path(blob_dir.path).scandir():
+                    st = blob.stat(follow_symlinks=False)
+                    blobs.append((st.st_mtime, st.st_size, Path(blob.path)))
+            total = sum(size for _, size, _ in blobs)
+            for _, size, blob in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                fd = os.open(blob, os.O_RDONLY | os.O_CLOEXEC)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # in use
+                else:
+                    os.unlink(blob)
+                    total -= size
+                finally:
+                    os.close(fd)
+                try:
+                    os.rmdir(blob.dirname())
+                except OSError:
+                    pass  # other names for the same contents
+            for entry in self.index.scandir():
+                if not os.path.exists(entry.path):
+                    os.unlink(entry.path)
+
+
+def _resource_key(package, name: str, rsrc_in: IO[bytes]) -> Optional[str]:
+    """
+    Identifies a resource by the file that it is read from, or returns `None`
+    if there is no such file (in which case the resource's contents have to
+    be hashed to find it in the cache).
+    """
+    try:
+        path = getattr(rsrc_in, "name", None)
+        if isinstance(path, str) and os.path.exists(path):
+            # The resource is a file of its own, which is exactly what is
+            # about to be read.
+            st = os.fstat(rsrc_in.fileno())
+            ident = (path,)
+        else:
+            if isinstance(package, str):
+                spec = importlib.util.find_spec(package)
+            else:
+                spec = package.__spec__
+            # `zipimport` loaders know their archive, which changes whenever
+            # any of its resources do
+            path = spec.loader.archive
+            st = os.stat(path)
+            ident = (spec.name, name, path)
+    except Exception:
+        return None
+    ident += (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    return hashlib.sha256(repr(ident).encode()).hexdigest()
+
+
+def _lock_blob(blob: Path) -> Optional[int]:
+    """
+    Returns a fd with a shared lock on `blob`, or `None` if it has been (or
+    is being) evicted.  Also marks the blob as recently used.
+    """
+    try:
+        fd = os.open(blob, os.O_RDONLY | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        if os.fstat(fd).st_nlink == 0:
+            raise FileNotFoundError(blob)
+        os.utime(fd)
+    except (BlockingIOError, FileNotFoundError):
+        os.close(fd)
+        return None
+    return fd
 
 
 @contextmanager
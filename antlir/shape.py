@@ -8,12 +8,21 @@
 # directly, instead it contains supporting implementations for bzl/shape.bzl.
 # See that file for motivations and usage documentation.
 
+import collections.abc
 import enum
+import functools
+import hashlib
+import hmac
 import importlib.resources
+import inspect
+import json
+import marshal
+import operator
 import os
-from typing import Type, TypeVar, Union
+import typing
+from typing import Any, Callable, Optional, Type, TypeVar, Union
 
-from antlir.freeze import DoNotFreeze, freeze
+from antlir.freeze import DoNotFreeze, freeze, frozendict
 from antlir.fs_utils import Path
 
 try:
@@ -23,6 +32,12 @@ except ImportError:  # pragma: no cover
     from pydantic import BaseModel  # type: ignore  # noqa: F403
     from pydantic.main import ModelMetaclass  # type: ignore  # noqa: F403
 
+try:
+    # Much faster than `json` for the big shape files our rules produce
+    from orjson import loads as _json_loads  # pragma: no cover
+except ImportError:  # pragma: no cover
+    _json_loads = json.loads
+
 
 S = TypeVar("S")
 
@@ -37,15 +52,9 @@ class ShapeMeta(ModelMetaclass):
             cls.__name__ = repr(cls)
             cls.__qualname__ = repr(cls)
 
-            # create an inner class `types` to make all the fields types usable
-            # from a user of shape without having to know the cryptic generated
-            # class names
+            # `types` is created on first access, see `_LazyTypes`
             if "types" in dct or "types" in dct.get("__annotations__", {}):
                 raise KeyError("'types' cannot be used as a shape field name")
-            types_cls = {}
-            for key, f in cls.__fields__.items():
-                types_cls[key] = f.type_
-            cls.types = type("types", (object,), types_cls)
 
         return cls
 
@@ -77,24 +86,135 @@ class Shape(BaseModel, DoNotFreeze, metaclass=ShapeMeta):
             self.__dict__[k] = freeze(v)
 
     @classmethod
-    def read_resource(cls: Type[S], package: str, name: str) -> S:
+    def read_resource(
+        cls: Type[S], package: str, name: str, *, trusted: bool = False
+    ) -> S:
         with importlib.resources.open_text(package, name) as r:
+            if trusted:
+                # pyre-fixme[16]: `S` has no attribute `parse_trusted`.
+                return cls.parse_trusted(r.read())
             # pyre-fixme[16]: `S` has no attribute `parse_raw`.
             return cls.parse_raw(r.read())
 
     @classmethod
-    def load(cls: Type[S], path: Union[Path, str]) -> S:
+    def load(cls: Type[S], path: Union[Path, str], *, trusted: bool = False) -> S:
+        if trusted:
+            with open(path, "rb") as r:
+                # pyre-fixme[16]: `S` has no attribute `parse_trusted`.
+                return cls.parse_trusted(r.read())
         with open(path, "r") as r:
             # pyre-fixme[16]: `S` has no attribute `parse_raw`.
             return cls.parse_raw(r.read())
 
     @classmethod
-    def from_env(cls: Type[S], envvar: str) -> S:
+    def from_env(cls: Type[S], envvar: str, *, trusted: bool = False) -> S:
+        if trusted:
+            # pyre-fixme[16]: `S` has no attribute `parse_trusted`.
+            return cls.parse_trusted(os.environ[envvar])
         # pyre-fixme[16]: `S` has no attribute `parse_raw`.
         return cls.parse_raw(os.environ[envvar])
 
+    @classmethod
+    def parse_trusted(cls: Type[S], raw: Union[str, bytes]) -> S:
+        """
+        Like `parse_raw`, but for JSON that is already known to match this
+        shape, such as the output of `shape.json_file`, whose schema was
+        checked by buck when it was generated.  See `construct_trusted`.
+        """
+        # pyre-fixme[16]: `S` has no attribute `construct_trusted`.
+        return cls.construct_trusted(_json_loads(raw))
+
+    @classmethod
+    def construct_trusted(cls: Type[S], data: typing.Mapping[str, Any]) -> S:
+        """
+        Builds a (frozen) instance from the parsed JSON for this shape,
+        without pydantic validation.  Values are only converted to the
+        field types (`Path`, enums, nested shapes, tuples and frozendicts).
+
+        Invalid input is NOT reliably detected, and can result in instances
+        with fields of the wrong type, so this must only be used for data
+        that was produced by our own rules.
+        """
+        values = {}
+        fields_set = set()
+        for name, alias, convert, field in _trusted_fields(cls):
+            try:
+                v = data[alias]
+            except KeyError:
+                if field.required:
+                    raise ValueError(f"{cls!r}: missing required field {name}")
+                values[name] = freeze(field.get_default())
+                continue
+            values[name] = v if v is None or convert is _identity else convert(v)
+            fields_set.add(name)
+        return _new_shape(cls, values, fields_set)
+
+    def _to_cache_bytes(self) -> bytes:
+        """
+        Private in-process cache encoding of this instance, that
+        `_from_cache_bytes` loads without any validation (like
+        `parse_trusted`, but without a JSON parser and with field names only
+        stored once in the schema).
+
+        This is not an interchange format: the bytes are authenticated with
+        a key that only exists in this process, so data from anywhere else
+        (other processes, or untrusted input, which must never reach
+        `marshal.loads`) is rejected.  Use JSON to pass shapes around.
+        """
+        codec = _cache_codec(type(self))
+        payload = codec.fingerprint + marshal.dumps(
+            codec.encode(self), _MARSHAL_VERSION
+        )
+        return _cache_mac(payload) + payload
+
+    @classmethod
+    def _from_cache_bytes(cls: Type[S], data: bytes) -> S:
+        "Loads (frozen) instances that were encoded by `_to_cache_bytes`"
+        codec = _cache_codec(cls)
+        data = memoryview(data)
+        mac, payload = data[:_CACHE_MAC_SIZE], data[_CACHE_MAC_SIZE:]
+        if not hmac.compare_digest(mac, _cache_mac(payload)):
+            raise ValueError(f"not cached by this process: {cls!r}")
+        fingerprint = codec.fingerprint
+        if payload[: len(fingerprint)] != fingerprint:
+            raise ValueError(f"not cached data of {cls!r}")
+        return codec.decode(marshal.loads(payload[len(fingerprint) :]))
+
+    # Shapes are immutable, so their hash only needs to be computed once.
+    # Slots are not pydantic fields, so this does not show up in `dict()`,
+    # `repr()` or the JSON.
+    __slots__ = ("_shape_hash",)
+
+    def _hash_or_none(self) -> Optional[int]:
+        "Cached hash, or `None` if some field is not hashable"
+        try:
+            return self._shape_hash
+        except AttributeError:
+            try:
+                h = hash((type(self), *self.__dict__.values()))
+            except TypeError:
+                h = None
+            object.__setattr__(self, "_shape_hash", h)
+            return h
+
     def __hash__(self) -> int:
-        return hash((type(self), *self.__dict__.values()))
+        h = self._hash_or_none()
+        if h is None:
+            # raise the original TypeError
+            return hash((type(self), *self.__dict__.values()))
+        return h
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        if type(other) is not type(self):
+            # pydantic compares the `dict()` of any two models
+            return super().__eq__(other)
+        h, other_h = self._hash_or_none(), other._hash_or_none()
+        if h is not None and other_h is not None and h != other_h:
+            return False
+        # Like comparing `dict()`s, but without converting nested shapes
+        return self.__dict__ == other.__dict__
 
     def __repr__(self) -> str:
         """
@@ -111,6 +231,221 @@ class Shape(BaseModel, DoNotFreeze, metaclass=ShapeMeta):
         return f"shape({fields})"
 
 
+@functools.lru_cache(maxsize=None)
+def _trusted_fields(cls) -> list[tuple[str, str, Callable[[Any], Any], Any]]:
+    "(name, alias, converter, pydantic field) for each field of a shape"
+    fields = []
+    for name, f in cls.__fields__.items():
+        convert = _trusted_converter(f.outer_type_)
+        if convert is None:
+            convert = functools.partial(_validate_field, cls, f)
+        fields.append((name, f.alias, convert, f))
+    return fields
+
+
+def _trusted_converter(tp) -> Optional[Callable[[Any], Any]]:
+    """
+    Returns a function that converts JSON for `tp` to a frozen value, or
+    `None` if that is not possible without validation (namely for unions,
+    whose member would have to be guessed).
+    """
+    if tp in (bool, int, str):
+        return _identity
+    if tp is Path:
+        return Path
+    if inspect.isclass(tp) and issubclass(tp, Shape):
+        return tp.construct_trusted
+    if inspect.isclass(tp) and issubclass(tp, enum.Enum):
+        return tp
+    origin, args = typing.get_origin(tp), typing.get_args(tp)
+    if origin is tuple and len(args) == 2 and args[1] is Ellipsis:
+        item = _trusted_converter(args[0])
+        if item is None:
+            return None
+        if item is _identity:
+            return tuple
+        return lambda v: tuple(item(i) for i in v)
+    if origin in (collections.abc.Mapping, dict) and len(args) == 2:
+        key, value = _trusted_converter(args[0]), _trusted_converter(args[1])
+        if key is None or value is None:
+            return None
+        return lambda v: frozendict({key(k): value(i) for k, i in v.items()})
+    return None
+
+
+def _identity(v):
+    return v
+
+
+def _new_shape(cls, values: dict, fields_set: set):
+    # This is what `cls.construct()` does, without the redundant handling of
+    # defaults and aliases.
+    m = cls.__new__(cls)
+    object.__setattr__(m, "__dict__", values)
+    object.__setattr__(m, "__fields_set__", fields_set)
+    if cls.__private_attributes__:
+        m._init_private_attributes()
+    return m
+
+
+# The cache encoding is the `marshal` (which is fast and compact, but only
+# supports builtin types and must not be used on untrusted data) of each value
+# converted by `_cache_codec`, after a fingerprint of the shape, and
+# authenticated with a key that is private to this process.
+_CACHE_KEY = os.urandom(32)
+_CACHE_MAC_SIZE = 16
+_MARSHAL_VERSION = 4
+
+
+def _cache_mac(payload) -> bytes:
+    return hashlib.blake2b(
+        payload, key=_CACHE_KEY, digest_size=_CACHE_MAC_SIZE
+    ).digest()
+
+
+class _CacheCodec(typing.NamedTuple):
+    encode: Callable[[Any], Any]
+    decode: Callable[[Any], Any]
+    # describes the encoding, so that changing a shape definition does not
+    # silently mix up fields
+    schema: str
+
+    @property
+    def fingerprint(self) -> bytes:
+        return hashlib.sha256(self.schema.encode()).digest()[:8]
+
+
+@functools.lru_cache(maxsize=None)
+def _cache_codec(tp) -> _CacheCodec:
+    """
+    How to convert values of (field) type `tp` to and from builtin types:
+    shapes become tuples of their fields (in `__SHAPE_FIELDS__` order, see
+    the `bzl/shape2` templates), union members are tagged with their index,
+    enums become their values and paths become `bytes`.
+    """
+    if tp in (bool, int, str):
+        return _CacheCodec(_identity, _identity, tp.__name__)
+    if tp is Path:
+        return _CacheCodec(bytes, Path, "path")
+    if inspect.isclass(tp) and issubclass(tp, enum.Enum):
+        values = [e.value for e in tp]
+        return _CacheCodec(operator.attrgetter("value"), tp, f"enum{values}")
+    if inspect.isclass(tp) and issubclass(tp, Shape):
+        return _shape_cache_codec(tp)
+    origin, args = typing.get_origin(tp), typing.get_args(tp)
+    if origin is tuple and len(args) == 2 and args[1] is Ellipsis:
+        item = _cache_codec(args[0])
+        if item.encode is _identity:
+            return _CacheCodec(tuple, tuple, f"[{item.schema}]")
+        return _CacheCodec(
+            lambda v: tuple(map(item.encode, v)),
+            lambda v: tuple(map(item.decode, v)),
+            f"[{item.schema}]",
+        )
+    if origin in (collections.abc.Mapping, dict) and len(args) == 2:
+        key, value = _cache_codec(args[0]), _cache_codec(args[1])
+        return _CacheCodec(
+            lambda v: {key.encode(k): value.encode(i) for k, i in v.items()},
+            lambda v: frozendict(
+                {key.decode(k): value.decode(i) for k, i in v.items()}
+            ),
+            f"map({key.schema},{value.schema})",
+        )
+    if origin is Union:
+        members = [(typing.get_origin(m) or m, _cache_codec(m)) for m in args]
+
+        def encode_union(v):
+            for i, (member, codec) in enumerate(members):
+                if isinstance(v, member):
+                    return (i, codec.encode(v))
+            raise TypeError(f"{v!r} is not a {tp}")
+
+        def decode_union(v):
+            i, v = v
+            return members[i][1].decode(v)
+
+        return _CacheCodec(
+            encode_union,
+            decode_union,
+            "|".join(codec.schema for _, codec in members),
+        )
+    raise TypeError(f"{tp} cannot be cached")
+
+
+def _shape_cache_codec(cls) -> _CacheCodec:
+    # user-written subclasses can add fields
+    names = cls.__dict__.get("__SHAPE_FIELDS__", None) or tuple(cls.__fields__)
+    fields = [(name, _cache_codec(cls.__fields__[name].outer_type_)) for name in names]
+    converted = [
+        (name, codec) for name, codec in fields if codec.encode is not _identity
+    ]
+
+    # All fields are always set, and since shapes are immutable, pydantic
+    # never modifies this.
+    fields_set = frozenset(names)
+    new, setattr = cls.__new__, object.__setattr__
+    private_attributes = bool(cls.__private_attributes__)
+
+    def encode(m):
+        values = dict(m.__dict__)
+        for name, codec in converted:
+            if values[name] is not None:
+                values[name] = codec.encode(values[name])
+        return tuple(values[name] for name in names)
+
+    def decode(v):
+        values = dict(zip(names, v))
+        for name, codec in converted:
+            if values[name] is not None:
+                values[name] = codec.decode(values[name])
+        # inlined `_new_shape`, since this is the hot loop
+        m = new(cls)
+        setattr(m, "__dict__", values)
+        setattr(m, "__fields_set__", fields_set)
+        if private_attributes:
+            m._init_private_attributes()
+        return m
+
+    return _CacheCodec(
+        encode,
+        decode,
+        "{" + ",".join(f"{name}:{codec.schema}" for name, codec in fields) + "}",
+    )
+
+
+def _validate_field(cls, field, v):
+    v, errors = field.validate(v, {}, loc=field.name, cls=cls)
+    if errors:
+        raise ValueError(f"{cls!r}: invalid {field.name}: {errors}")
+    return freeze(v)
+
+
+class _LazyTypes:
+    """
+    Creates the inner class `types` of a generated shape on first access, to
+    make all the fields types usable from a user of shape without having to
+    know the cryptic generated class names.
+    """
+
+    def __get__(self, instance, owner):
+        # user-written subclasses get the types of the generated class
+        for cls in owner.__mro__:
+            if cls.__dict__.get("__GENERATED_SHAPE__", False):
+                break
+        else:
+            raise AttributeError(f"{owner!r} has no attribute 'types'")
+        types_cls = type(
+            "types", (object,), {key: f.type_ for key, f in cls.__fields__.items()}
+        )
+        # shadows this descriptor from now on
+        cls.types = types_cls
+        return types_cls
+
+
+# Set after the class is created so that pydantic does not make it a field
+Shape.types = _LazyTypes()
+
+
 class Enum(enum.Enum):
     def __repr__(self) -> str:
         return self.name
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Micro-benchmarks for `fs_utils`, `freeze` and `shape`, compared against the
+plain Python (or previous) implementations of the same thing.
+
+These are not tests: timings are only printed, since they depend on the
+machine. Run them all, or only the ones whose names contain any of the given
+arguments:
+
+    buck2 run antlir/tests:benchmarks -- freeze shape_
+"""
+
+import json
+import os
+import sys
+import timeit
+from typing import Callable, Dict
+from unittest import mock
+
+from antlir.freeze import freeze, frozendict
+from antlir.fs_utils import Path, temp_dir
+from antlir.tests.test_freeze import _json_like, _recursive_freeze
+from antlir.tests.test_fs_utils import _make_tree
+from antlir.tests.test_shape import _generated_module, _tree_json, leaf_t, tree_t
+
+
+def _bench(name: str, fn, number: int = 100000) -> float:
+    elapsed = min(timeit.repeat(fn, number=number, repeat=3))
+    per_op = elapsed / number
+    if per_op < 1e-3:
+        print(f"{name}: {per_op * 1e9:.0f} ns/op")
+    else:
+        print(f"{name}: {per_op * 1e3:.1f} ms/op")
+    return elapsed
+
+
+def path_join() -> None:
+    root = Path("/some/image/root")
+    _bench("Path / bytes", lambda: root / b"usr/lib64")
+    _bench("Path / str", lambda: root / "usr/lib64")
+    _bench("os.path.join", lambda: os.path.join(b"/some/image/root", b"usr"))
+
+
+def path_compare() -> None:
+    a, b = Path("/some/image/root"), Path("/some/image/root")
+    _bench("Path == Path", lambda: a == b)
+    _bench("Path != Path", lambda: a != b)
+    raw_a, raw_b = bytes(a), bytes(b)
+    _bench("bytes == bytes", lambda: raw_a == raw_b)
+
+
+def path_hash() -> None:
+    paths = [Path(f"/usr/lib/{i}") for i in range(1000)]
+    _bench("set(Path)", lambda: set(paths), number=1000)
+    raw = [bytes(p) for p in paths]
+    _bench("set(bytes)", lambda: set(raw), number=1000)
+
+
+def path_decode() -> None:
+    p = Path("/some/image/root/usr/lib64")
+    _bench("Path.decode", lambda: p.decode())
+    _bench("str(Path)", lambda: str(p))
+    _bench("f-string", lambda: f"{p}")
+
+
+def path_split() -> None:
+    p = Path("/some/image/root/usr/lib64")
+    _bench("Path.basename", lambda: p.basename())
+    _bench("Path.dirname", lambda: p.dirname())
+    _bench("Path.normpath", lambda: p.normpath())
+    _bench("os.path.dirname", lambda: os.path.dirname(b"/some/image/root/usr"))
+
+
+def path_walk() -> None:
+    # Set this to 1000000 for a representative image-sized tree.
+    num_entries = int(os.environ.get("ANTLIR_BENCH_WALK_ENTRIES", "10000"))
+    with temp_dir() as td:
+        _make_tree(td, num_entries)
+
+        def os_walk():
+            # The type of each file is also needed by most callers
+            for dirpath, _, filenames in os.walk(td):
+                for f in filenames:
+                    os.path.islink(os.path.join(dirpath, f))
+
+        def td_walk():
+            for _, _, files in td.walk():
+                for f in files:
+                    f.is_symlink()
+
+        _bench(f"os.walk ({num_entries} entries)", os_walk, number=1)
+        _bench(f"Path.walk ({num_entries} entries)", td_walk, number=1)
+
+
+def freeze_tree() -> None:
+    # Set this to 1000000 for a representative big shape blob
+    num_nodes = int(os.environ.get("ANTLIR_BENCH_FREEZE_NODES", "100000"))
+    obj = _json_like(num_nodes)
+    _bench(f"freeze ({num_nodes} nodes)", lambda: freeze(obj), number=1)
+    try:
+        _bench(
+            f"recursive freeze ({num_nodes} nodes)",
+            lambda: _recursive_freeze(obj),
+            number=1,
+        )
+    except RecursionError:
+        print(f"recursive freeze ({num_nodes} nodes): too deep")
+    frozen = freeze(obj)
+    _bench(f"freeze frozen ({num_nodes} nodes)", lambda: freeze(frozen), number=1)
+
+
+def frozendict_ops() -> None:
+    raw = {f"key{i}": i for i in range(10)}
+    d = frozendict(raw)
+    _bench("frozendict(dict)", lambda: frozendict(raw))
+    _bench("dict(dict)", lambda: dict(raw))
+    _bench("frozendict[key]", lambda: d["key5"])
+    _bench("frozendict.get", lambda: d.get("key5"))
+    _bench("key in frozendict", lambda: "key5" in d)
+    _bench("dict[key]", lambda: raw["key5"])
+    _bench("list(frozendict.items())", lambda: list(d.items()))
+    _bench("list(dict.items())", lambda: list(raw.items()))
+    _bench("hash(frozendict)", lambda: hash(d))
+    _bench("hash(new frozendict)", lambda: hash(frozendict(raw)))
+    items = [frozendict(raw, i=i) for i in range(1000)]
+    _bench("set(frozendicts)", lambda: set(items), number=100)
+
+
+def shape_hash_eq() -> None:
+    num = int(os.environ.get("ANTLIR_BENCH_SHAPE_LEAVES", "10000"))
+    leaves = [leaf_t(name=f"leaf{i % (num // 2)}", size=i % 7) for i in range(num)]
+    copies = [leaf_t(**leaf.dict()) for leaf in leaves]
+    _bench(f"set({num} shapes)", lambda: set(leaves), number=1)
+    index = {leaf: i for i, leaf in enumerate(leaves)}
+    _bench(f"{num} dict lookups", lambda: [index[leaf] for leaf in copies], number=1)
+    _bench(f"{num} eq", lambda: [a == b for a, b in zip(leaves, copies)], number=1)
+
+
+def shape_import() -> None:
+    num = int(os.environ.get("ANTLIR_BENCH_SHAPE_MODULE_SHAPES", "500"))
+    code = compile(_generated_module(num), "generated", "exec")
+    _bench(f"import ({num} shapes)", lambda: exec(code, {}), number=1)
+
+    def use():
+        ns = {}
+        exec(code, ns)
+        for i in range(num):
+            ns[f"shape{i}_t"].types
+            ns[f"shape{i}_t"].__name__
+
+    _bench(f"import and use ({num} shapes)", use, number=1)
+
+
+def shape_load() -> None:
+    # Set this to 100000 for a ~10MB shape file
+    num_leaves = int(os.environ.get("ANTLIR_BENCH_SHAPE_LEAVES", "10000"))
+    raw = json.dumps(_tree_json(num_leaves))
+    print(f"{len(raw) / 2**20:.1f} MiB of JSON")
+    _bench("parse_raw", lambda: tree_t.parse_raw(raw), number=1)
+    _bench("parse_trusted", lambda: tree_t.parse_trusted(raw), number=1)
+    with mock.patch("antlir.shape._json_loads", json.loads):
+        _bench("parse_trusted (json)", lambda: tree_t.parse_trusted(raw), number=1)
+    cached = tree_t.parse_trusted(raw)._to_cache_bytes()
+    print(f"{len(cached) / 2**20:.1f} MiB of cache bytes")
+    _bench("_from_cache_bytes", lambda: tree_t._from_cache_bytes(cached), number=1)
+
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+    fn.__name__: fn
+    for fn in [
+        path_join,
+        path_compare,
+        path_hash,
+        path_decode,
+        path_split,
+        path_walk,
+        freeze_tree,
+        frozendict_ops,
+        shape_hash_eq,
+        shape_import,
+        shape_load,
+    ]
+}
+
+
+def main() -> None:
+    filters = sys.argv[1:]
+    for name, fn in BENCHMARKS.items():
+        if filters and not any(f in name for f in filters):
+            continue
+        print(f"== {name}")
+        fn()
+
+
+if __name__ == "__main__":
+    main()
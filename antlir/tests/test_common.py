@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import asyncio
+import logging
+import time
+import unittest
+from unittest import mock
+
+from antlir.common import (
+    async_retry_fn,
+    async_retryable,
+    backoff_delays,
+    retry_fn,
+    retryable,
+    RetryBudget,
+)
+
+
+class Flaky:
+    "Fails the first `failures` calls"
+
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self) -> int:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError(f"failure {self.calls}")
+        return self.calls
+
+
+class RetryTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        sleep = mock.patch("antlir.common._mockable_retry_fn_sleep")
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_retry_fn(self) -> None:
+        flaky = Flaky(2)
+        self.assertEqual(3, retry_fn(flaky, delays=[1, 2, 3], what="flaky"))
+        self.assertEqual([mock.call(1), mock.call(2)], self.sleep.call_args_list)
+        with self.assertRaisesRegex(RuntimeError, "failure 3"):
+            retry_fn(Flaky(3), delays=[1, 2], what="flaky")
+        with self.assertRaisesRegex(RuntimeError, "failure 1"):
+            retry_fn(Flaky(1), lambda e: False, delays=[1], what="flaky")
+        self.assertEqual(1, retry_fn(Flaky(0), delays=[], what="flaky"))
+        with self.assertLogs("antlir", level="ERROR") as logs:
+            retry_fn(Flaky(1), delays=[1, 2], what="flaky")
+        self.assertIn("[Retry 1 of 2] flaky -- waiting 1 seconds.", logs.output[0])
+        # `delays` is only measured when a retry is logged
+        logger = logging.getLogger("antlir")
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+        self.assertEqual(
+            2,
+            retry_fn(Flaky(1), delays=iter([1]), what="flaky", log_exception=False),
+        )
+
+    def test_backoff_and_jitter(self) -> None:
+        self.assertEqual([0.5, 1, 2, 4, 5], backoff_delays(0.5, 5, max_delay=5))
+        self.assertEqual([1, 3, 9], backoff_delays(1, 3, factor=3))
+        with mock.patch("antlir.common._mockable_retry_fn_random", return_value=0.5):
+            retry_fn(Flaky(2), delays=[2, 4], what="flaky", jitter=0.5)
+        self.assertEqual([mock.call(1.5), mock.call(3.0)], self.sleep.call_args_list)
+
+    def test_budget(self) -> None:
+        budget = RetryBudget(max_tokens=2, ratio=0.5)
+        self.assertEqual(3, retry_fn(Flaky(2), delays=[0] * 5, what="a", budget=budget))
+        # the budget is spent, so this fails without retrying
+        flaky = Flaky(1)
+        with self.assertRaisesRegex(RuntimeError, "failure 1"):
+            retry_fn(flaky, delays=[0] * 5, what="b", budget=budget)
+        self.assertEqual(1, flaky.calls)
+        # successes earn retries back
+        for _ in range(2):
+            retry_fn(Flaky(0), delays=[0], what="c", budget=budget)
+        self.assertEqual(2, retry_fn(Flaky(1), delays=[0], what="d", budget=budget))
+
+    def test_retryable_formats_lazily(self) -> None:
+        flaky = Flaky(1)
+
+        @retryable("calling {a} {b}", [0])
+        def fn(a, b=2):
+            return flaky()
+
+        # no message is needed if it succeeds right away
+        flaky.calls = 1
+        with mock.patch("inspect.getcallargs") as getcallargs:
+            self.assertEqual(2, fn(1))
+            getcallargs.assert_not_called()
+        flaky.calls = 0
+        with self.assertLogs("antlir", level="ERROR") as logs:
+            self.assertEqual(2, fn(1))
+        self.assertIn("calling 1 2", logs.output[0])
+        # not even on failure, if the message is not logged
+        flaky.calls = 0
+
+        @retryable("calling {a}", [0], log_exception=False)
+        def quiet(a):
+            return flaky()
+
+        logger = logging.getLogger("antlir")
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+        with mock.patch("inspect.getcallargs") as getcallargs:
+            self.assertEqual(2, quiet(1))
+            getcallargs.assert_not_called()
+
+
+class AsyncRetryTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_async_retry_fn(self) -> None:
+        flaky = Flaky(2)
+
+        async def fn():
+            return flaky()
+
+        self.assertEqual(3, await async_retry_fn(fn, delays=[0, 0], what="fn"))
+        flaky = Flaky(1)
+        with self.assertRaisesRegex(RuntimeError, "failure 1"):
+            await async_retry_fn(fn, delays=[], what="fn", budget=RetryBudget())
+
+    async def test_does_not_block_others(self) -> None:
+        flaky = Flaky(2)
+        budget = RetryBudget()
+
+        @async_retryable("flaky {n}", [0.2, 0.2], log_exception=False, budget=budget)
+        async def retried(n):
+            return flaky()
+
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        start = time.monotonic()
+        self.assertEqual(3, await retried(1))
+        elapsed = time.monotonic() - start
+        task.cancel()
+        self.assertGreaterEqual(elapsed, 0.4)
+        # `time.sleep` would have stalled the ticker for the whole retry
+        self.assertGreater(ticks, 10)
+
+    async def test_concurrent(self) -> None:
+        flaky = Flaky(3)
+        done = []
+
+        @async_retryable("flaky", [0.1] * 3, log_exception=False, jitter=1)
+        async def retried():
+            return flaky()
+
+        async def fine(n):
+            await asyncio.sleep(0.01 * n)
+            done.append(n)
+
+        results = await asyncio.gather(retried(), *(fine(n) for n in range(5)))
+        self.assertEqual(4, results[0])
+        self.assertEqual(list(range(5)), done)
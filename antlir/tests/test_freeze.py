@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import pickle
+import random
+import sys
+import unittest
+from collections.abc import Mapping
+from enum import Enum
+from typing import NamedTuple
+
+from antlir.freeze import DoNotFreeze, freeze, frozendict
+
+
+class Color(Enum):
+    RED = 1
+
+
+class Point(NamedTuple):
+    x: object
+    y: object
+
+
+class Custom:
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def freeze(self, *, _memo, **kwargs):
+        return ("custom", freeze(self.value, _memo=_memo), kwargs)
+
+
+def _recursive_freeze(obj, *, _memo=None):
+    "The previous, recursive implementation, as a reference"
+    if isinstance(obj, (bytes, Enum, float, int, str, type(None))):
+        return obj
+    if _memo is None:
+        _memo = {}
+    if id(obj) in _memo:
+        return _memo[id(obj)]
+    if isinstance(obj, tuple) and hasattr(obj, "_make"):
+        frozen = obj._make(_recursive_freeze(i, _memo=_memo) for i in obj)
+    elif isinstance(obj, (list, tuple)):
+        frozen = tuple(_recursive_freeze(i, _memo=_memo) for i in obj)
+    elif isinstance(obj, dict):
+        frozen = frozendict(
+            {
+                _recursive_freeze(k, _memo=_memo): _recursive_freeze(v, _memo=_memo)
+                for k, v in obj.items()
+            }
+        )
+    elif isinstance(obj, (set, frozenset)):
+        frozen = frozenset(_recursive_freeze(i, _memo=_memo) for i in obj)
+    else:
+        frozen = obj
+    _memo[id(obj)] = frozen
+    return frozen
+
+
+def _json_like(num_nodes: int, seed: int = 0):
+    "A random JSON-like tree (like a big shape blob) with ~`num_nodes` nodes"
+    rng = random.Random(seed)
+    root = {}
+    containers = [root]
+    for i in range(num_nodes):
+        parent = rng.choice(containers[-100:])
+        r = rng.random()
+        if r < 0.1:
+            node = {}
+            containers.append(node)
+        elif r < 0.2:
+            node = []
+            containers.append(node)
+        elif r < 0.6:
+            node = f"value{i}"
+        else:
+            node = i
+        if isinstance(parent, dict):
+            parent[f"key{i}"] = node
+        else:
+            parent.append(node)
+    return root
+
+
+class FrozendictTestCase(unittest.TestCase):
+    def test_mapping(self) -> None:
+        d = frozendict({"a": 1}, b=2)
+        self.assertIsInstance(d, Mapping)
+        self.assertEqual(2, len(d))
+        self.assertEqual(1, d["a"])
+        self.assertIn("b", d)
+        self.assertNotIn("c", d)
+        self.assertEqual(None, d.get("c"))
+        self.assertEqual(3, d.get("c", 3))
+        self.assertEqual(["a", "b"], list(d))
+        self.assertEqual(["a", "b"], list(d.keys()))
+        self.assertEqual([1, 2], list(d.values()))
+        self.assertEqual([("a", 1), ("b", 2)], list(d.items()))
+        with self.assertRaises(KeyError):
+            d["c"]
+        with self.assertRaises(TypeError):
+            d["a"] = 2
+        self.assertEqual("frozendict({'a': 1, 'b': 2})", repr(d))
+
+    def test_eq_and_hash(self) -> None:
+        d = frozendict(a=1, b=2)
+        self.assertEqual(d, d)
+        self.assertEqual(d, frozendict(b=2, a=1))
+        self.assertEqual(d, {"b": 2, "a": 1})
+        self.assertEqual({"b": 2, "a": 1}, d)
+        self.assertNotEqual(d, frozendict(a=1))
+        self.assertNotEqual(d, {"a": 1})
+        self.assertNotEqual(d, 1)
+        self.assertNotEqual(d, (("a", 1), ("b", 2)))
+        # order-insensitive, like equality
+        self.assertEqual(hash(d), hash(frozendict(b=2, a=1)))
+        self.assertEqual(hash(d), hash(d))
+        self.assertEqual({d: 1}[frozendict(b=2, a=1)], 1)
+        unhashable = frozendict(a=[])
+        for _ in range(2):  # the failure must not be cached
+            with self.assertRaises(TypeError):
+                hash(unhashable)
+
+    def test_copy_and_pickle(self) -> None:
+        d = frozendict(a=frozendict(b=1))
+        for c in [copy.copy(d), copy.deepcopy(d), pickle.loads(pickle.dumps(d))]:
+            self.assertIs(frozendict, type(c))
+            self.assertEqual(d, c)
+            self.assertEqual(hash(d), hash(c))
+
+    def test_freeze(self) -> None:
+        d = frozendict(a=1)
+        self.assertIs(d, freeze(d))
+        self.assertEqual(frozendict(a=(1,)), freeze({"a": [1]}))
+
+
+class FreezeTestCase(unittest.TestCase):
+    def test_containers(self) -> None:
+        frozen = freeze(
+            {
+                "list": [1, [2.0, b"3"], {4}],
+                "set": {Color.RED, None},
+                "point": Point(x=[1], y="y"),
+                ("tuple", "key"): frozenset({("a", 1)}),
+            }
+        )
+        self.assertEqual(
+            frozendict(
+                {
+                    "list": (1, (2.0, b"3"), frozenset({4})),
+                    "set": frozenset({Color.RED, None}),
+                    "point": Point(x=(1,), y="y"),
+                    ("tuple", "key"): frozenset({("a", 1)}),
+                }
+            ),
+            frozen,
+        )
+        self.assertIs(Point, type(frozen["point"]))
+        with self.assertRaises(NotImplementedError):
+            freeze([object()])
+
+    def test_matches_recursive(self) -> None:
+        obj = _json_like(10000)
+        self.assertEqual(_recursive_freeze(obj), freeze(obj))
+
+    def test_immutable_returned_as_is(self) -> None:
+        t = (1, ("a", frozenset({2})), Point(x=3, y=(4,)))
+        self.assertIs(t, freeze(t))
+        fs = frozenset({(1, 2), "a"})
+        self.assertIs(fs, freeze(fs))
+        dnf = DoNotFreeze()
+        self.assertIs(dnf, freeze([dnf])[0])
+        inner = (1, 2)
+        self.assertIs(inner, freeze([inner, [3]])[0])
+        # not as-is if anything inside needs to be copied
+        self.assertEqual((1, (2,)), freeze((1, [2])))
+
+    def test_shared(self) -> None:
+        shared = [1, {"a": [2]}]
+        frozen = freeze({"x": shared, "y": [shared], "z": (shared,)})
+        self.assertIs(frozen["x"], frozen["y"][0])
+        self.assertIs(frozen["x"], frozen["z"][0])
+        memo = {}
+        self.assertIs(freeze(shared, _memo=memo), freeze(shared, _memo=memo))
+
+    def test_custom_freeze(self) -> None:
+        self.assertEqual((("custom", (1,), {}),), freeze([Custom([1])]))
+        self.assertEqual(("custom", (1,), {"k": 2}), freeze(Custom([1]), k=2))
+        with self.assertRaises(AssertionError):
+            freeze([1], k=2)
+
+    def test_deep(self) -> None:
+        obj = leaf = []
+        for _ in range(sys.getrecursionlimit() * 10):
+            leaf.append({"a": []})
+            leaf = leaf[0]["a"]
+        frozen = freeze(obj)
+        for _ in range(sys.getrecursionlimit() * 10):
+            frozen = frozen[0]["a"]
+        self.assertEqual((), frozen)
+
+    def test_shared_immutable_dag(self) -> None:
+        # Each level refers to the one below twice, so walking it as a tree
+        # (instead of once per distinct node) would take 2**64 steps.
+        dag = ("x",)
+        for _ in range(64):
+            dag = (dag, dag)
+        self.assertIs(dag, freeze(dag))
+        frozen = freeze([dag, {"k": dag}])
+        self.assertIs(dag, frozen[0])
+        self.assertIs(dag, frozen[1]["k"])
+
+    def test_self_referential(self) -> None:
+        obj = []
+        obj.append({"self": obj})
+        with self.assertRaisesRegex(ValueError, "self-referential list"):
+            freeze(obj)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import importlib
+import itertools
+import os
+import pickle
+import sys
+import unittest
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from antlir.fs_utils import _ResourceCache, Path, temp_dir
+
+# Deliberately includes paths that are not normalized, so that the fast paths
+# are checked against `os.path` on their edge cases.
+_SAMPLES = [
+    b"",
+    b"/",
+    b"//",
+    b"///",
+    b"a",
+    b"a/",
+    b"/a",
+    b"//a",
+    b"/a/b/c",
+    b"a/b/c/",
+    b"a//b",
+    b"./a/../b",
+    b"/a/./b/..",
+    b"\xff/\xfe",
+]
+
+
+def _make_tree(root: Path, num_entries: int, fanout: int = 10) -> None:
+    "A tree where each directory has `fanout` files and `fanout` subdirs."
+    made, queue = 0, [root]
+    while made < num_entries:
+        d = queue.pop(0)
+        for i in range(fanout):
+            (d / f"f{i}").touch()
+            os.mkdir(d / f"d{i}")
+            queue.append(d / f"d{i}")
+        made += 2 * fanout
+
+
+class PathTestCase(unittest.TestCase):
+    def test_join_matches_os_path(self) -> None:
+        for left, right in itertools.product(_SAMPLES, repeat=2):
+            expected = os.path.join(left, right)
+            cases = [(Path(left), right), (Path(left), Path(right))]
+            if right.isascii():
+                cases.append((Path(left), right.decode()))
+            for lhs, rhs in cases:
+                joined = lhs / rhs
+                self.assertIs(Path, type(joined))
+                self.assertEqual(expected, joined)
+            joined = left / Path(right)
+            self.assertIs(Path, type(joined))
+            self.assertEqual(expected, joined)
+        self.assertEqual(b"a/b", Path("a") / "b")
+        self.assertEqual(b"a/b", "a" / Path("b"))
+        self.assertEqual(b"a/b/c", Path.join("a", b"b", Path("c")))
+
+    def test_join_rejects_non_paths(self) -> None:
+        for bad in [None, 5, bytearray(b"x")]:
+            with self.assertRaises(TypeError):
+                Path("a") / bad
+            with self.assertRaises(TypeError):
+                bad / Path("a")
+
+    def test_split_matches_os_path(self) -> None:
+        for p in _SAMPLES:
+            for path in [Path(p), Path(p)]:  # second time is cached
+                self.assertEqual(os.path.basename(p), path.basename())
+                self.assertEqual(os.path.dirname(p), path.dirname())
+                self.assertEqual(os.path.normpath(p), path.normpath())
+                for result in [path.basename(), path.dirname(), path.normpath()]:
+                    self.assertIs(Path, type(result))
+
+    def test_compare_and_hash(self) -> None:
+        self.assertEqual(Path("a"), b"a")
+        self.assertEqual(Path("a"), Path(b"a"))
+        self.assertNotEqual(Path("a"), b"b")
+        self.assertEqual(hash(b"a"), hash(Path("a")))
+        self.assertEqual({b"a": 1}[Path("a")], 1)
+        self.assertFalse(Path("a") == None)  # noqa: E711
+        with self.assertRaisesRegex(TypeError, "Cannot compare `Path`"):
+            Path("a") == "a"
+        with self.assertRaisesRegex(TypeError, "Cannot compare `Path`"):
+            Path("a") != "a"
+
+    def test_decode_and_format(self) -> None:
+        p = Path(b"/a/\xff")
+        self.assertEqual("/a/\udcff", p.decode())
+        self.assertEqual("/a/\udcff", str(p))
+        self.assertEqual("/a/\udcff", f"{p}")
+        self.assertEqual("  /a/\udcff", f"{p:>6}")
+        with self.assertRaises(AssertionError):
+            p.decode(errors="strict")
+
+    def test_no_instance_dict(self) -> None:
+        p = Path("a")
+        with self.assertRaises(AttributeError):
+            p.foo = 1
+        self.assertEqual(p, pickle.loads(pickle.dumps(p)))
+        self.assertIs(Path, type(pickle.loads(pickle.dumps(p))))
+
+
+class WalkTestCase(unittest.TestCase):
+    def test_scandir(self) -> None:
+        with temp_dir() as td:
+            (td / "f").touch()
+            os.mkdir(td / "d")
+            os.symlink("d", td / "l")
+            entries = {e.name: e for e in td.scandir()}
+            self.assertEqual({b"f", b"d", b"l"}, set(entries))
+            self.assertTrue(entries[b"d"].is_dir())
+            self.assertTrue(entries[b"l"].is_symlink())
+            self.assertEqual(td / "f", entries[b"f"].path)
+
+    def test_matches_os_walk(self) -> None:
+        with temp_dir() as td:
+            _make_tree(td, 300, fanout=3)
+            expected = {
+                (Path(dirpath), frozenset(dirnames), frozenset(filenames))
+                for dirpath, dirnames, filenames in os.walk(td)
+            }
+            actual = {
+                (
+                    dirpath,
+                    frozenset(e.name for e in dirs),
+                    frozenset(e.name for e in files),
+                )
+                for dirpath, dirs, files in td.walk()
+            }
+            self.assertEqual(expected, actual)
+            self.assertTrue(all(type(dirpath) is Path for dirpath, _, _ in td.walk()))
+
+    def test_symlinks_are_files(self) -> None:
+        with temp_dir() as td:
+            os.mkdir(td / "d")
+            (td / "d/f").touch()
+            os.symlink("d", td / "l")
+            self.assertEqual(
+                [(td, [b"d"], [b"l"]), (td / "d", [], [b"f"])],
+                [
+                    (dirpath, [e.name for e in dirs], [e.name for e in files])
+                    for dirpath, dirs, files in td.walk()
+                ],
+            )
+
+    def test_prune_and_max_depth(self) -> None:
+        with temp_dir() as td:
+            os.makedirs(td / "a/b/c")
+            os.makedirs(td / "x/y")
+            visited = []
+            for dirpath, dirs, _ in td.walk():
+                visited.append(dirpath.relpath(td))
+                dirs[:] = [e for e in dirs if e.name != b"x"]
+            self.assertEqual([b".", b"a", b"a/b", b"a/b/c"], visited)
+            self.assertEqual(
+                [b".", b"a", b"x"],
+                sorted(dirpath.relpath(td) for dirpath, _, _ in td.walk(max_depth=1)),
+            )
+            self.assertEqual(1, len(list(td.walk(max_depth=0))))
+
+    def test_one_filesystem(self) -> None:
+        # Nothing in a fresh temporary directory is a mountpoint, but this
+        # checks that the device comparison does not prune anything else.
+        with temp_dir() as td:
+            os.makedirs(td / "a/b")
+            self.assertEqual(3, len(list(td.walk(one_filesystem=True))))
+
+    def test_errors_are_raised(self) -> None:
+        with temp_dir() as td:
+            with self.assertRaises(FileNotFoundError):
+                list((td / "missing").walk())
+
+
+class ResourceCacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # Resources in a zip archive have no filesystem path, so they have to
+        # be materialized.
+        self.td = self.enterContext(temp_dir())
+        archive = self.td / "pkg.zip"
+        with zipfile.ZipFile(archive.decode(), "w") as z:
+            z.writestr("zipped_rsrc_pkg/__init__.py", "")
+            z.writestr("zipped_rsrc_pkg/big", b"#!/bin/sh\necho big\n" * 100)
+            z.writestr("zipped_rsrc_pkg/small", b"#!/bin/sh\necho small\n")
+        sys.path.insert(0, archive.decode())
+        self.addCleanup(sys.path.remove, archive.decode())
+        self.addCleanup(sys.modules.pop, "zipped_rsrc_pkg", None)
+        importlib.invalidate_caches()
+        self.cache_dir = self.td / "cache"
+
+    def _env(self, max_bytes: int = 2**20):
+        return mock.patch.dict(
+            os.environ,
+            {
+                "ANTLIR_RESOURCE_CACHE_DIR": self.cache_dir.decode(),
+                "ANTLIR_RESOURCE_CACHE_MAX_BYTES": str(max_bytes),
+            },
+        )
+
+    def test_disabled(self) -> None:
+        with Path.resource("zipped_rsrc_pkg", "small", exe=True) as p:
+            self.assertFalse(p.startswith(self.cache_dir))
+            self.assertTrue(os.access(p, os.X_OK))
+        self.assertFalse(p.exists())
+        self.assertFalse(self.cache_dir.exists())
+
+    def test_cached(self) -> None:
+        with self._env():
+            with Path.resource("zipped_rsrc_pkg", "small", exe=True) as p1:
+                self.assertTrue(p1.startswith(self.cache_dir))
+                self.assertEqual(b"small", p1.basename())
+                self.assertTrue(os.access(p1, os.X_OK))
+                self.assertEqual("#!/bin/sh\necho small\n", p1.read_text())
+            self.assertTrue(p1.exists())
+            with mock.patch("antlir.fs_utils._ResourceCache._insert") as insert:
+                with Path.resource("zipped_rsrc_pkg", "small", exe=True) as p2:
+                    self.assertEqual(p1, p2)
+                insert.assert_not_called()
+            # Not executable resources are never cached
+            with Path.resource("zipped_rsrc_pkg", "small", exe=False) as p3:
+                self.assertFalse(p3.startswith(self.cache_dir))
+
+    def test_rewritten_resource(self) -> None:
+        # A resource that is a plain file of its own, but is not executable,
+        # also has to be materialized.
+        pkg = self.td / "dir_rsrc_pkg"
+        os.mkdir(pkg)
+        (pkg / "__init__.py").touch()
+        rsrc = pkg / "rsrc"
+        with open(rsrc, "w") as f:
+            f.write("#!/bin/sh\necho one\n")
+        sys.path.insert(0, self.td.decode())
+        self.addCleanup(sys.path.remove, self.td.decode())
+        self.addCleanup(sys.modules.pop, "dir_rsrc_pkg", None)
+        importlib.invalidate_caches()
+        with self._env():
+            with Path.resource("dir_rsrc_pkg", "rsrc", exe=True) as p1:
+                self.assertTrue(p1.startswith(self.cache_dir))
+            with mock.patch("antlir.fs_utils._ResourceCache._insert") as insert:
+                with Path.resource("dir_rsrc_pkg", "rsrc", exe=True) as p2:
+                    self.assertEqual(p1, p2)
+                insert.assert_not_called()
+            # Same size and a different mtime, even on filesystems with
+            # coarse timestamps
+            st = os.stat(rsrc)
+            with open(rsrc, "w") as f:
+                f.write("#!/bin/sh\necho two\n")
+            os.utime(rsrc, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            with Path.resource("dir_rsrc_pkg", "rsrc", exe=True) as p3:
+                self.assertNotEqual(p1, p3)
+                self.assertEqual("#!/bin/sh\necho two\n", p3.read_text())
+
+    def test_same_contents_without_index(self) -> None:
+        with self._env():
+            with mock.patch("antlir.fs_utils._resource_key", return_value=None):
+                with Path.resource("zipped_rsrc_pkg", "small", exe=True) as p1:
+                    pass
+                with Path.resource("zipped_rsrc_pkg", "small", exe=True) as p2:
+                    self.assertEqual(p1, p2)
+            self.assertEqual([], (self.cache_dir / "index").listdir())
+
+    def test_evict(self) -> None:
+        with self._env(max_bytes=100):
+            with Path.resource("zipped_rsrc_pkg", "big", exe=True) as big:
+                # `big` is over budget, but it is in use
+                with Path.resource("zipped_rsrc_pkg", "small", exe=True) as small:
+                    self.assertTrue(big.exists())
+            # Now `big` is evicted to make room for the next resource
+            os.utime(small)
+            cache = _ResourceCache.from_env()
+            assert cache is not None
+            cache.evict()
+            self.assertFalse(big.exists())
+            self.assertFalse(big.dirname().exists())
+            self.assertTrue(small.exists())
+            self.assertEqual(1, len((self.cache_dir / "index").listdir()))
+            with Path.resource("zipped_rsrc_pkg", "big", exe=True) as big2:
+                self.assertEqual(big, big2)
+                self.assertTrue(big2.exists())
+
+    def test_concurrent(self) -> None:
+        # `flock`s belong to open file descriptions, so threads contend for
+        # them just like processes do.  The tiny budget means that nearly
+        # every call also evicts.
+        def use(name: str) -> None:
+            for _ in range(50):
+                with Path.resource("zipped_rsrc_pkg", name, exe=True) as p:
+                    self.assertEqual(f"echo {name}", p.read_text().split("\n")[1])
+
+        with self._env(max_bytes=1), ThreadPoolExecutor(8) as pool:
+            for f in [pool.submit(use, n) for n in ["big", "small"] * 4]:
+                f.result()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import typing
+import unittest
+from unittest import mock
+
+from antlir.freeze import frozendict
+from antlir.fs_utils import Path, temp_dir
+from antlir.shape import Enum, Shape
+
+# These mimic what `bzl/shape2` generates, see `struct.pydantic.handlebars`
+
+
+class color_t(Enum):
+    RED = "red"
+    BLUE = "blue"
+
+
+class leaf_t(Shape):
+    __GENERATED_SHAPE__ = True
+    __SHAPE_FIELDS__ = (
+        "name",
+        "size",
+        "enabled",
+    )
+
+    name: str
+    size: int = 0
+    enabled: bool = True
+
+
+class other_leaf_t(Shape):
+    __GENERATED_SHAPE__ = True
+    __SHAPE_FIELDS__ = ("label",)
+
+    label: str
+
+
+either_t = typing.Union[
+    leaf_t,
+    other_leaf_t,
+]
+
+
+class tree_t(Shape):
+    __GENERATED_SHAPE__ = True
+    __SHAPE_FIELDS__ = (
+        "path",
+        "color",
+        "leaves",
+        "tags",
+        "either",
+        "many",
+        "parent",
+        "names",
+    )
+
+    path: Path
+    color: color_t
+    leaves: typing.Tuple[leaf_t, ...]
+    tags: typing.Mapping[str, typing.Tuple[int, ...]]
+    either: either_t
+    many: typing.Tuple[either_t, ...] = []  # pyre-ignore
+    parent: typing.Optional[leaf_t] = None
+    names: typing.Tuple[str, ...] = ["default"]  # pyre-ignore
+
+
+def _tree_json(num_leaves: int = 3) -> dict:
+    return {
+        "path": "/some/path",
+        "color": "blue",
+        "leaves": [
+            {"name": f"leaf{i}", "size": i, "enabled": i % 2 == 0}
+            for i in range(num_leaves)
+        ],
+        "tags": {"a": [1, 2], "b": []},
+        "either": {"label": "other"},
+        "many": [{"name": "x"}, {"label": "y"}],
+    }
+
+
+def _generated_module(num_shapes: int) -> str:
+    "Source of a big module, as rendered by the `bzl/shape2` pydantic templates"
+    lines = [
+        "import importlib",
+        "import typing",
+        "",
+        "from antlir.fs_utils import Path",
+        "from antlir.shape import Enum, Shape",
+    ]
+    for i in range(num_shapes):
+        child = f"shape{i - 1}_t" if i else "int"
+        lines += f"""
+class enum{i}_t(Enum):
+    A = "a"
+    B = "b"
+
+class shape{i}_t(Shape):
+    __GENERATED_SHAPE__ = True
+
+    name: str
+    size: int = 0
+    path: typing.Optional[Path] = None
+    tags: typing.Tuple[str, ...] = []  # pyre-ignore
+    kv: typing.Mapping[str, int]
+    color: enum{i}_t
+    child: typing.Optional[{child}] = None
+""".splitlines()
+    return "\n".join(lines)
+
+
+class TrustedLoadTestCase(unittest.TestCase):
+    def assert_same(self, expected: Shape, actual: Shape) -> None:
+        self.assertIs(type(expected), type(actual))
+        self.assertEqual(expected, actual)
+        self.assertEqual(repr(expected), repr(actual))
+        self.assertEqual(expected.__fields_set__, actual.__fields_set__)
+        for field in type(expected).__fields__:
+            self.assertIs(
+                type(getattr(expected, field)), type(getattr(actual, field)), field
+            )
+
+    def test_same_as_validated(self) -> None:
+        raw = json.dumps(_tree_json())
+        trusted = tree_t.parse_trusted(raw)
+        self.assert_same(tree_t.parse_raw(raw), trusted)
+        self.assertIsInstance(trusted.path, Path)
+        self.assertIs(color_t.BLUE, trusted.color)
+        self.assertIsInstance(trusted.tags, frozendict)
+        self.assertEqual((1, 2), trusted.tags["a"])
+        self.assertIsInstance(trusted.either, other_leaf_t)
+        self.assertEqual([leaf_t, other_leaf_t], [type(m) for m in trusted.many])
+        self.assertEqual(("default",), trusted.names)
+        self.assertIsNone(trusted.parent)
+        with self.assertRaises(TypeError):
+            trusted.path = Path("/other")
+
+    def test_bytes(self) -> None:
+        raw = json.dumps(_tree_json())
+        self.assert_same(tree_t.parse_raw(raw), tree_t.parse_trusted(raw.encode()))
+
+    def test_missing_required(self) -> None:
+        data = _tree_json()
+        del data["path"]
+        with self.assertRaisesRegex(ValueError, "missing required field path"):
+            tree_t.construct_trusted(data)
+
+    def test_load(self) -> None:
+        raw = json.dumps(_tree_json())
+        expected = tree_t.parse_raw(raw)
+        with temp_dir() as td:
+            with open(td / "tree.json", "w") as f:
+                f.write(raw)
+            self.assert_same(expected, tree_t.load(td / "tree.json", trusted=True))
+        with mock.patch.dict(os.environ, {"TREE": raw}):
+            self.assert_same(expected, tree_t.from_env("TREE", trusted=True))
+
+
+class ShapeMetaTestCase(unittest.TestCase):
+    def test_display_name(self) -> None:
+        self.assertEqual("shape(name=str, size=int, enabled=bool)", repr(leaf_t))
+        self.assertEqual(repr(leaf_t), leaf_t.__name__)
+        self.assertEqual(repr(leaf_t), leaf_t.__qualname__)
+        self.assertIn(
+            "shape(name=str, size=int, enabled=bool)",
+            repr(tree_t).replace("Optional[", ""),
+        )
+
+        class user_t(leaf_t):
+            pass
+
+        self.assertEqual("user_t", user_t.__name__)
+        self.assertTrue(repr(user_t).startswith("user_t(name=str"), repr(user_t))
+
+    def test_types(self) -> None:
+        self.assertIs(Path, tree_t.types.path)
+        self.assertIs(color_t, tree_t.types.color)
+        self.assertIs(leaf_t, tree_t.types.parent)
+        self.assertIs(tree_t.types, tree_t.types)
+        self.assertIs(tree_t.types, tree_t.parse_obj(_tree_json()).types)
+        self.assertNotIn("types", tree_t.__fields__)
+
+        class user_t(tree_t):
+            pass
+
+        self.assertIs(tree_t.types, user_t.types)
+        with self.assertRaises(AttributeError):
+            Shape.types
+        with self.assertRaisesRegex(KeyError, "'types' cannot be used"):
+
+            class bad_t(Shape):
+                __GENERATED_SHAPE__ = True
+
+                types: int
+
+    def test_generated_module(self) -> None:
+        ns = {}
+        exec(_generated_module(3), ns)
+        self.assertTrue(ns["shape2_t"].__name__.startswith("shape(name=str"))
+        self.assertIs(ns["shape1_t"], ns["shape2_t"].types.child)
+
+
+class HashEqTestCase(unittest.TestCase):
+    def test_hash_cached(self) -> None:
+        leaf = leaf_t(name="a")
+        self.assertEqual(hash(leaf), hash(leaf_t(name="a")))
+        self.assertEqual(hash((leaf_t, "a", 0, True)), hash(leaf))
+        with mock.patch.dict(leaf.__dict__, {"name": "b"}):
+            # the fields are not looked at again
+            self.assertEqual(hash(leaf_t(name="a")), hash(leaf))
+        # the cache is not a field
+        self.assertEqual({"name": "a", "size": 0, "enabled": True}, leaf.dict())
+        self.assertEqual("shape(name='a', size=0, enabled=True)", repr(leaf))
+        self.assertNotIn("_shape_hash", leaf.json())
+        # nor is it copied along with changed fields
+        self.assertEqual(hash(leaf_t(name="b")), hash(leaf.copy(update={"name": "b"})))
+        self.assertEqual(hash(leaf), hash(leaf.copy()))
+
+    def test_unhashable(self) -> None:
+        tree = tree_t.parse_obj(_tree_json())
+        # shape enums are not hashable
+        for _ in range(2):
+            with self.assertRaises(TypeError):
+                hash(tree)
+        self.assertEqual(tree, tree_t.parse_obj(_tree_json()))
+        other = _tree_json()
+        other["leaves"][0]["size"] = 100
+        self.assertNotEqual(tree, tree_t.parse_obj(other))
+
+    def test_eq(self) -> None:
+        leaf = leaf_t(name="a")
+        self.assertEqual(leaf, leaf)
+        self.assertEqual(leaf, leaf_t(name="a"))
+        self.assertNotEqual(leaf, leaf_t(name="a", size=1))
+        # like pydantic, anything with the same `dict()` is equal
+        self.assertEqual(leaf, {"name": "a", "size": 0, "enabled": True})
+        self.assertNotEqual(leaf, other_leaf_t(label="a"))
+        # a hash mismatch is enough to tell that they are different
+        other = leaf_t(name="b")
+        hash(leaf), hash(other)
+        with mock.patch.dict(other.__dict__, {"name": "a"}):
+            self.assertNotEqual(leaf, other)
+
+
+class CacheBytesTestCase(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        raw = json.dumps(_tree_json())
+        expected = tree_t.parse_raw(raw)
+        cached = expected._to_cache_bytes()
+        self.assertLess(len(cached), len(raw))
+        actual = tree_t._from_cache_bytes(cached)
+        self.assertEqual(expected, actual)
+        self.assertEqual(repr(expected), repr(actual))
+        self.assertEqual(expected.dict(), actual.dict())
+        self.assertEqual(cached, actual._to_cache_bytes())
+        for field in tree_t.__fields__:
+            self.assertIs(
+                type(getattr(expected, field)), type(getattr(actual, field)), field
+            )
+        self.assertIsInstance(actual.tags, frozendict)
+        self.assertEqual([leaf_t, other_leaf_t], [type(m) for m in actual.many])
+        with self.assertRaises(TypeError):
+            actual.path = Path("/other")
+        # and back to a validated instance
+        self.assertEqual(expected, tree_t.parse_obj(actual.dict()))
+
+    def test_optional(self) -> None:
+        data = _tree_json()
+        data["parent"] = {"name": "parent"}
+        data["names"] = []
+        for tree in [tree_t.parse_obj(data), tree_t.parse_obj(_tree_json())]:
+            self.assertEqual(tree, tree_t._from_cache_bytes(tree._to_cache_bytes()))
+
+    def test_subclass(self) -> None:
+        class user_t(leaf_t):
+            extra: typing.Tuple[Path, ...]
+
+        leaf = user_t(name="a", extra=["/a", "/b"])
+        self.assertEqual(leaf, user_t._from_cache_bytes(leaf._to_cache_bytes()))
+
+    def test_wrong_shape(self) -> None:
+        cached = leaf_t(name="a")._to_cache_bytes()
+        with self.assertRaisesRegex(ValueError, "not cached data of"):
+            other_leaf_t._from_cache_bytes(cached)
+
+        class changed_t(Shape):
+            __GENERATED_SHAPE__ = True
+            __SHAPE_FIELDS__ = ("name", "size", "enabled")
+
+            name: str
+            size: str
+            enabled: bool
+
+        with self.assertRaisesRegex(ValueError, "not cached data of"):
+            changed_t._from_cache_bytes(cached)
+
+    def test_other_process(self) -> None:
+        cached = leaf_t(name="a")._to_cache_bytes()
+        tampered = bytearray(cached)
+        tampered[-1] ^= 1
+        # another process has another key
+        with mock.patch("antlir.shape._CACHE_KEY", b"\0" * 32):
+            other_process = leaf_t(name="a")._to_cache_bytes()
+        # nothing that this process did not write gets to `marshal.loads`
+        with mock.patch("marshal.loads") as loads:
+            for data in [b"{}", bytes(tampered), other_process]:
+                with self.assertRaisesRegex(ValueError, "not cached by this process"):
+                    leaf_t._from_cache_bytes(data)
+            loads.assert_not_called()